@@ -0,0 +1,478 @@
+"""
+Columnar cold tier for old observations.
+
+Observations older than HEALTH_ARCHIVE_AFTER_DAYS move, one UTC month
+per device, into Arrow IPC files under HEALTH_ARCHIVE_DIR: one record
+batch per file, sorted by (observed_ms, event_id), uncompressed so it
+can be memory-mapped and read without copying. Low-cardinality strings
+are dictionary-encoded, the device id lives only in the manifest and
+observed_at is only kept where it is not just observed_ms spelled out.
+
+SQLite keeps the manifest (archive_segment, with an interval index) and
+the content hashes of archived events (archived_identity), so re-uploads
+of archived history are still caught as duplicates.
+
+Derived tables are refreshed before events leave and the dirty marks
+their deletion leaves behind are dropped, so fused_minute, rollups and
+sleep sessions keep covering archived months. Their rebuilds only redo
+months without a segment (live_spans, ARCHIVED_SQL); rollups add the
+archived events of each bucket (events), so a timezone change
+re-buckets archived months too, and the step baseline falls back to
+the last archived counter sample (last_step). The archive is read-only
+history: metrics (api/metrics.py) and /observations read both tiers,
+but archived events can no longer be invalidated or superseded.
+
+Rows that land in an archived month later show up in /observations and
+metrics right away, but derived.refresh leaves that month's derived
+tables as they are; the next run folds the rows into a new generation
+of the month file.
+
+    python -m api.archive run [--older-than-days N] [--device ID]
+    python -m api.archive list
+"""
+import argparse
+import functools
+import json
+import os
+import sqlite3
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from urllib.parse import quote
+
+import numpy as np
+
+from . import config
+
+
+DAY_MS = 86_400_000
+
+# (name, arrow type) of every archived column; see _schema()
+COLUMNS = [
+    ("event_id", "string"),
+    ("observed_ms", "int64"),
+    ("observed_at", "string"),         # NULL when it is iso_ms(observed_ms)
+    ("obs_kind", "dict"),
+    ("is_valid", "int8"),
+    ("superseded_by", "string"),
+    ("note", "string"),
+    ("body_mass_kg", "float64"),
+    ("step_value", "int64"),
+    ("step_mode", "dict"),
+    ("step_delta", "int64"),           # steps_normalized.step_delta
+    ("state", "dict"),
+    ("source_kind", "dict"),
+    ("app_version", "dict"),
+    ("ingested_at", "string"),
+    ("provenance_json", "string"),
+    ("content_hash", "string"),
+]
+
+SOURCE_SQL = """
+    SELECT e.event_id, e.observed_ms, e.observed_at, e.obs_kind, e.is_valid,
+        e.superseded_by, e.note, w.body_mass_kg, s.step_value, s.step_mode,
+        n.step_delta, z.state, p.source_kind, p.app_version, p.ingested_at,
+        p.provenance_json, i.content_hash
+    FROM observation_event e
+    LEFT JOIN event_weight w ON w.event_key = e.event_key
+    LEFT JOIN event_steps s ON s.event_key = e.event_key
+    LEFT JOIN steps_normalized n ON n.event_id = e.event_id
+    LEFT JOIN event_sleep_state z ON z.event_key = e.event_key
+    LEFT JOIN event_provenance p ON p.event_key = e.event_key
+    LEFT JOIN observation_identity i ON i.event_id = e.event_id
+    WHERE e.device_id = ? AND e.observed_ms >= ? AND e.observed_ms < ?
+    ORDER BY e.observed_ms, e.event_id
+"""
+
+# device-months with live events before the cutoff
+DUE_SQL = """
+    SELECT device_id, MIN(observed_ms) FROM observation_event
+    WHERE observed_ms < ? {device}
+    GROUP BY device_id
+"""
+
+# whether {table}'s row at {ms} lies in an archived month of its device;
+# derived tables keep those rows as they are
+ARCHIVED_SQL = """EXISTS (
+    SELECT 1 FROM archive_segment s
+    WHERE s.device_id = {table}.device_id
+        AND s.month = strftime('%Y-%m', {ms} / 1000, 'unixepoch')
+)"""
+
+SEGMENTS_SQL = """
+    SELECT device_id, month, start_ms, end_ms, path FROM archive_segment
+    WHERE {where} AND end_ms >= ? AND start_ms < ?
+    ORDER BY start_ms
+"""
+
+UPSERT_SEGMENT_SQL = """
+    INSERT INTO archive_segment
+    (device_id, month, start_ms, end_ms, path, row_count, byte_size, archived_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, strftime('%Y-%m-%dT%H:%M:%fZ', 'now'))
+    ON CONFLICT(device_id, month) DO UPDATE SET
+        start_ms = excluded.start_ms, end_ms = excluded.end_ms, path = excluded.path,
+        row_count = excluded.row_count, byte_size = excluded.byte_size,
+        archived_at = excluded.archived_at
+"""
+
+
+def iso_ms(ms: int) -> str:
+    dt = datetime.fromtimestamp(ms // 1000, tz=timezone.utc)
+    return f"{dt:%Y-%m-%dT%H:%M:%S}.{ms % 1000:03d}Z"
+
+
+def month_start(ms: int) -> int:
+    dt = datetime.fromtimestamp(ms // 1000, tz=timezone.utc)
+    return int(datetime(dt.year, dt.month, 1, tzinfo=timezone.utc).timestamp() * 1000)
+
+
+def next_month(ms: int) -> int:
+    dt = datetime.fromtimestamp(ms // 1000, tz=timezone.utc)
+    year, month = (dt.year + 1, 1) if dt.month == 12 else (dt.year, dt.month + 1)
+    return int(datetime(year, month, 1, tzinfo=timezone.utc).timestamp() * 1000)
+
+
+def month_label(ms: int) -> str:
+    return datetime.fromtimestamp(ms // 1000, tz=timezone.utc).strftime("%Y-%m")
+
+
+def live_spans(conn: sqlite3.Connection, device_id: str) -> list[tuple[int, int]]:
+    """
+    [lo, hi) spans around the archived months of device_id, oldest first
+    """
+    spans, lo = [], -(2**62)
+    for (month,) in conn.execute(
+        "SELECT month FROM archive_segment WHERE device_id = ? ORDER BY month", (device_id,)
+    ):
+        start = int(datetime.strptime(month, "%Y-%m").replace(tzinfo=timezone.utc).timestamp() * 1000)
+        if start > lo:
+            spans.append((lo, start))
+        lo = next_month(start)
+    spans.append((lo, 2**62))
+    return spans
+
+
+def _root(root=None) -> Path:
+    return Path(root or config.ARCHIVE_DIR)
+
+
+def _schema():
+    import pyarrow as pa
+
+    types = {
+        "string": pa.string(), "int64": pa.int64(), "int8": pa.int8(),
+        "float64": pa.float64(), "dict": pa.dictionary(pa.int32(), pa.string()),
+    }
+    return pa.schema([(name, types[kind]) for name, kind in COLUMNS])
+
+
+@functools.lru_cache(maxsize=64)
+def _open(path: str):
+    """
+    the record batch of one archive file, memory-mapped. Files are never
+    rewritten in place (a new generation gets a new name), so caching by
+    path is safe.
+    """
+    import pyarrow as pa
+
+    reader = pa.ipc.open_file(pa.memory_map(path, "r"))
+    if reader.num_record_batches == 0:
+        return pa.RecordBatch.from_pylist([], schema=_schema())
+    return reader.get_batch(0)
+
+
+def _batch(rows: list[tuple]):
+    import pyarrow as pa
+
+    schema = _schema()
+    columns = list(zip(*rows)) if rows else [[] for _ in COLUMNS]
+    arrays = []
+    for (name, kind), values in zip(COLUMNS, columns):
+        if kind == "dict":
+            arrays.append(pa.array(values, type=pa.string()).dictionary_encode())
+        else:
+            arrays.append(pa.array(values, type=schema.field(name).type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def _write(path: Path, batch):
+    import pyarrow as pa
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    with pa.OSFile(str(tmp), "wb") as sink:
+        with pa.ipc.new_file(sink, batch.schema) as writer:
+            writer.write_batch(batch)
+    with open(tmp, "rb+") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _segment_path(device_id: str, month: str, generation: int) -> str:
+    return f"{quote(device_id, safe='')}/{month}.g{generation}.arrow"
+
+
+def _archive_month(conn: sqlite3.Connection, root: Path, device_id: str, lo: int, hi: int):
+    """
+    move the live events of [lo, hi) on device_id into a new generation
+    of its month file; the caller owns the transaction. Returns (events
+    moved, file written, file it replaces); the caller removes the
+    first file if the transaction fails and the second once it commits.
+    """
+    month = month_label(lo)
+    rows = [
+        (r[0], r[1], None if r[2] == iso_ms(r[1]) else r[2]) + r[3:]
+        for r in conn.execute(SOURCE_SQL, (device_id, lo, hi))
+    ]
+    if not rows:
+        return 0, None, None
+    old = conn.execute(
+        "SELECT path FROM archive_segment WHERE device_id = ? AND month = ?", (device_id, month)
+    ).fetchone()
+    generation = 1
+    if old is not None:
+        previous = _open(str(root / old[0])).to_pylist()
+        rows.extend(tuple(r[name] for name, _ in COLUMNS) for r in previous)
+        rows.sort(key=lambda r: (r[1], r[0]))
+        generation = int(old[0].rsplit(".g", 1)[1].split(".")[0]) + 1
+
+    rel = _segment_path(device_id, month, generation)
+    path = root / rel
+    _write(path, _batch(rows))
+    try:
+        conn.execute(UPSERT_SEGMENT_SQL, (
+            device_id, month, rows[0][1], rows[-1][1], rel, len(rows), path.stat().st_size,
+        ))
+        conn.executemany(
+            "INSERT OR IGNORE INTO archived_identity(content_hash, event_id) VALUES (?, ?)",
+            [(r[-1], r[0]) for r in rows if r[-1] is not None],
+        )
+        # the table, not the view, so that rowcount counts the events
+        moved = conn.execute(
+            "DELETE FROM event WHERE device_key = (SELECT device_key FROM device WHERE device_id = ?)"
+            " AND observed_ms >= ? AND observed_ms < ?",
+            (device_id, lo, hi),
+        ).rowcount
+        # derived tables already cover these events; keep them as they are
+        conn.execute(
+            "DELETE FROM fused_minute_dirty WHERE device_id = ? AND minute_bucket >= ? AND minute_bucket < ?",
+            (device_id, lo // 60_000, -(-hi // 60_000)),
+        )
+    except BaseException:
+        path.unlink(missing_ok=True)
+        raise
+    return moved, path, None if old is None else root / old[0]
+
+
+def run(conn: sqlite3.Connection, older_than_days: int | None = None,
+        device_id: str | None = None, root=None) -> dict:
+    """
+    archive every whole UTC month that ended before now - older_than_days,
+    one transaction per device-month
+    """
+    # derived's rebuilds read the archive, so it is imported here
+    from . import derived
+
+    root = _root(root)
+    days = config.ARCHIVE_AFTER_DAYS if older_than_days is None else older_than_days
+    cutoff = month_start(int(time.time() * 1000) - days * DAY_MS)
+    params: list = [cutoff]
+    device = ""
+    if device_id is not None:
+        device = "AND device_id = ?"
+        params.append(device_id)
+    due = conn.execute(DUE_SQL.format(device=device), params).fetchall()
+
+    counts = {"segments": 0, "events": 0}
+    for device, first in due:
+        lo = month_start(first)
+        while lo < cutoff:
+            hi = next_month(lo)
+            written = None
+            try:
+                with conn:
+                    # bring derived tables up to date while the events are here
+                    derived.refresh(conn)
+                    moved, written, replaced = _archive_month(conn, root, device, lo, hi)
+            except BaseException:
+                if written is not None:
+                    written.unlink(missing_ok=True)
+                raise
+            if replaced is not None:
+                replaced.unlink(missing_ok=True)
+            if moved:
+                counts["segments"] += 1
+                counts["events"] += moved
+            lo = hi
+    return counts
+
+
+def segments(conn: sqlite3.Connection, device_id: str | None, start_ms: int, end_ms: int) -> list[tuple]:
+    """
+    (device_id, month, start_ms, end_ms, path) of the segments that overlap
+    [start_ms, end_ms), by start_ms
+    """
+    where, params = ("device_id = ?", [device_id]) if device_id is not None else ("1", [])
+    return conn.execute(SEGMENTS_SQL.format(where=where), params + [start_ms, end_ms]).fetchall()
+
+
+def _slice(batch, start_ms: int, end_ms: int):
+    t = batch.column("observed_ms").to_numpy()
+    lo, hi = np.searchsorted(t, [start_ms, end_ms], side="left")
+    return batch.slice(lo, hi - lo)
+
+
+def _is(batch, column: str, value: str) -> np.ndarray:
+    """
+    column == value for a dictionary column, compared on the codes
+    """
+    arr = batch.column(column)
+    codes = np.flatnonzero(np.asarray(arr.dictionary.to_pylist(), dtype=object) == value)
+    if not len(codes):
+        return np.zeros(len(arr), dtype=bool)
+    return np.isin(arr.indices.to_numpy(zero_copy_only=False), codes)
+
+
+def _valid(batch) -> np.ndarray:
+    return ((batch.column("is_valid").to_numpy(zero_copy_only=False) == 1)
+            & ~batch.column("superseded_by").is_valid().to_numpy(zero_copy_only=False))
+
+
+def load(conn: sqlite3.Connection, device_id: str, obs_kind: str, column: str,
+         start_ms: int, end_ms: int, root=None) -> tuple[np.ndarray, np.ndarray]:
+    """
+    (observed_ms, column) of valid archived obs_kind samples in
+    [start_ms, end_ms), sorted, for the metric loaders
+    """
+    found = segments(conn, device_id, start_ms, end_ms)
+    if not found:
+        return np.empty(0, dtype=np.int64), np.empty(0)
+    root = _root(root)
+    ts, vs = [], []
+    for *_, rel in found:
+        batch = _slice(_open(str(root / rel)), start_ms, end_ms)
+        values = batch.column(column)
+        keep = (_valid(batch)
+                & _is(batch, "obs_kind", obs_kind)
+                & values.is_valid().to_numpy(zero_copy_only=False))
+        ts.append(batch.column("observed_ms").to_numpy()[keep])
+        vs.append(values.to_numpy(zero_copy_only=False)[keep].astype(np.float64))
+    return np.concatenate(ts), np.concatenate(vs)
+
+
+def events(conn: sqlite3.Connection, device_id: str, start_ms: int, end_ms: int,
+           root=None) -> dict[str, np.ndarray]:
+    """
+    observed_ms, obs_kind, body_mass_kg, step_value, step_mode and
+    step_delta of the valid archived events in [start_ms, end_ms), by
+    observed_ms; missing numbers are NaN. For the rollups.
+    """
+    strings = ("obs_kind", "step_mode")
+    numbers = ("body_mass_kg", "step_value", "step_delta")
+    out: dict[str, list] = {name: [] for name in ("observed_ms",) + strings + numbers}
+    root = _root(root)
+    for *_, rel in segments(conn, device_id, start_ms, end_ms):
+        batch = _slice(_open(str(root / rel)), start_ms, end_ms)
+        batch = batch.take(np.flatnonzero(_valid(batch)))
+        out["observed_ms"].append(batch.column("observed_ms").to_numpy())
+        for name in strings:
+            out[name].append(np.asarray(batch.column(name).to_pylist(), dtype=object))
+        for name in numbers:
+            out[name].append(batch.column(name).to_numpy(zero_copy_only=False).astype(np.float64))
+    empty = {"observed_ms": np.int64, **dict.fromkeys(strings, object), **dict.fromkeys(numbers, np.float64)}
+    return {
+        name: np.concatenate(parts) if parts else np.empty(0, dtype=empty[name])
+        for name, parts in out.items()
+    }
+
+
+def last_step(conn: sqlite3.Connection, device_id: str, step_mode: str,
+              after_ms: int, before_ms: int, root=None) -> tuple | None:
+    """
+    (observed_ms, event_id, step_value) of the last valid archived
+    step_mode sample in [after_ms, before_ms), the baseline of the
+    first live sample after it
+    """
+    root = _root(root)
+    for *_, rel in reversed(segments(conn, device_id, after_ms, before_ms)):
+        batch = _slice(_open(str(root / rel)), after_ms, before_ms)
+        keep = np.flatnonzero(_valid(batch) & _is(batch, "obs_kind", "steps")
+                              & _is(batch, "step_mode", step_mode))
+        if len(keep):
+            row = batch.slice(int(keep[-1]), 1).to_pylist()[0]
+            return row["observed_ms"], row["event_id"], row["step_value"]
+    return None
+
+
+def scan(conn: sqlite3.Connection, device_id: str | None, obs_kind: str | None,
+         start_ms: int, end_ms: int, valid_only: bool, after: list | None,
+         limit: int, root=None) -> list[dict]:
+    """
+    up to limit archived rows in /observations shape, in (observed_ms,
+    event_id) order and after the keyset cursor
+    """
+    if after is not None:
+        start_ms = max(start_ms, after[0])
+    found = segments(conn, device_id, start_ms, end_ms)
+    if not found:
+        return []
+    root = _root(root)
+    out: list[tuple] = []
+    for i, (device, _, _, _, rel) in enumerate(found):
+        batch = _slice(_open(str(root / rel)), start_ms, end_ms)
+        keep = np.ones(batch.num_rows, dtype=bool)
+        if obs_kind is not None:
+            keep &= _is(batch, "obs_kind", obs_kind)
+        if valid_only:
+            keep &= _valid(batch)
+        if after is not None:
+            # rows at after[0] itself need the event_id tie-break
+            t = batch.column("observed_ms").to_numpy()
+            ties = np.flatnonzero(keep & (t == after[0]))
+            if len(ties):
+                ids = batch.column("event_id").take(ties).to_pylist()
+                keep[ties] = [e > after[1] for e in ids]
+        idx = np.flatnonzero(keep)[:limit]
+        for row in batch.take(idx).to_pylist():
+            row["device_id"] = device
+            if row["observed_at"] is None:
+                row["observed_at"] = iso_ms(row["observed_ms"])
+            out.append(((row["observed_ms"], row["event_id"]), row))
+        out.sort(key=lambda r: r[0])
+        del out[limit:]
+        # segments come by start_ms: none of the rest can beat a full page
+        if len(out) == limit and (i + 1 == len(found) or found[i + 1][2] > out[-1][0][0]):
+            break
+    return [row for _, row in out]
+
+
+def main(argv=None):
+    from . import db
+
+    parser = argparse.ArgumentParser(prog="python -m api.archive")
+    parser.add_argument("command", choices=["run", "list"])
+    parser.add_argument("--db", default=None, help="database (default: HEALTH_DB_PATH)")
+    parser.add_argument("--older-than-days", type=int, default=None,
+                        help="age to archive at (default: HEALTH_ARCHIVE_AFTER_DAYS)")
+    parser.add_argument("--device", default=None, help="only this device_id")
+    args = parser.parse_args(argv)
+
+    conn = db.connect(path=args.db)
+    try:
+        if args.command == "run":
+            counts = run(conn, args.older_than_days, args.device)
+            print(f"archived: {counts}")
+        else:
+            for row in conn.execute(
+                "SELECT device_id, month, row_count, byte_size, path FROM archive_segment"
+                " ORDER BY device_id, month"
+            ):
+                print(json.dumps(dict(zip(("device_id", "month", "rows", "bytes", "path"), row))))
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,91 @@
+import os
+from pathlib import Path
+
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+
+
+def load_env_file(path: Path):
+    """
+    minimal .env reader (KEY=VALUE, # comments, optional quotes).
+    Real environment variables always win over the file.
+    """
+    if not path.exists():
+        return
+    for line in path.read_text(encoding="utf-8").splitlines():
+        line = line.strip()
+        if not line or line.startswith("#") or "=" not in line:
+            continue
+        key, value = line.split("=", 1)
+        key = key.strip()
+        if key.startswith("export "):
+            key = key[len("export "):].strip()
+        value = value.strip()
+        if len(value) >= 2 and value[0] == value[-1] and value[0] in "\"'":
+            value = value[1:-1]
+        os.environ.setdefault(key, value)
+
+
+def env_int(name: str, default: int) -> int:
+    return int(os.environ.get(name, default))
+
+
+def env_float(name: str, default: float) -> float:
+    return float(os.environ.get(name, default))
+
+
+load_env_file(ROOT_DIR / ".env")
+
+DB_PATH = os.environ.get("HEALTH_DB_PATH", "/home/kris/healthass/store/health.db")
+
+# connection setup, applied once per connection
+DB_BUSY_TIMEOUT_MS = env_int("HEALTH_DB_BUSY_TIMEOUT_MS", 5000)
+DB_SYNCHRONOUS = os.environ.get("HEALTH_DB_SYNCHRONOUS", "NORMAL")
+DB_MMAP_SIZE = env_int("HEALTH_DB_MMAP_SIZE", 256 * 1024 * 1024)
+DB_CACHE_SIZE = env_int("HEALTH_DB_CACHE_SIZE", -16000)  # negative = KiB
+DB_TEMP_STORE = os.environ.get("HEALTH_DB_TEMP_STORE", "MEMORY")
+DB_STATEMENT_CACHE = env_int("HEALTH_DB_STATEMENT_CACHE", 256)
+
+# reader pool
+DB_READERS = env_int("HEALTH_DB_READERS", 4)
+DB_THREADS = env_int("HEALTH_DB_THREADS", DB_READERS)
+DB_CONN_MAX_AGE_S = env_float("HEALTH_DB_CONN_MAX_AGE_S", 600)
+DB_CONN_MAX_USES = env_int("HEALTH_DB_CONN_MAX_USES", 10000)
+
+# group-commit writer
+WRITER_BATCH_MS = env_float("HEALTH_WRITER_BATCH_MS", 10)
+WRITER_BATCH_ROWS = env_int("HEALTH_WRITER_BATCH_ROWS", 1000)
+
+# cold tier (api/archive.py): where month files go, and the age at which
+# observations move there
+ARCHIVE_DIR = Path(os.environ.get("HEALTH_ARCHIVE_DIR", Path(DB_PATH).parent / "archive"))
+ARCHIVE_AFTER_DAYS = env_int("HEALTH_ARCHIVE_AFTER_DAYS", 365)
+
+# instrumentation (api/instrument.py, GET /metrics); 0 turns it off.
+# Statements slower than HEALTH_SLOW_QUERY_MS are logged with their plan
+# (0 = no slow-query log), to HEALTH_SLOW_QUERY_LOG or stderr.
+INSTRUMENT = env_int("HEALTH_INSTRUMENT", 1) != 0
+SLOW_QUERY_MS = env_float("HEALTH_SLOW_QUERY_MS", 0)
+SLOW_QUERY_LOG = os.environ.get("HEALTH_SLOW_QUERY_LOG", "")
+
+# evidence bundles (api/evidence.py): in-memory LRU size, and the spans
+# (days) built ahead of time for every metric after each engine run
+EVIDENCE_CACHE_ENTRIES = env_int("HEALTH_EVIDENCE_CACHE_ENTRIES", 1024)
+EVIDENCE_WARM_DAYS = [int(d) for d in os.environ.get("HEALTH_EVIDENCE_WARM_DAYS", "7,30").split(",") if d.strip()]
+
+# explanations (api/explain.py): Ollama-compatible runtime, model, and how
+# many requests it gets at once
+OLLAMA_URL = os.environ.get("HEALTH_OLLAMA_URL", "http://127.0.0.1:11434")
+OLLAMA_MODEL = os.environ.get("HEALTH_OLLAMA_MODEL", "qwen3:0.6b")
+EXPLAIN_CONCURRENCY = env_int("HEALTH_EXPLAIN_CONCURRENCY", 1)
+EXPLAIN_TIMEOUT_S = env_float("HEALTH_EXPLAIN_TIMEOUT_S", 120)
+
+# timezone for devices without a device_settings row
+DEFAULT_TIMEZONE = os.environ.get("HEALTH_DEFAULT_TIMEZONE", "UTC")
+
+# metric engine: seconds between scheduled runs (0 = only when triggered)
+METRIC_INTERVAL_S = env_float("HEALTH_METRIC_INTERVAL_S", 900)
+
+# decision engine
+POLICY_DIR = Path(os.environ.get("HEALTH_POLICY_DIR", ROOT_DIR / "policies"))
+POLICY_VERSION = os.environ.get("HEALTH_POLICY_VERSION", "v1")
@@ -0,0 +1,208 @@
+"""
+Bulk corrections of observations after insert: invalidate, supersede or
+restore a set of events, chosen by event_id list or by a (device_id,
+obs_kind, [start_ms, end_ms)) predicate.
+
+apply() runs in the caller's transaction (one writer job) and brings
+everything downstream up to date before it returns, touching only what
+the corrected events fall in:
+- minute buckets: the fused triggers mark the corrected minutes dirty;
+  derived.refresh() recomputes them, the normalized step deltas after
+  them, their hour/day/week rollups and the sleep sessions around them
+- metric windows: per device, the metrics computed from a corrected
+  obs_kind are recomputed over the windows overlapping the corrected
+  span, widened to the next step sample (its delta depends on the one
+  before) and to the start of any sleep session it was or becomes part
+  of. Only values or runs that actually change are written.
+- decisions: the decision_runs of changed values are deleted, so the
+  decision engine evaluates them again on its next run
+
+Evidence bundles and report days follow from the existing triggers and
+change marks.
+
+    python -m api.corrections invalidate --event-id ID [--event-id ID ...]
+    python -m api.corrections supersede --device D --kind weight --start-ms A --end-ms B --superseded-by ID
+    python -m api.corrections restore --device D --start-ms A --end-ms B
+"""
+import argparse
+import sqlite3
+import sys
+
+from . import derived, metrics, rollups
+from .identity import LOOKUP_CHUNK
+
+
+ACTIONS = ("invalidate", "supersede", "restore")
+
+# (SET clause, rows it changes) per action
+ACTION_SQL = {
+    "invalidate": ("is_valid = 0", "is_valid = 1"),
+    "supersede": ("superseded_by = :superseded_by", "superseded_by IS NOT :superseded_by"),
+    "restore": ("is_valid = 1, superseded_by = NULL", "(is_valid = 0 OR superseded_by IS NOT NULL)"),
+}
+
+TARGET_COLUMNS = "event_id, device_id, obs_kind, observed_ms"
+
+NEXT_STEP_SQL = """
+SELECT MIN(observed_ms) FROM steps_normalized WHERE device_id = ? AND observed_ms > ?
+"""
+
+
+def _targets(conn: sqlite3.Connection, where: str, params: dict, event_ids, device_id,
+             obs_kind, start_ms, end_ms) -> tuple[list[tuple], int]:
+    """
+    (rows the action changes, rows selected)
+    """
+    select = f"SELECT {TARGET_COLUMNS}, {where} FROM observation_event WHERE "
+    if event_ids is not None:
+        event_ids = list(dict.fromkeys(event_ids))
+        queries = []
+        for i in range(0, len(event_ids), LOOKUP_CHUNK):
+            part = {f"e{j}": event_id for j, event_id in enumerate(event_ids[i:i + LOOKUP_CHUNK])}
+            marks = ",".join(f":{name}" for name in part)
+            queries.append((select + f"event_id IN ({marks})", {**params, **part}))
+    else:
+        sql = select + "device_id = :device_id AND observed_ms >= :start_ms AND observed_ms < :end_ms"
+        if obs_kind is not None:
+            sql += " AND obs_kind = :obs_kind"
+        queries = [(sql, {**params, "device_id": device_id, "obs_kind": obs_kind,
+                          "start_ms": start_ms, "end_ms": end_ms})]
+    rows, matched = [], 0
+    for sql, bound in queries:
+        for *row, changes in conn.execute(sql, bound):
+            matched += 1
+            if changes:
+                rows.append(tuple(row))
+    return rows, matched
+
+
+def _validate(conn, action, event_ids, device_id, start_ms, end_ms, superseded_by):
+    if action not in ACTIONS:
+        raise ValueError(f"action must be one of {ACTIONS}")
+    if event_ids is not None and device_id is not None:
+        raise ValueError("give either event_ids or device_id with start_ms/end_ms, not both")
+    if event_ids is None:
+        if device_id is None or start_ms is None or end_ms is None:
+            raise ValueError("device_id, start_ms and end_ms are required without event_ids")
+        if end_ms <= start_ms:
+            raise ValueError("end_ms must be after start_ms")
+    if action == "supersede":
+        if superseded_by is None:
+            raise ValueError("supersede needs superseded_by")
+        if conn.execute(
+            "SELECT 1 FROM observation_event WHERE event_id = ?", (superseded_by,)
+        ).fetchone() is None:
+            raise ValueError(f"Unknown superseded_by event: {superseded_by}")
+    elif superseded_by is not None:
+        raise ValueError(f"superseded_by only applies to supersede, not {action}")
+
+
+def apply(conn: sqlite3.Connection, action: str, event_ids=None, device_id: str | None = None,
+          obs_kind: str | None = None, start_ms: int | None = None, end_ms: int | None = None,
+          superseded_by: str | None = None, note: str | None = None) -> dict:
+    """
+    correct the selected events and their downstream data, inside the
+    caller's transaction; returns counts of what changed
+    """
+    _validate(conn, action, event_ids, device_id, start_ms, end_ms, superseded_by)
+    assignment, where = ACTION_SQL[action]
+    params = {"superseded_by": superseded_by} if action == "supersede" else {}
+    rows, matched = _targets(conn, where, params, event_ids, device_id, obs_kind, start_ms, end_ms)
+    if superseded_by is not None and any(row[0] == superseded_by for row in rows):
+        raise ValueError(f"{superseded_by} cannot supersede itself")
+    result = {
+        "matched": matched,
+        "missing": (len(set(event_ids)) - matched) if event_ids is not None else 0,
+        "events": len(rows),
+        "minute_buckets": 0,
+        "rollup_buckets": 0,
+        "metric_values": 0,
+        "stale_values": 0,
+        "decisions_cleared": 0,
+    }
+    if not rows:
+        return result
+
+    # device_id -> [lo, hi, obs_kinds] of the corrected events
+    spans: dict[str, list] = {}
+    for _, dev, kind, observed_ms in rows:
+        span = spans.setdefault(dev, [observed_ms, observed_ms, set()])
+        span[0] = min(span[0], observed_ms)
+        span[1] = max(span[1], observed_ms)
+        span[2].add(kind)
+    # sessions the corrected sleep samples belong to now; after the
+    # refresh they may belong to different ones
+    sleep_starts = {
+        dev: metrics.session_start(conn, dev, lo, hi)
+        for dev, (lo, hi, kinds) in spans.items() if "sleep_state" in kinds
+    }
+
+    conn.executemany(
+        f"UPDATE event SET {assignment}, note = COALESCE(:note, note)"
+        " WHERE event_id = :event_id",
+        [{**params, "note": note, "event_id": row[0]} for row in rows],
+    )
+
+    keys = derived.refresh(conn)
+    result["minute_buckets"] = len(keys)
+    result["rollup_buckets"] = len(rollups.buckets_for_minutes(conn, keys))
+
+    batch = metrics.MetricBatch()
+    for dev, (lo, hi, kinds) in spans.items():
+        if "sleep_state" in kinds:
+            for start in (sleep_starts[dev], metrics.session_start(conn, dev, lo, hi)):
+                if start is not None:
+                    lo = min(lo, start)
+        if "steps" in kinds:
+            after = conn.execute(NEXT_STEP_SQL, (dev, hi)).fetchone()[0]
+            if after is not None:
+                hi = after
+        metric_ids = [
+            spec.metric_id for spec in metrics.REGISTRY.values()
+            if metrics.SOURCE_KINDS[spec.source] in kinds
+        ]
+        if not metric_ids:
+            continue
+        part = metrics.recompute(conn, dev, lo, hi + 1, metric_ids)
+        batch.values.extend(part.values)
+        batch.runs.extend(part.runs)
+        batch.stale.extend(part.stale)
+
+    metrics.changed_only(conn, batch)
+    metrics.write(conn, batch)
+    result["decisions_cleared"] = batch.decisions_cleared
+    result["metric_values"] = len(batch.values)
+    result["stale_values"] = len(batch.stale)
+    return result
+
+
+def main(argv=None):
+    from . import db
+
+    parser = argparse.ArgumentParser(prog="python -m api.corrections")
+    parser.add_argument("action", choices=ACTIONS)
+    parser.add_argument("--event-id", action="append", dest="event_ids")
+    parser.add_argument("--device", dest="device_id")
+    parser.add_argument("--kind", dest="obs_kind")
+    parser.add_argument("--start-ms", type=int)
+    parser.add_argument("--end-ms", type=int)
+    parser.add_argument("--superseded-by")
+    parser.add_argument("--note")
+    args = parser.parse_args(argv)
+
+    conn = db.connect()
+    try:
+        with conn:
+            result = apply(conn, **vars(args))
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+    finally:
+        conn.close()
+    for name, n in result.items():
+        print(f"{name}: {n}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
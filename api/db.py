@@ -0,0 +1,134 @@
+import asyncio
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from . import config, instrument
+
+
+def connect(readonly: bool = False, path=None) -> sqlite3.Connection:
+    """
+    open a connection with the pragmas from config applied once
+    """
+    conn = sqlite3.connect(
+        path or config.DB_PATH,
+        timeout=config.DB_BUSY_TIMEOUT_MS / 1000,
+        cached_statements=config.DB_STATEMENT_CACHE,
+        check_same_thread=False,
+        factory=instrument.connection_factory(),
+    )
+    conn.execute("PRAGMA foreign_keys = ON;")
+    conn.execute(f"PRAGMA busy_timeout = {int(config.DB_BUSY_TIMEOUT_MS)};")
+    conn.execute(f"PRAGMA synchronous = {config.DB_SYNCHRONOUS};")
+    conn.execute(f"PRAGMA mmap_size = {int(config.DB_MMAP_SIZE)};")
+    conn.execute(f"PRAGMA cache_size = {int(config.DB_CACHE_SIZE)};")
+    conn.execute(f"PRAGMA temp_store = {config.DB_TEMP_STORE};")
+    if readonly:
+        conn.execute("PRAGMA query_only = ON;")
+    else:
+        # persistent in the file, so this only does work the first time
+        conn.execute("PRAGMA journal_mode = WAL;")
+    return conn
+
+
+class _Pooled:
+    __slots__ = ("conn", "created", "uses")
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.created = time.monotonic()
+        self.uses = 0
+
+
+class ReaderPool:
+    """
+    bounded set of read-only connections.
+
+    Connections are health-checked on checkout and recycled after
+    max_age_s seconds or max_uses checkouts, or after a database error.
+    """
+
+    def __init__(self, size: int, max_age_s: float, max_uses: int):
+        self.size = size
+        self.max_age_s = max_age_s
+        self.max_uses = max_uses
+        self._idle: queue.LifoQueue = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _fresh(self, item: _Pooled | None) -> bool:
+        if item is None:
+            return False
+        if time.monotonic() - item.created > self.max_age_s or item.uses >= self.max_uses:
+            return False
+        try:
+            item.conn.execute("SELECT 1").fetchone()
+        except sqlite3.Error:
+            return False
+        return True
+
+    def _checkout(self) -> _Pooled:
+        while True:
+            try:
+                item = self._idle.get_nowait()
+            except queue.Empty:
+                return _Pooled(connect(readonly=True))
+            if self._fresh(item):
+                return item
+            item.conn.close()
+
+    @contextmanager
+    def reader(self):
+        self._slots.acquire()
+        item = None
+        broken = False
+        try:
+            item = self._checkout()
+            item.uses += 1
+            yield item.conn
+        except sqlite3.DatabaseError:
+            broken = True
+            raise
+        finally:
+            if item is not None:
+                if broken:
+                    item.conn.close()
+                else:
+                    if item.conn.in_transaction:
+                        item.conn.rollback()
+                    self._idle.put(item)
+            self._slots.release()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().conn.close()
+            except queue.Empty:
+                break
+
+
+readers = ReaderPool(config.DB_READERS, config.DB_CONN_MAX_AGE_S, config.DB_CONN_MAX_USES)
+
+# blocking sqlite calls run here instead of on the event loop
+executor = ThreadPoolExecutor(max_workers=config.DB_THREADS, thread_name_prefix="sqlite-read")
+
+
+def _with_reader(fn, args, queued):
+    with readers.reader() as conn:
+        instrument.READ_WAIT.observe(time.perf_counter() - queued)
+        return fn(conn, *args)
+
+
+async def run_read(fn, *args):
+    """
+    run fn(conn, *args) on a pooled read connection off the event loop
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, _with_reader, fn, args, time.perf_counter())
+
+
+def shutdown():
+    executor.shutdown(wait=False)
+    readers.close()
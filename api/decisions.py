@@ -0,0 +1,292 @@
+"""
+Batch decision engine over metric_value.
+
+A policy is a versioned JSON rule file (config.POLICY_DIR/<version>.json).
+Every metric_value of a metric the policy has rules for gets exactly one
+decision_run per policy_version; the first matching rule sets the
+decision_result, and values no rule matches get action 'none'. Pending
+values are found with an anti-join on idx_decision_run_metric_policy, so
+re-running only touches what is new.
+
+    python -m api.decisions [policy_version]
+"""
+import json
+import operator
+import sqlite3
+import sys
+import uuid
+from datetime import datetime, timezone
+
+import numpy as np
+
+from . import config
+
+
+DAY_MS = 86_400_000
+
+# how far the window lag_days earlier may end from exactly lag_days * 24h
+NEAREST_MS = DAY_MS // 2
+
+DECISION_NAMESPACE = uuid.UUID("9e0b6f5a-3c41-4d8e-b7a2-6f1e2d9c4b37")
+
+OPS = {
+    ">": operator.gt,
+    ">=": operator.ge,
+    "<": operator.lt,
+    "<=": operator.le,
+}
+
+
+class Rule:
+    def __init__(self, spec: dict, default_confidence: float):
+        self.rule_id = spec["rule_id"]
+        self.type = spec.get("type", "threshold")
+        if self.type not in ("threshold", "trend"):
+            raise ValueError(f"rule {self.rule_id}: unknown type '{self.type}'")
+        if spec["op"] not in OPS:
+            raise ValueError(f"rule {self.rule_id}: unknown op '{spec['op']}'")
+        self.metric_id = spec["metric_id"]
+        self.op = OPS[spec["op"]]
+        self.threshold = float(spec["threshold"])
+        self.lag_ms = int(spec.get("lag_days", 0)) * DAY_MS
+        self.min_confidence = float(spec.get("min_confidence", default_confidence))
+        self.action = spec["action"]
+        self.msg = spec.get("msg")
+        self.explain = spec.get("explain")
+        self.notify = int(bool(spec.get("notify", False)))
+        self.reversible = int(bool(spec.get("reversible", True)))
+
+
+class Policy:
+    def __init__(self, spec: dict):
+        self.version = spec["policy_version"]
+        default_confidence = float(spec.get("min_confidence", 0.0))
+        self.rules = [Rule(r, default_confidence) for r in spec["rules"]]
+        self.metric_ids = sorted({r.metric_id for r in self.rules})
+        self.lags = sorted({r.lag_ms for r in self.rules if r.type == "trend"})
+
+
+_policies: dict[str, Policy] = {}
+
+
+def load_policy(version: str) -> Policy:
+    policy = _policies.get(version)
+    if policy is None:
+        path = config.POLICY_DIR / f"{version}.json"
+        with open(path, encoding="utf-8") as f:
+            policy = Policy(json.load(f))
+        if policy.version != version:
+            raise ValueError(f"{path} declares policy_version '{policy.version}'")
+        _policies[version] = policy
+    return policy
+
+
+def trend_lags(conn: sqlite3.Connection) -> dict[str, set[int]]:
+    """
+    metric_id -> lag_ms of the trend rules of every policy with decisions
+    stored; policies whose file is gone are skipped
+    """
+    out: dict[str, set[int]] = {}
+    for (version,) in conn.execute("SELECT DISTINCT policy_version FROM decision_run"):
+        try:
+            policy = load_policy(version)
+        except FileNotFoundError:
+            continue
+        for rule in policy.rules:
+            if rule.type == "trend":
+                out.setdefault(rule.metric_id, set()).add(rule.lag_ms)
+    return out
+
+
+class DecisionBatch:
+    def __init__(self, policy_version: str):
+        self.policy_version = policy_version
+        self.runs: list[tuple] = []
+        self.results: list[tuple] = []
+
+    def __len__(self):
+        return len(self.runs)
+
+
+def rowid_range(conn: sqlite3.Connection) -> tuple[int, int]:
+    row = conn.execute("SELECT MIN(rowid), MAX(rowid) FROM metric_value").fetchone()
+    return (row[0] or 0), (row[1] or 0)
+
+
+def pending(conn: sqlite3.Connection, policy: Policy, lo_rowid: int | None = None,
+            hi_rowid: int | None = None) -> list[tuple]:
+    """
+    metric values of the policy's metrics with no decision_run for it yet
+    """
+    marks = ",".join("?" * len(policy.metric_ids))
+    return conn.execute(
+        f"""
+        SELECT mv.metric_value_id, mv.metric_id, mv.device_id,
+            mv.window_start_ms, mv.window_end_ms, mv.value_real,
+            COALESCE(mr.confidence_score, 1.0)
+        FROM metric_value mv
+        LEFT JOIN metric_run mr ON mr.metric_value_id = mv.metric_value_id
+        WHERE mv.metric_id IN ({marks})
+            AND mv.rowid > ? AND mv.rowid <= ?
+            AND NOT EXISTS (
+                SELECT 1 FROM decision_run dr
+                WHERE dr.metric_value_id = mv.metric_value_id
+                    AND dr.policy_version = ?
+            )
+        """,
+        (*policy.metric_ids,
+         lo_rowid if lo_rowid is not None else -(2**62),
+         hi_rowid if hi_rowid is not None else 2**62,
+         policy.version),
+    ).fetchall()
+
+
+def previous_values(conn: sqlite3.Connection, rows: list[tuple], lag_ms: int) -> np.ndarray:
+    """
+    value of the same metric/device window lag_ms earlier, NaN when missing.
+    Windows end on local day boundaries, so across a DST change the earlier
+    window ends an hour off lag_ms; the one ending nearest it (within half
+    a day) is taken. One range read on idx_metric_value_device_window per
+    (device, metric).
+    """
+    out = np.full(len(rows), np.nan)
+    groups: dict[tuple, list[int]] = {}
+    for i, r in enumerate(rows):
+        groups.setdefault((r[2], r[1]), []).append(i)
+    for (device_id, metric_id), idx in groups.items():
+        starts = [rows[i][3] - lag_ms for i in idx]
+        found = conn.execute(
+            """
+            SELECT window_end_ms, value_real FROM metric_value
+            WHERE device_id = ? AND window_start_ms BETWEEN ? AND ?
+                AND metric_id = ?
+            ORDER BY window_end_ms
+            """,
+            (device_id, min(starts) - NEAREST_MS, max(starts) + NEAREST_MS, metric_id),
+        ).fetchall()
+        if not found:
+            continue
+        ends = np.array([we for we, _ in found], dtype=np.int64)
+        values = np.array([np.nan if v is None else v for _, v in found], dtype=np.float64)
+        targets = np.array([rows[i][4] - lag_ms for i in idx], dtype=np.int64)
+        after = np.clip(np.searchsorted(ends, targets), 0, len(ends) - 1)
+        before = np.clip(after - 1, 0, len(ends) - 1)
+        nearest = np.where(np.abs(ends[before] - targets) < np.abs(ends[after] - targets),
+                           before, after)
+        hit = np.abs(ends[nearest] - targets) < NEAREST_MS
+        out[np.array(idx)[hit]] = values[nearest[hit]]
+    return out
+
+
+def evaluate(conn: sqlite3.Connection, policy: Policy, lo_rowid: int | None = None,
+             hi_rowid: int | None = None) -> DecisionBatch:
+    """
+    read-only half: decide every pending value in the rowid range
+    """
+    batch = DecisionBatch(policy.version)
+    rows = pending(conn, policy, lo_rowid, hi_rowid)
+    if not rows:
+        return batch
+
+    metric_ids = np.array([r[1] for r in rows], dtype=object)
+    values = np.array([np.nan if r[5] is None else r[5] for r in rows], dtype=np.float64)
+    confidence = np.array([r[6] for r in rows], dtype=np.float64)
+    deltas = {}
+    for lag in policy.lags:
+        # only rows of metrics that have a trend rule with this lag
+        wanted = {r.metric_id for r in policy.rules if r.type == "trend" and r.lag_ms == lag}
+        idx = np.flatnonzero(np.isin(metric_ids, list(wanted)))
+        prev = np.full(len(rows), np.nan)
+        prev[idx] = previous_values(conn, [rows[i] for i in idx], lag)
+        deltas[lag] = values - prev
+
+    # first matching rule wins, so apply them back to front
+    chosen = np.full(len(rows), -1)
+    with np.errstate(invalid="ignore"):
+        for i in range(len(policy.rules) - 1, -1, -1):
+            rule = policy.rules[i]
+            subject = deltas[rule.lag_ms] if rule.type == "trend" else values
+            hit = ((metric_ids == rule.metric_id)
+                   & (confidence >= rule.min_confidence)
+                   & rule.op(subject, rule.threshold))
+            chosen[hit] = i
+
+    computed_at = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    for n, r in enumerate(rows):
+        run_id = str(uuid.uuid5(DECISION_NAMESPACE, f"{r[0]}|{policy.version}"))
+        batch.runs.append((run_id, r[0], computed_at, policy.version))
+        if chosen[n] < 0:
+            batch.results.append((run_id, 1, "no rule matched", "none", None, 0))
+            continue
+        rule = policy.rules[chosen[n]]
+        delta = deltas[rule.lag_ms][n] if rule.type == "trend" else float("nan")
+        msg = rule.msg.format(value=values[n], delta=delta) if rule.msg else None
+        batch.results.append((
+            run_id, rule.reversible, f"{rule.rule_id}: {rule.explain or rule.action}",
+            rule.action, msg, rule.notify,
+        ))
+    return batch
+
+
+def write(conn: sqlite3.Connection, batch: DecisionBatch) -> int:
+    """
+    write half, inside the caller's transaction; re-writing is a no-op
+    """
+    conn.executemany(
+        """
+        INSERT OR IGNORE INTO decision_run
+        (decision_run_id, metric_value_id, computed_at, policy_version)
+        values(?,?,?,?)
+        """,
+        batch.runs,
+    )
+    conn.executemany(
+        """
+        INSERT OR IGNORE INTO decision_result
+        (decision_run_id, reversible, explain, action, msg, notify)
+        values(?,?,?,?,?,?)
+        """,
+        batch.results,
+    )
+    return len(batch)
+
+
+def chunks(conn: sqlite3.Connection, chunk_rows: int) -> list[tuple[int, int]]:
+    """
+    (lo, hi] rowid ranges covering metric_value, for parallel evaluation
+    """
+    lo, hi = rowid_range(conn)
+    return [(start, min(start + chunk_rows, hi)) for start in range(lo - 1, hi, chunk_rows)]
+
+
+def run(conn: sqlite3.Connection, policy_version: str, chunk_rows: int = 20000) -> int:
+    """
+    evaluate and write chunk by chunk on one connection (CLI / scripts),
+    committing after every chunk so live writers are never held up long
+    """
+    policy = load_policy(policy_version)
+    total = 0
+    for lo, hi in chunks(conn, chunk_rows):
+        batch = evaluate(conn, policy, lo, hi)
+        if len(batch):
+            with conn:
+                total += write(conn, batch)
+    return total
+
+
+def main(argv=None):
+    from . import db
+
+    argv = sys.argv[1:] if argv is None else argv
+    version = argv[0] if argv else config.POLICY_VERSION
+    conn = db.connect()
+    try:
+        n = run(conn, version)
+        print(f"decision engine ({version}): {n} decisions written")
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
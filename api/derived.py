@@ -0,0 +1,87 @@
+"""
+Refresh of every table derived from observations.
+
+Triggers only mark what changed; refresh() brings the derived tables up
+to date inside the caller's transaction and marks the changed days for
+the metric engine in metric_dirty. The group-commit writer runs it
+before each COMMIT, and anything that writes observations outside the
+writer (merge, import, migrations) should call it before committing too.
+set_timezone() re-buckets a device's derived state after its local day
+boundaries move.
+"""
+import sqlite3
+from zoneinfo import ZoneInfo
+
+from . import archive, fused, rollups, sleep, steps
+
+# derived tables of archived months are frozen (api/archive.py): their
+# events are gone, so recomputing them would only lose data
+FROZEN_SQL = "DELETE FROM fused_minute_dirty WHERE " + archive.ARCHIVED_SQL.format(
+    table="fused_minute_dirty", ms="fused_minute_dirty.minute_bucket * 60000"
+)
+
+
+# the UTC days of changed minutes, for the metric engine (api/metrics.py)
+METRIC_DIRTY_SQL = "INSERT INTO metric_dirty(device_id, day_ms) values(?, ?)"
+
+DAY_MINUTES = 1440
+DAY_MS = DAY_MINUTES * 60_000
+
+
+def refresh(conn: sqlite3.Connection) -> list[tuple]:
+    """
+    returns the (device_id, minute_bucket) keys that were refreshed
+    """
+    conn.execute(FROZEN_SQL)
+    keys = fused.refresh_dirty(conn)
+    if keys:
+        # a counter sample also changes the delta of the one after it
+        changed = keys + steps.refresh(conn, keys)
+        rollups.refresh(conn, changed)
+        sleep.refresh(conn, keys)
+        conn.executemany(METRIC_DIRTY_SQL, sorted({
+            (device_id, minute // DAY_MINUTES * DAY_MINUTES * 60_000) for device_id, minute in changed
+        }))
+    return keys
+
+
+def rebuild(conn: sqlite3.Connection):
+    fused.rebuild(conn)
+    steps.rebuild(conn)
+    rollups.rebuild(conn)
+    sleep.rebuild(conn)
+
+
+def set_timezone(conn: sqlite3.Connection, device_id: str, tz_name: str) -> int:
+    """
+    move device_id to tz_name and re-bucket what follows its local days:
+    the rollups and reports now, and every written metric window through
+    metric_dirty, so the next metric run replaces the windows of the old
+    offset (their decisions and evidence go with them). Returns the rollup
+    buckets.
+    """
+    # reports imports metrics, which imports identity, which imports derived
+    from . import reports
+
+    ZoneInfo(tz_name)  # raises for unknown zones
+    conn.execute(
+        """
+        INSERT INTO device_settings(device_id, timezone) VALUES (?, ?)
+        ON CONFLICT(device_id) DO UPDATE SET timezone = excluded.timezone
+        """,
+        (device_id, tz_name),
+    )
+    n = rollups.rebuild(conn, device_id)
+    first, last = conn.execute(
+        "SELECT MIN(window_start_ms), MAX(window_end_ms) FROM metric_value WHERE device_id = ?",
+        (device_id,),
+    ).fetchone()
+    if first is not None:
+        conn.executemany(METRIC_DIRTY_SQL, [
+            (device_id, day_ms) for day_ms in range(first // DAY_MS * DAY_MS, last, DAY_MS)
+        ])
+    # day partials and periods of the old zone must not mix with the new ones
+    conn.execute("DELETE FROM report_day WHERE device_id = ?", (device_id,))
+    conn.execute("DELETE FROM report WHERE device_id = ?", (device_id,))
+    reports.write(conn, reports.compute(conn, device_id=device_id))
+    return n
@@ -0,0 +1,367 @@
+"""
+Evidence bundles: the structured JSON the LLM layer reads instead of the
+database.
+
+A bundle covers one device, one metric and one window [start_ms, end_ms):
+every metric_value whose window ends in it, with its metric_run
+uncertainty and decision_results, a trend summary, and how many of the
+underlying observations were left out as invalid or superseded. The body
+is canonical JSON (sorted keys, no whitespace) carrying the sha256 of
+everything else as content_hash, so identical contexts hash the same
+whatever computed them.
+
+Two tiers:
+- evidence_bundle, on disk. Triggers (api/schema.py) delete exactly the
+  bundles a write touches: a metric value, run, decision or result in
+  the window, or an observation in its data span becoming invalid or
+  superseded. They also bump evidence_epoch for the device; a bundle is
+  only stored if the epoch it was built under is still current.
+- an in-process LRU of encoded bodies, checked against the stored
+  content_hash on every hit, so a bundle dropped on disk is never served
+  from memory.
+
+A hit costs two primary-key probes. warm() builds the default spans
+(HEALTH_EVIDENCE_WARM_DAYS) ending at each metric's watermark; the
+metric loop runs it after every engine run.
+
+    python -m api.evidence warm
+    python -m api.evidence get <device_id> <metric_id> [--end-ms MS] [--days N]
+"""
+import argparse
+import hashlib
+import json
+import sqlite3
+import sys
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+import numpy as np
+
+from . import config, metrics
+
+
+DAY_MS = 86_400_000
+
+# confidence_score below this counts as low confidence in the trend summary
+LOW_CONFIDENCE = 0.5
+
+VALUES_SQL = """
+SELECT v.metric_value_id, v.window_start_ms, v.window_end_ms,
+    COALESCE(v.value_real, v.value_int), v.value_text,
+    r.confidence_score, r.missing_data_ratio, r.is_imputed, r.logic_version
+FROM metric_value v
+LEFT JOIN metric_run r ON r.metric_value_id = v.metric_value_id
+WHERE v.device_id = ? AND v.metric_id = ?
+    AND v.window_start_ms >= ? AND v.window_start_ms < ?
+    AND v.window_end_ms > ? AND v.window_end_ms <= ?
+ORDER BY v.window_end_ms, v.window_start_ms
+"""
+
+DECISIONS_SQL = """
+SELECT v.window_end_ms, d.policy_version, r.action, r.msg, r.explain, r.notify, r.reversible
+FROM metric_value v
+JOIN decision_run d ON d.metric_value_id = v.metric_value_id
+JOIN decision_result r ON r.decision_run_id = d.decision_run_id
+WHERE v.device_id = ? AND v.metric_id = ?
+    AND v.window_start_ms >= ? AND v.window_start_ms < ?
+    AND v.window_end_ms > ? AND v.window_end_ms <= ?
+    AND r.action IS NOT 'none'
+ORDER BY v.window_end_ms, d.policy_version
+"""
+
+EXCLUDED_SQL = """
+SELECT
+    COALESCE(SUM(is_valid = 0), 0),
+    COALESCE(SUM(is_valid = 1 AND superseded_by IS NOT NULL), 0)
+FROM observation_event
+WHERE device_id = ? AND observed_ms >= ? AND observed_ms < ? AND obs_kind = ?
+    AND (is_valid = 0 OR superseded_by IS NOT NULL)
+"""
+
+STORE_SQL = """
+INSERT OR REPLACE INTO evidence_bundle
+(device_id, metric_id, start_ms, end_ms, data_start_ms, obs_kind, content_hash, body_json, built_at)
+values(?,?,?,?,?,?,?,?,?)
+"""
+
+
+class Bundle:
+    __slots__ = ("key", "data_start_ms", "obs_kind", "epoch", "content_hash", "body", "fresh")
+
+    def __init__(self, key, data_start_ms, obs_kind, epoch, content_hash, body: bytes,
+                 fresh: bool):
+        # (device_id, metric_id, start_ms, end_ms)
+        self.key = key
+        self.data_start_ms = data_start_ms
+        self.obs_kind = obs_kind
+        self.epoch = epoch
+        self.content_hash = content_hash
+        self.body = body
+        # built by this call, not yet in evidence_bundle
+        self.fresh = fresh
+
+
+class LRU:
+    """
+    key -> Bundle, thread-safe; the reader pool calls in from many threads
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self._items: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            bundle = self._items.get(key)
+            if bundle is not None:
+                self._items.move_to_end(key)
+            return bundle
+
+    def put(self, bundle: Bundle):
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._items[bundle.key] = bundle
+            self._items.move_to_end(bundle.key)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+memory = LRU(config.EVIDENCE_CACHE_ENTRIES)
+
+
+def _canonical(obj) -> bytes:
+    return json.dumps(obj, sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode()
+
+
+def _trend(values: list[dict]) -> dict:
+    numeric = [(v["window_end_ms"], v["value"]) for v in values if v["value"] is not None]
+    low = sum(1 for v in values if v["confidence"] is not None and v["confidence"] < LOW_CONFIDENCE)
+    if not numeric:
+        return {"count": 0, "low_confidence": low}
+    t = np.array([ms for ms, _ in numeric], dtype=np.float64) / DAY_MS
+    v = np.array([val for _, val in numeric], dtype=np.float64)
+    slope = None
+    if len(v) >= 2 and np.ptp(t) > 0:
+        slope = round(float(np.polyfit(t - t[-1], v, 1)[0]), 6)
+    return {
+        "count": len(v),
+        "first": round(float(v[0]), 6),
+        "last": round(float(v[-1]), 6),
+        "min": round(float(v.min()), 6),
+        "max": round(float(v.max()), 6),
+        "mean": round(float(v.mean()), 6),
+        "change": round(float(v[-1] - v[0]), 6),
+        "slope_per_day": slope,
+        "low_confidence": low,
+    }
+
+
+def _epoch(conn: sqlite3.Connection, device_id: str) -> int:
+    row = conn.execute("SELECT epoch FROM evidence_epoch WHERE device_id = ?", (device_id,)).fetchone()
+    return row[0] if row else 0
+
+
+def _definition(conn: sqlite3.Connection, metric_id: str):
+    return conn.execute(
+        "SELECT unit, description, watermark FROM metric_def WHERE metric_id = ?", (metric_id,)
+    ).fetchone()
+
+
+def build(conn: sqlite3.Connection, device_id: str, metric_id: str, start_ms: int,
+          end_ms: int, definition=None) -> Bundle | None:
+    """
+    assemble the bundle for [start_ms, end_ms); None for an unknown metric
+    """
+    definition = definition or _definition(conn, metric_id)
+    if definition is None:
+        return None
+    unit, description, _ = definition
+    spec = metrics.REGISTRY.get(metric_id)
+    window_ms = spec.window_ms if spec is not None else 0
+    obs_kind = metrics.SOURCE_KINDS.get(spec.source, "") if spec is not None else ""
+    data_start_ms = start_ms - window_ms
+
+    # read the epoch first: anything committed after it makes the bundle
+    # unstorable, even if the queries below already see it
+    epoch = _epoch(conn, device_id)
+    params = (device_id, metric_id, data_start_ms, end_ms, start_ms, end_ms)
+    values = [
+        {
+            "window_start_ms": ws,
+            "window_end_ms": we,
+            "value": value,
+            "value_text": text,
+            "confidence": confidence,
+            "missing_data_ratio": missing,
+            "is_imputed": bool(imputed) if imputed is not None else None,
+            "logic_version": logic,
+        }
+        for _, ws, we, value, text, confidence, missing, imputed, logic
+        in conn.execute(VALUES_SQL, params)
+    ]
+    decisions = [
+        dict(zip(("window_end_ms", "policy_version", "action", "msg", "explain"), row[:5]),
+             notify=bool(row[5]), reversible=bool(row[6]))
+        for row in conn.execute(DECISIONS_SQL, params)
+    ]
+    invalid, superseded = conn.execute(
+        EXCLUDED_SQL, (device_id, data_start_ms, end_ms, obs_kind)
+    ).fetchone()
+
+    body = {
+        "device_id": device_id,
+        "metric": {
+            "metric_id": metric_id,
+            "unit": unit,
+            "description": description,
+            "window_days": spec.window_days if spec is not None else None,
+        },
+        "window": {"start_ms": start_ms, "end_ms": end_ms},
+        "values": values,
+        "decisions": decisions,
+        "trend": _trend(values),
+        "excluded_observations": {"obs_kind": obs_kind, "invalid": invalid, "superseded": superseded},
+    }
+    content_hash = hashlib.sha256(_canonical(body)).hexdigest()
+    body["content_hash"] = content_hash
+    return Bundle((device_id, metric_id, start_ms, end_ms), data_start_ms, obs_kind, epoch,
+                  content_hash, _canonical(body), fresh=True)
+
+
+def default_end(definition, device_id: str) -> int | None:
+    """
+    end of the last window the metric engine wrote for device_id
+    """
+    marks = metrics.parse_watermark(definition[2])
+    end = marks.get(device_id, marks.get("*"))
+    return int(end) if end else None
+
+
+def get(conn: sqlite3.Connection, device_id: str, metric_id: str, end_ms: int | None = None,
+        days: int = 7) -> Bundle | None:
+    """
+    the bundle for the days before end_ms (default: the metric's
+    watermark), from memory, disk or built; None if the metric is unknown
+    or has no windows yet
+    """
+    definition = _definition(conn, metric_id)
+    if definition is None:
+        return None
+    if end_ms is None:
+        end_ms = default_end(definition, device_id)
+        if end_ms is None:
+            return None
+    key = (device_id, metric_id, end_ms - days * DAY_MS, end_ms)
+
+    row = conn.execute(
+        """
+        SELECT content_hash, body_json, data_start_ms, obs_kind FROM evidence_bundle
+        WHERE device_id = ? AND metric_id = ? AND start_ms = ? AND end_ms = ?
+        """,
+        key,
+    ).fetchone()
+    if row is not None:
+        cached = memory.get(key)
+        if cached is not None and cached.content_hash == row[0]:
+            return cached
+        bundle = Bundle(key, row[2], row[3], None, row[0], row[1].encode(), fresh=False)
+    else:
+        bundle = build(conn, device_id, metric_id, key[2], key[3], definition)
+    memory.put(bundle)
+    return bundle
+
+
+def store(conn: sqlite3.Connection, bundles: list[Bundle]) -> int:
+    """
+    write freshly built bundles, inside the caller's transaction, skipping
+    any whose device saw an invalidating write since it was built
+    """
+    built_at = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    rows = []
+    epochs = {}
+    for b in bundles:
+        device_id = b.key[0]
+        if device_id not in epochs:
+            epochs[device_id] = _epoch(conn, device_id)
+        if b.fresh and b.epoch == epochs[device_id]:
+            rows.append((*b.key, b.data_start_ms, b.obs_kind, b.content_hash,
+                         b.body.decode(), built_at))
+    conn.executemany(STORE_SQL, rows)
+    for b in bundles:
+        b.fresh = False
+    return len(rows)
+
+
+def warm(conn: sqlite3.Connection, spans_days=None) -> list[Bundle]:
+    """
+    build the bundles for the default spans that are not on disk yet
+    """
+    spans_days = config.EVIDENCE_WARM_DAYS if spans_days is None else spans_days
+    out = []
+    for metric_id, unit, description, watermark in conn.execute(
+        "SELECT metric_id, unit, description, watermark FROM metric_def"
+    ).fetchall():
+        definition = (unit, description, watermark)
+        for device_id, end_ms in metrics.parse_watermark(watermark).items():
+            if device_id == "*":
+                continue
+            for days in spans_days:
+                key = (device_id, metric_id, int(end_ms) - days * DAY_MS, int(end_ms))
+                if conn.execute(
+                    """
+                    SELECT 1 FROM evidence_bundle
+                    WHERE device_id = ? AND metric_id = ? AND start_ms = ? AND end_ms = ?
+                    """,
+                    key,
+                ).fetchone():
+                    continue
+                out.append(build(conn, *key, definition))
+    return out
+
+
+def main(argv=None):
+    from . import db
+
+    parser = argparse.ArgumentParser(prog="python -m api.evidence")
+    parser.add_argument("command", choices=["warm", "get"])
+    parser.add_argument("device_id", nargs="?")
+    parser.add_argument("metric_id", nargs="?")
+    parser.add_argument("--end-ms", type=int, default=None)
+    parser.add_argument("--days", type=int, default=7)
+    args = parser.parse_args(argv)
+
+    conn = db.connect()
+    try:
+        if args.command == "warm":
+            bundles = warm(conn)
+            with conn:
+                n = store(conn, bundles)
+            print(f"evidence: {n} bundles built")
+        else:
+            if not args.device_id or not args.metric_id:
+                parser.error("get needs device_id and metric_id")
+            bundle = get(conn, args.device_id, args.metric_id, args.end_ms, args.days)
+            if bundle is None:
+                print("no such metric, or no windows yet", file=sys.stderr)
+                return 1
+            if bundle.fresh:
+                with conn:
+                    store(conn, [bundle])
+            print(bundle.body.decode())
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,197 @@
+"""
+Explanations of evidence bundles (api/evidence.py) from the local Ollama
+runtime.
+
+The model host runs one inference at a time, so every request goes
+through one ExplainQueue:
+- a request is keyed by (content_hash, model, PROMPT_VERSION);
+  explanation_cache answers repeats without touching the model
+- requests for a key already queued or running wait on that one job
+  instead of adding another
+- jobs wait in a priority queue, interactive (chart taps, widgets) before
+  report; a queued report job asked for interactively is promoted
+- at most HEALTH_EXPLAIN_CONCURRENCY jobs talk to the model at once
+
+The client speaks Ollama's POST /api/generate (non-streaming) with the
+standard library, so any compatible server, including a stub, will do.
+"""
+import asyncio
+import itertools
+import json
+import re
+import sqlite3
+import time
+import urllib.error
+import urllib.request
+from datetime import datetime, timezone
+
+from . import config, db
+
+
+PROMPT_VERSION = "explain-v1"
+
+INTERACTIVE = 0
+REPORT = 1
+PRIORITIES = {"interactive": INTERACTIVE, "report": REPORT}
+
+SYSTEM_PROMPT = (
+    "You explain a person's own health metrics to them. Use only the JSON "
+    "evidence you are given. Say what the values and their trend show and how "
+    "reliable they are (confidence, missing data, excluded observations). "
+    "No medical diagnosis, no prescriptions, no advice beyond what the "
+    "decisions in the evidence say. At most four short sentences."
+)
+
+# qwen3 may still emit its reasoning when asked not to
+THINK_RE = re.compile(r"<think>.*?</think>\s*", re.S)
+
+CACHE_SQL = """
+SELECT text FROM explanation_cache
+WHERE content_hash = ? AND model = ? AND prompt_version = ?
+"""
+
+STORE_SQL = """
+INSERT OR REPLACE INTO explanation_cache
+(content_hash, model, prompt_version, text, duration_ms, created_at)
+values(?,?,?,?,?,?)
+"""
+
+
+class RuntimeUnavailable(Exception):
+    pass
+
+
+def prompt(body: bytes) -> str:
+    return f"Evidence:\n{body.decode()}\n\nExplain this metric for its window."
+
+
+def generate(prompt_text: str, model: str | None = None, url: str | None = None,
+             timeout_s: float | None = None) -> str:
+    """
+    one blocking, non-streaming /api/generate call
+    """
+    request = urllib.request.Request(
+        (url or config.OLLAMA_URL).rstrip("/") + "/api/generate",
+        data=json.dumps({
+            "model": model or config.OLLAMA_MODEL,
+            "system": SYSTEM_PROMPT,
+            "prompt": prompt_text,
+            "stream": False,
+            "think": False,
+            "options": {"temperature": 0},
+        }).encode(),
+        headers={"Content-Type": "application/json"},
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=timeout_s or config.EXPLAIN_TIMEOUT_S) as resp:
+            reply = json.loads(resp.read())
+    except (urllib.error.URLError, TimeoutError, ValueError) as e:
+        raise RuntimeUnavailable(str(e)) from e
+    if "response" not in reply:
+        raise RuntimeUnavailable(reply.get("error", "no response in reply"))
+    return THINK_RE.sub("", reply["response"]).strip()
+
+
+def cached(conn: sqlite3.Connection, content_hash: str, model: str) -> str | None:
+    row = conn.execute(CACHE_SQL, (content_hash, model, PROMPT_VERSION)).fetchone()
+    return row[0] if row else None
+
+
+class _Job:
+    __slots__ = ("key", "body", "priority", "future", "started")
+
+    def __init__(self, key, body: bytes, priority: int):
+        self.key = key
+        self.body = body
+        self.priority = priority
+        self.future = asyncio.get_running_loop().create_future()
+        self.started = False
+
+
+class ExplainQueue:
+    """
+    coalescing priority queue in front of the model; write(fn, rows) is
+    the group-commit writer's run()
+    """
+
+    def __init__(self, write, concurrency: int = 1, model: str | None = None,
+                 generate_fn=generate):
+        self._write = write
+        self.concurrency = max(1, concurrency)
+        self.model = model or config.OLLAMA_MODEL
+        self._generate = generate_fn
+        self._jobs: dict = {}
+        self._seq = itertools.count()
+        self._queue: asyncio.PriorityQueue | None = None
+        self._workers: list[asyncio.Task] = []
+
+    def start(self):
+        if self._workers:
+            return
+        self._queue = asyncio.PriorityQueue()
+        self._workers = [asyncio.create_task(self._work()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        for job in self._jobs.values():
+            if not job.future.done():
+                job.future.set_exception(RuntimeUnavailable("explanation queue stopped"))
+        self._jobs.clear()
+
+    def pending(self) -> int:
+        return sum(1 for job in self._jobs.values() if not job.started)
+
+    async def explain(self, content_hash: str, body: bytes,
+                      priority: int = INTERACTIVE) -> tuple[str, bool]:
+        """
+        (text, from_cache) for the bundle with this content_hash
+        """
+        text = await db.run_read(cached, content_hash, self.model)
+        if text is not None:
+            return text, True
+        if not self._workers:
+            raise RuntimeUnavailable("explanation queue is not running")
+        key = (content_hash, self.model, PROMPT_VERSION)
+        job = self._jobs.get(key)
+        if job is None:
+            job = _Job(key, body, priority)
+            self._jobs[key] = job
+            self._queue.put_nowait((priority, next(self._seq), job))
+        elif priority < job.priority and not job.started:
+            # queue it again ahead; the worker skips whichever copy comes second
+            job.priority = priority
+            self._queue.put_nowait((priority, next(self._seq), job))
+        # shielded: a caller going away must not cancel the shared job
+        return await asyncio.shield(job.future), False
+
+    async def _work(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            _, _, job = await self._queue.get()
+            if job.started:
+                continue
+            job.started = True
+            try:
+                # a job that finished meanwhile may have answered this one
+                text = await db.run_read(cached, *job.key[:2])
+                if text is not None:
+                    job.future.set_result(text)
+                    continue
+                started = time.perf_counter()
+                text = await loop.run_in_executor(None, self._generate, prompt(job.body), self.model)
+                duration_ms = int((time.perf_counter() - started) * 1000)
+                created_at = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+                await self._write(lambda conn: conn.execute(
+                    STORE_SQL, (*job.key, text, duration_ms, created_at)
+                ).rowcount)
+                job.future.set_result(text)
+            except asyncio.CancelledError:
+                job.future.cancel()
+                raise
+            except Exception as e:
+                job.future.set_exception(e)
+            finally:
+                self._jobs.pop(job.key, None)
@@ -0,0 +1,191 @@
+"""
+Incremental maintenance of the fused_minute table.
+
+Triggers on event / event_weight / event_steps record every
+(device_id, minute_bucket) they touch in fused_minute_dirty.
+refresh_dirty() recomputes just those buckets inside the caller's
+transaction; derived.refresh() calls it, ahead of the tables built on
+fused_minute, before every COMMIT.
+
+    python -m api.fused rebuild   # recompute the whole table from the view
+    python -m api.fused check     # diff the table against fused_minute_view
+"""
+import sqlite3
+import sys
+
+from . import archive
+
+
+# same shape as fused_minute_view, but base only covers the dirty buckets
+# and is found through idx_event_device_ms
+RECOMPUTE_SQL = """
+INSERT INTO fused_minute
+(device_id, minute_bucket, minute_start_utc, body_mass_01, steps_delta_sum, step_cum_last)
+WITH base AS (
+    SELECT
+        e.device_id,
+        d.minute_bucket,
+        e.observed_ms,
+        e.event_key,
+        e.obs_kind
+    FROM fused_minute_dirty d
+    -- CROSS JOIN pins the loop order: walking the dirty set and probing
+    -- the index stays proportional to the dirty set, while the planner's
+    -- own pick (scan every event) does not
+    CROSS JOIN observation_event e
+        ON e.device_id = d.device_id
+        AND e.observed_ms >= d.minute_bucket * 60000
+        AND e.observed_ms < (d.minute_bucket + 1) * 60000
+    WHERE e.is_valid = 1 AND e.superseded_by IS NULL
+),
+weight_ranked AS (
+    SELECT
+        b.device_id,
+        b.minute_bucket,
+        ow.body_mass_01,
+        ROW_NUMBER() OVER (
+            PARTITION BY b.device_id, b.minute_bucket
+            ORDER BY b.observed_ms DESC
+        ) AS rn
+    FROM base b
+    JOIN event_weight ow ON ow.event_key = b.event_key
+    WHERE b.obs_kind = 'weight'
+),
+weight_final AS (
+    SELECT device_id, minute_bucket, body_mass_01
+    FROM weight_ranked
+    WHERE rn = 1
+),
+steps_agg AS (
+    SELECT
+        b.device_id,
+        b.minute_bucket,
+        SUM(CASE WHEN os.step_mode='delta' THEN os.step_value ELSE 0 END) AS steps_delta_sum,
+        MAX(CASE WHEN os.step_mode='cumulative' THEN os.step_value ELSE NULL END) AS step_cum_last
+    FROM base b
+    JOIN event_steps os ON os.event_key = b.event_key
+    WHERE b.obs_kind = 'steps'
+    GROUP BY b.device_id, b.minute_bucket
+)
+SELECT
+    x.device_id,
+    x.minute_bucket,
+    datetime(x.minute_bucket * 60, 'unixepoch') AS minute_start_utc,
+    wf.body_mass_01,
+    COALESCE(sa.steps_delta_sum, 0) AS steps_delta_sum,
+    sa.step_cum_last
+FROM (SELECT DISTINCT device_id, minute_bucket FROM base) x
+LEFT JOIN weight_final wf
+    ON wf.device_id = x.device_id AND wf.minute_bucket = x.minute_bucket
+LEFT JOIN steps_agg sa
+    ON sa.device_id = x.device_id AND sa.minute_bucket = x.minute_bucket
+"""
+
+COLUMNS = "device_id, minute_bucket, minute_start_utc, body_mass_01, steps_delta_sum, step_cum_last"
+
+
+def _live(table: str) -> str:
+    """
+    rows of table outside archived months; the archived ones stay as they
+    were, since their events are gone (api/archive.py)
+    """
+    return "NOT " + archive.ARCHIVED_SQL.format(table=table, ms=f"{table}.minute_bucket * 60000")
+
+
+def drop_legacy_view(conn: sqlite3.Connection) -> bool:
+    """
+    older databases have fused_minute as a VIEW; drop it so the table can
+    take the name. Returns True when the table needs a full rebuild.
+    """
+    row = conn.execute(
+        "SELECT type FROM sqlite_master WHERE name = 'fused_minute'"
+    ).fetchone()
+    if row is None:
+        return True
+    if row[0] == "view":
+        conn.execute("DROP VIEW fused_minute")
+        return True
+    return False
+
+
+def refresh_dirty(conn: sqlite3.Connection) -> list[tuple]:
+    """
+    recompute the dirty buckets and clear the dirty set.
+    Returns the (device_id, minute_bucket) pairs that were refreshed.
+    """
+    keys = conn.execute(
+        "SELECT device_id, minute_bucket FROM fused_minute_dirty"
+    ).fetchall()
+    if not keys:
+        return []
+    conn.execute(
+        """
+        DELETE FROM fused_minute
+        WHERE (device_id, minute_bucket) IN
+            (SELECT device_id, minute_bucket FROM fused_minute_dirty)
+        """
+    )
+    conn.execute(RECOMPUTE_SQL)
+    conn.execute("DELETE FROM fused_minute_dirty")
+    return keys
+
+
+def rebuild(conn: sqlite3.Connection) -> int:
+    conn.execute(f"DELETE FROM fused_minute WHERE {_live('fused_minute')}")
+    conn.execute(
+        f"INSERT INTO fused_minute ({COLUMNS}) SELECT {COLUMNS} FROM fused_minute_view v WHERE {_live('v')}"
+    )
+    conn.execute("DELETE FROM fused_minute_dirty")
+    return conn.execute("SELECT COUNT(*) FROM fused_minute").fetchone()[0]
+
+
+def check(conn: sqlite3.Connection, limit: int = 100) -> list[tuple]:
+    """
+    rows where the table and the view disagree, tagged 'missing' (in the
+    view only) or 'stale' (in the table only); archived months are left
+    out, the view no longer sees their events
+    """
+    view = f"SELECT {COLUMNS} FROM fused_minute_view v WHERE {_live('v')}"
+    table = f"SELECT {COLUMNS} FROM fused_minute WHERE {_live('fused_minute')}"
+    return conn.execute(
+        f"""
+        SELECT 'missing', * FROM ({view} EXCEPT {table})
+        UNION ALL
+        SELECT 'stale', * FROM ({table} EXCEPT {view})
+        LIMIT ?
+        """,
+        (limit,),
+    ).fetchall()
+
+
+def main(argv=None):
+    from . import db, derived
+
+    argv = sys.argv[1:] if argv is None else argv
+    command = argv[0] if argv else "check"
+    conn = db.connect()
+    try:
+        if command == "rebuild":
+            with conn:
+                n = rebuild(conn)
+            print(f"fused_minute rebuilt: {n} rows")
+        elif command == "check":
+            # the whole chain: clearing the dirty set alone would leave
+            # steps, rollups and sleep behind with nothing left to redo them
+            with conn:
+                derived.refresh(conn)
+            diff = check(conn)
+            for row in diff:
+                print(*row, sep="\t")
+            print(f"fused_minute check: {len(diff)} mismatching rows")
+            return 1 if diff else 0
+        else:
+            print("usage: python -m api.fused [rebuild|check]")
+            return 2
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
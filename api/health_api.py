@@ -1,212 +1,79 @@
 import sqlite3
-from fastapi import FastAPI,HTTPException
-from pydantic import BaseModel
+import asyncio
+import codecs
+import json
+from fastapi import FastAPI,HTTPException,Request
+from fastapi.responses import PlainTextResponse, Response
+from pydantic import BaseModel, ValidationError
 from typing import Optional
 import os
 import uuid
 from .toy_data import router as test_router
+from . import (config, corrections, db, decisions, derived, evidence, explain, fused, identity, ingest,
+               instrument, metrics, migrations, query, reports, rollups, sleep, steps)
+from .writer import GroupCommitWriter
 
 app = FastAPI()
 
+if config.INSTRUMENT:
+    app.add_middleware(instrument.Middleware)
+
 
 
 # print("CWD =", os.getcwd())
 
-DB_PATH = "/home/kris/healthass/store/health.db"
+DB_PATH = config.DB_PATH
 
 def get_conn() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH, timeout=30)
-    conn.execute("PRAGMA foreign_keys = ON;")    
-    return conn
+    return db.connect()
+
+# every insert goes through this one connection, group-committed
+writer = GroupCommitWriter(
+    get_conn,
+    batch_ms=config.WRITER_BATCH_MS,
+    batch_rows=config.WRITER_BATCH_ROWS,
+    before_commit=derived.refresh,
+)
 
-app.include_router(test_router)
+instrument.gauge("health_writer_queue_depth", "write jobs waiting for a batch", writer.pending)
 
+# one queue in front of the model host
+explainer = explain.ExplainQueue(writer.run, config.EXPLAIN_CONCURRENCY)
+instrument.gauge("health_explain_queue_depth", "explanations waiting for the model", explainer.pending)
+instrument.gauge("health_db_size_bytes", "database file size", lambda: os.path.getsize(DB_PATH))
+instrument.gauge("health_db_wal_size_bytes", "WAL file size", lambda: os.path.getsize(DB_PATH + "-wal"))
+
+app.include_router(test_router)
+app.include_router(query.router)
 
-SCHEMA_SQL = """
--- Core tables
-CREATE TABLE IF NOT EXISTS observation_event (
-    event_id TEXT PRIMARY KEY,
-    device_id TEXT NOT NULL,
-    observed_at TEXT NOT NULL,
-    observed_ms INTEGER NOT NULL,
-    obs_kind TEXT NOT NULL,           -- 'weight' | 'steps' | 'sleep_state'
-    is_valid INTEGER NOT NULL DEFAULT 1,
-    superseded_by TEXT DEFAULT NULL,
-    note TEXT DEFAULT NULL,
-    CHECK (is_valid IN (0, 1))
-);
-
-CREATE INDEX IF NOT EXISTS idx_event_device_time
-    ON observation_event(device_id, observed_ms);
-
-CREATE INDEX IF NOT EXISTS idx_event_kind_time
-    ON observation_event(obs_kind, observed_ms);
-
-CREATE INDEX IF NOT EXISTS idx_event_superseded
-    ON observation_event(device_id, superseded_by);
-
-CREATE TABLE IF NOT EXISTS observation_provenance (
-    event_id TEXT PRIMARY KEY,
-    source_kind TEXT NOT NULL DEFAULT 'unknown',
-    app_version TEXT DEFAULT NULL,
-    ingested_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ', 'now')),
-    provenance_json TEXT DEFAULT NULL,
-    FOREIGN KEY (event_id) REFERENCES observation_event(event_id) ON DELETE CASCADE
-);
-
--- Payload tables
-CREATE TABLE IF NOT EXISTS obs_steps (
-    event_id TEXT PRIMARY KEY,
-    step_value INTEGER NOT NULL,
-    step_mode TEXT NOT NULL, -- 'delta'|'cumulative'|'device_total'
-    CHECK (step_value >= 0),
-    CHECK (step_mode IN ('delta', 'cumulative', 'device_total')),
-    FOREIGN KEY (event_id) REFERENCES observation_event(event_id) ON DELETE CASCADE
-);
-
-CREATE TABLE IF NOT EXISTS obs_weight (
-    event_id TEXT PRIMARY KEY,
-    body_mass_kg REAL NOT NULL,
-    body_mass_01 REAL GENERATED ALWAYS AS (round(body_mass_kg, 1)) VIRTUAL,
-    CHECK (body_mass_kg > 0),
-    FOREIGN KEY (event_id) REFERENCES observation_event(event_id) ON DELETE CASCADE
-);
-
-CREATE TABLE IF NOT EXISTS obs_sleep_state (
-    event_id TEXT PRIMARY KEY,
-    state TEXT NOT NULL,
-    CHECK(state <> ''),
-    FOREIGN KEY (event_id) REFERENCES observation_event(event_id) ON DELETE CASCADE
-);
-
--- Metrics
-CREATE TABLE IF NOT EXISTS metric_def (
-    metric_id TEXT PRIMARY KEY,
-    metric_name TEXT NOT NULL UNIQUE,
-    watermark TEXT NOT NULL,
-    unit TEXT DEFAULT NULL,
-    description TEXT DEFAULT NULL
-);
-
-CREATE TABLE IF NOT EXISTS metric_value (
-    metric_value_id TEXT PRIMARY KEY,
-    metric_id TEXT NOT NULL,
-    device_id TEXT NOT NULL,
-    window_start_ms INTEGER NOT NULL,
-    window_end_ms INTEGER NOT NULL,
-    computed_at TEXT NOT NULL,
-    value_real REAL DEFAULT NULL,
-    value_int INTEGER DEFAULT NULL,
-    value_text TEXT DEFAULT NULL,
-    CHECK (window_end_ms > window_start_ms),
-    FOREIGN KEY (metric_id) REFERENCES metric_def(metric_id)
-);
-
-CREATE INDEX IF NOT EXISTS idx_metric_value_device_window
-    ON metric_value(device_id, window_start_ms, window_end_ms);
-
-CREATE TABLE IF NOT EXISTS metric_run (
-    metric_value_id TEXT PRIMARY KEY,
-    confidence_score REAL NOT NULL,
-    missing_data_ratio REAL NOT NULL,
-    is_imputed INTEGER NOT NULL DEFAULT 0,
-    logic_version TEXT DEFAULT NULL,
-    details_json TEXT DEFAULT NULL,
-    CHECK (confidence_score >= 0 AND confidence_score <= 1),
-    CHECK (missing_data_ratio >= 0 AND missing_data_ratio <= 1),
-    CHECK (is_imputed IN (0, 1)),
-    FOREIGN KEY (metric_value_id) REFERENCES metric_value(metric_value_id) ON DELETE CASCADE
-);
-
--- Decisions
-CREATE TABLE IF NOT EXISTS decision_run (
-    decision_run_id TEXT PRIMARY KEY,
-    metric_value_id TEXT NOT NULL,
-    computed_at TEXT NOT NULL,
-    policy_version TEXT DEFAULT NULL,
-    FOREIGN KEY (metric_value_id) REFERENCES metric_value(metric_value_id) ON DELETE CASCADE
-);
-
-CREATE TABLE IF NOT EXISTS decision_result (
-    decision_run_id TEXT PRIMARY KEY,
-    reversible INTEGER NOT NULL DEFAULT 1,
-    explain TEXT DEFAULT NULL,
-    action TEXT DEFAULT NULL,
-    msg TEXT DEFAULT NULL,
-    notify INTEGER NOT NULL DEFAULT 0,
-    CHECK (reversible IN (0, 1)),
-    CHECK (notify IN (0, 1)),
-    FOREIGN KEY (decision_run_id) REFERENCES decision_run(decision_run_id) ON DELETE CASCADE
-);
-
--- Fused view (minute alignment)
-CREATE VIEW IF NOT EXISTS fused_minute AS
-WITH base AS (
-    SELECT
-        device_id,
-        CAST(observed_ms / 60000 AS INTEGER) AS minute_bucket,
-        observed_ms,
-        event_id,
-        obs_kind
-    FROM observation_event
-    WHERE is_valid = 1 AND superseded_by IS NULL
-),
-weight_ranked AS (
-    SELECT
-        b.device_id,
-        b.minute_bucket,
-        ow.body_mass_01,
-        ROW_NUMBER() OVER (
-            PARTITION BY b.device_id, b.minute_bucket
-            ORDER BY b.observed_ms DESC
-        ) AS rn
-    FROM base b
-    JOIN obs_weight ow ON ow.event_id = b.event_id
-    WHERE b.obs_kind = 'weight'
-),
-weight_final AS (
-    SELECT device_id, minute_bucket, body_mass_01
-    FROM weight_ranked
-    WHERE rn = 1
-),
-steps_agg AS (
-    SELECT
-        b.device_id,
-        b.minute_bucket,
-        SUM(CASE WHEN os.step_mode='delta' THEN os.step_value ELSE 0 END) AS steps_delta_sum,
-        MAX(CASE WHEN os.step_mode='cumulative' THEN os.step_value ELSE NULL END) AS step_cum_last
-    FROM base b
-    JOIN obs_steps os ON os.event_id = b.event_id
-    WHERE b.obs_kind = 'steps'
-    GROUP BY b.device_id, b.minute_bucket
-)
-SELECT
-    x.device_id,
-    x.minute_bucket,
-    datetime(x.minute_bucket * 60, 'unixepoch') AS minute_start_utc,
-    wf.body_mass_01,
-    COALESCE(sa.steps_delta_sum, 0) AS steps_delta_sum,
-    sa.step_cum_last
-FROM (SELECT DISTINCT device_id, minute_bucket FROM base) x
-LEFT JOIN weight_final wf
-    ON wf.device_id = x.device_id AND wf.minute_bucket = x.minute_bucket
-LEFT JOIN steps_agg sa
-    ON sa.device_id = x.device_id AND sa.minute_bucket = x.minute_bucket;
-"""
 
 def init_db():
-    conn = sqlite3.connect(DB_PATH, timeout=30)
+    conn = get_conn()
     try:
-        # # connection-level pragmas
-        # conn.execute("PRAGMA foreign_keys = ON;")
-        # conn.execute("PRAGMA journal_mode = WAL;")
-        # conn.execute("PRAGMA synchronous = NORMAL;")
-        # conn.execute("PRAGMA busy_timeout = 5000;")
-
-        # run schema
-        # cur = conn.cursor()
-        # cur.execute(SCHEMA_SQL)
-        conn.executescript(SCHEMA_SQL)
+        needs_rebuild = fused.drop_legacy_view(conn)
+        for version in migrations.migrate(conn):
+            print(f"schema migration {version} applied")
+        if needs_rebuild:
+            with conn:
+                derived.rebuild(conn)
+        elif conn.execute(
+            "SELECT EXISTS (SELECT 1 FROM event_steps) AND NOT EXISTS (SELECT 1 FROM steps_normalized)"
+        ).fetchone()[0]:
+            # rollups sum normalized steps, so they follow
+            with conn:
+                steps.rebuild(conn)
+                rollups.rebuild(conn)
+        elif conn.execute("SELECT NOT EXISTS (SELECT 1 FROM rollup)").fetchone()[0]:
+            with conn:
+                rollups.rebuild(conn)
+        if not needs_rebuild and conn.execute(
+            "SELECT EXISTS (SELECT 1 FROM event_sleep_state) AND NOT EXISTS (SELECT 1 FROM sleep_session)"
+        ).fetchone()[0]:
+            with conn:
+                sleep.rebuild(conn)
+        if identity.pending(conn):
+            hashed, superseded = identity.backfill(conn)
+            print(f"identity backfill: {hashed} hashed, {superseded} duplicates superseded")
         # optional: verify
         jm = conn.execute("PRAGMA journal_mode;").fetchone()[0]
         fk = conn.execute("PRAGMA foreign_keys;").fetchone()[0]
@@ -292,56 +159,474 @@ class DecisionResultIn(BaseModel):
     notify: bool
 
 
+class DeviceSettingsIn(BaseModel):
+    device_id: str
+    timezone: str
+
+
+class BulkObservationIn(BaseModel):
+    event: ObservationEventIn
+    weight: Optional[ObsWeightIn] = None
+    steps: Optional[ObsStepsIn] = None
+    sleep_state: Optional[ObsSleepIn] = None
+    provenance: Optional[ObservationProvenanceIn] = None
+
+
+class CorrectionIn(BaseModel):
+    action: str
+    # either event_ids, or device_id + [start_ms, end_ms) (+ obs_kind)
+    event_ids: Optional[list[str]] = None
+    device_id: Optional[str] = None
+    obs_kind: Optional[str] = None
+    start_ms: Optional[int] = None
+    end_ms: Optional[int] = None
+    superseded_by: Optional[str] = None
+    note: Optional[str] = None
+
+
+BULK_CHUNK_SIZE = 500
+
+# obs_kind -> the one payload field a combined record must carry
+BULK_PAYLOAD_FIELD = {
+    "weight": "weight",
+    "steps": "steps",
+    "sleep_state": "sleep_state",
+}
+
+
+def parse_bulk_record(raw) -> BulkObservationIn:
+    """
+    validate one combined record; payload/provenance may omit event_id
+    """
+    if isinstance(raw, (bytes, str)):
+        raw = json.loads(raw)
+    if not isinstance(raw, dict) or not isinstance(raw.get("event"), dict):
+        raise ValueError("record must be an object with an 'event' object")
+
+    event_id = raw["event"].get("event_id")
+    for key in ("weight", "steps", "sleep_state", "provenance"):
+        if isinstance(raw.get(key), dict):
+            raw[key].setdefault("event_id", event_id)
+
+    record = BulkObservationIn(**raw)
+    for key in ("weight", "steps", "sleep_state", "provenance"):
+        part = getattr(record, key)
+        if part is not None and part.event_id != record.event.event_id:
+            raise ValueError(f"{key}.event_id does not match event.event_id")
+
+    expected = BULK_PAYLOAD_FIELD.get(record.event.obs_kind)
+    for key in BULK_PAYLOAD_FIELD.values():
+        if key != expected and getattr(record, key) is not None:
+            raise ValueError(f"{key} payload not allowed for obs_kind '{record.event.obs_kind}'")
+    return record
+
+
+class ArrayItems:
+    """
+    items of a JSON array body fed chunk by chunk; raw_decode starts after
+    the last complete item, so only the item in progress is buffered
+    """
+    def __init__(self):
+        self.decoder = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder("utf-8")()
+        self.text = ""
+        # expecting: "[" -> first item or "]" -> "," or "]" -> item -> ...
+        self.expect = "["
+
+    def feed(self, chunk: bytes, final: bool = False) -> list:
+        text = self.text + self.utf8.decode(chunk, final)
+        items = []
+        pos = 0
+        while True:
+            while pos < len(text) and text[pos] in " \t\n\r":
+                pos += 1
+            if pos == len(text):
+                break
+            if self.expect == "[":
+                if text[pos] != "[":
+                    raise json.JSONDecodeError("Expecting '['", text, pos)
+                self.expect = "first"
+                pos += 1
+            elif self.expect == "first" and text[pos] == "]":
+                self.expect = "end"
+                pos += 1
+            elif self.expect in ("first", "item"):
+                try:
+                    item, stop = self.decoder.raw_decode(text, pos)
+                except json.JSONDecodeError:
+                    if final:
+                        raise
+                    break
+                if not final and (stop == len(text) or text[stop] not in " \t\n\r,]"):
+                    # a number cut short ("2." of "2.5") may go on in the next chunk
+                    break
+                items.append(item)
+                self.expect = ","
+                pos = stop
+            elif self.expect == ",":
+                if text[pos] not in ",]":
+                    raise json.JSONDecodeError("Expecting ',' delimiter", text, pos)
+                self.expect = "item" if text[pos] == "," else "end"
+                pos += 1
+            else:
+                raise json.JSONDecodeError("Extra data", text, pos)
+        self.text = text[pos:]
+        if final and self.expect != "end":
+            raise json.JSONDecodeError("Unterminated array", text, len(text))
+        return items
+
+
+async def iter_bulk_body(request: Request):
+    """
+    yield raw records from an NDJSON stream, or the items of a JSON array
+    body as its chunks arrive
+    """
+    buffer = b""
+    array_mode = None
+    array = ArrayItems()
+    async for chunk in request.stream():
+        if array_mode:
+            for item in array.feed(chunk):
+                yield item
+            continue
+        buffer += chunk
+        if array_mode is None:
+            head = buffer.lstrip()
+            if not head:
+                continue
+            array_mode = head[:1] == b"["
+            if array_mode:
+                for item in array.feed(buffer):
+                    yield item
+                continue
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield line
+
+    if array_mode:
+        for item in array.feed(b"", final=True):
+            yield item
+    elif buffer.strip():
+        yield buffer
+
+
+# set after ingest to run the metric engine without waiting for the timer
+metric_trigger = asyncio.Event()
+
+
+async def run_metric_engine() -> int:
+    batch = await db.run_read(metrics.compute)
+    # marks of late data are cleared even when nothing changed
+    if len(batch) or batch.dirty_id is not None:
+        await writer.run(lambda conn: metrics.write(conn, batch), rows=len(batch))
+    return len(batch)
+
+
+async def run_decision_engine(policy_version: str, chunk_rows: int = 5000) -> int:
+    """
+    evaluate rowid chunks of metric_value in parallel on the reader pool;
+    each chunk is its own writer job, so live ingest keeps flowing
+    """
+    policy = decisions.load_policy(policy_version)
+    ranges = await db.run_read(decisions.chunks, chunk_rows)
+
+    async def one(lo, hi):
+        batch = await db.run_read(decisions.evaluate, policy, lo, hi)
+        if len(batch):
+            await writer.run(lambda conn: decisions.write(conn, batch), rows=len(batch))
+        return len(batch)
+
+    done = await asyncio.gather(*(one(lo, hi) for lo, hi in ranges))
+    return sum(done)
+
+
+async def run_evidence_warm() -> int:
+    bundles = await db.run_read(evidence.warm)
+    if not bundles:
+        return 0
+    return await writer.run(lambda conn: evidence.store(conn, bundles), rows=len(bundles))
+
+
+async def run_reports() -> int:
+    batch = await db.run_read(reports.compute)
+    if batch.marks is None and not len(batch):
+        return 0
+    return await writer.run(lambda conn: reports.write(conn, batch), rows=max(1, len(batch)))
+
+
+async def metric_loop():
+    while True:
+        try:
+            await asyncio.wait_for(metric_trigger.wait(), config.METRIC_INTERVAL_S or None)
+        except asyncio.TimeoutError:
+            pass
+        metric_trigger.clear()
+        try:
+            await run_metric_engine()
+            await run_decision_engine(config.POLICY_VERSION)
+            await run_evidence_warm()
+            await run_reports()
+        except Exception as e:
+            print(f"metric engine failed: {e}")
+
+
 @app.on_event("startup")
-def on_startup():
+async def on_startup():
     init_db()
+    writer.start()
+    explainer.start()
+    app.state.metric_task = asyncio.create_task(metric_loop())
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    app.state.metric_task.cancel()
+    await explainer.stop()
+    writer.stop()
+    db.shutdown()
+
+
+@app.post("/decision_engine/run")
+async def trigger_decision_engine(policy_version: Optional[str] = None, chunk_rows: int = 5000):
+    version = policy_version or config.POLICY_VERSION
+    try:
+        n = await run_decision_engine(version, max(1, chunk_rows))
+        return {"status": "ok", "Policy Version": version, "Decisions": n}
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail=f"Unknown policy_version: {version}")
+    except (ValueError, KeyError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid policy {version}: {e}")
+    except sqlite3.OperationalError as e:
+        raise HTTPException(status_code=500, detail=f"DB error: {e}")
+
+
+@app.post("/metric_engine/run")
+async def trigger_metric_engine():
+    try:
+        n = await run_metric_engine()
+        return {"status": "ok", "Metric Values": n}
+    except sqlite3.OperationalError as e:
+        raise HTTPException(status_code=500, detail=f"DB error: {e}")
 
 @app.post("/observation_event")
 async def add_observation(entry:ObservationEventIn):
     try:
-        with get_conn() as conn:
-            conn.execute(
-                """
-                INSERT INTO observation_event
-                (event_id,device_id ,observed_at,observed_ms,obs_kind 
-                ,is_valid,superseded_by ,note) values
-                (?,?,?,?,?,?,?,?)
-                """,
-                (entry.event_id,
-                entry.device_id, 
-                entry.observed_at,
-                entry.observed_ms, 
-                entry.obs_kind, 
-                int(entry.is_valid),
-                entry.superseded_by, 
-                entry.note)
-            )
+        await writer.execute(
+            """
+            INSERT INTO observation_event
+            (event_id,device_id ,observed_at,observed_ms,obs_kind 
+            ,is_valid,superseded_by ,note) values
+            (?,?,?,?,?,?,?,?)
+            """,
+            (entry.event_id,
+            entry.device_id, 
+            entry.observed_at,
+            entry.observed_ms, 
+            entry.obs_kind, 
+            int(entry.is_valid),
+            entry.superseded_by, 
+            entry.note)
+        )
             
         return{"status": "ok", "Event Id": entry.event_id}
     except sqlite3.IntegrityError as e:
             raise HTTPException(status_code=400, detail=str(e))
     except sqlite3.OperationalError as e:
             raise HTTPException(status_code=500, detail=f"DB error: {e}")
-    finally:
-            conn.close()
     
 
+@app.post("/observations/bulk")
+async def add_observations_bulk(request: Request):
+    results = []
+    accepted = 0
+
+    async def flush(chunk):
+        nonlocal accepted
+        if not chunk:
+            return
+        records = [record.model_dump() for _, record in chunk]
+        outcomes = await writer.run(
+            lambda conn: ingest.insert_observations(conn, records),
+            rows=len(records),
+        )
+        for (index, record), (status, detail) in zip(chunk, outcomes):
+            result = {"index": index, "event_id": record.event.event_id, "status": status}
+            if status == "ok":
+                accepted += 1
+            elif status == "duplicate":
+                result["duplicate_of"] = detail
+            else:
+                result["detail"] = detail
+            results.append(result)
+
+    chunk = []
+    index = 0
+    try:
+        async for raw in iter_bulk_body(request):
+            try:
+                chunk.append((index, parse_bulk_record(raw)))
+            except (ValueError, ValidationError) as e:
+                results.append({"index": index, "event_id": None, "status": "invalid", "detail": str(e)})
+            index += 1
+            if len(chunk) >= BULK_CHUNK_SIZE:
+                await flush(chunk)
+                chunk = []
+        await flush(chunk)
+    except json.JSONDecodeError as e:
+        raise HTTPException(status_code=400, detail=f"Malformed JSON body: {e}")
+    except sqlite3.OperationalError as e:
+        raise HTTPException(status_code=500, detail=f"DB error: {e}")
+
+    if accepted:
+        metric_trigger.set()
+    results.sort(key=lambda r: r["index"])
+    return {"status": "ok", "received": index, "accepted": accepted, "results": results}
+
+
+@app.post("/observations/corrections")
+async def correct_observations(entry: CorrectionIn):
+    try:
+        result = await writer.run(
+            lambda conn: corrections.apply(conn, **entry.model_dump()),
+            rows=len(entry.event_ids or ()) or 1,
+        )
+    except (ValueError, sqlite3.IntegrityError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except sqlite3.OperationalError as e:
+        raise HTTPException(status_code=500, detail=f"DB error: {e}")
+    if result["decisions_cleared"] or result["metric_values"] or result["stale_values"]:
+        metric_trigger.set()
+    return {"status": "ok", **result}
+
+
+@app.post("/device_settings")
+async def set_device_settings(entry: DeviceSettingsIn):
+    try:
+        buckets = await writer.run(
+            lambda conn: derived.set_timezone(conn, entry.device_id, entry.timezone)
+        )
+        # the windows of the old offset are marked for the metric engine
+        metric_trigger.set()
+        return {"status": "ok", "Device Id": entry.device_id, "Rollup Buckets": buckets}
+    except (ValueError, KeyError) as e:
+        # ZoneInfoNotFoundError is a KeyError
+        raise HTTPException(status_code=400, detail=f"Unknown timezone: {e}")
+    except sqlite3.OperationalError as e:
+        raise HTTPException(status_code=500, detail=f"DB error: {e}")
+
+
+@app.get("/metrics")
+async def get_metrics():
+    # Prometheus text exposition format
+    return PlainTextResponse(instrument.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/rollups")
+async def get_rollups(device_id: str, grain: str = "day",
+                      start_ms: Optional[int] = None, end_ms: Optional[int] = None):
+    if grain not in rollups.GRAINS:
+        raise HTTPException(status_code=400, detail=f"grain must be one of {rollups.GRAINS}")
+    rows = await db.run_read(rollups.query, device_id, grain, start_ms, end_ms)
+    return {"device_id": device_id, "grain": grain, "rows": rows}
+
+
+@app.get("/sleep_sessions")
+async def get_sleep_sessions(device_id: str, start_ms: int, end_ms: int):
+    if end_ms <= start_ms:
+        raise HTTPException(status_code=400, detail="end_ms must be after start_ms")
+    rows = await db.run_read(sleep.query, device_id, start_ms, end_ms)
+    return {"device_id": device_id, "sessions": rows}
+
+
+@app.get("/reports")
+async def get_reports(device_id: str, period: str = "week", start_ms: Optional[int] = None,
+                      end_ms: Optional[int] = None):
+    if period not in reports.PERIODS:
+        raise HTTPException(status_code=400, detail=f"period must be one of {list(reports.PERIODS)}")
+    rows = await db.run_read(reports.query, device_id, period, start_ms, end_ms)
+    return {"device_id": device_id, "period": period, "reports": rows}
+
+
+@app.post("/reports/build")
+async def trigger_reports():
+    try:
+        n = await run_reports()
+        return {"status": "ok", "Reports": n}
+    except sqlite3.OperationalError as e:
+        raise HTTPException(status_code=500, detail=f"DB error: {e}")
+
+
+@app.get("/evidence/{device_id}/{metric_id}")
+async def get_evidence(device_id: str, metric_id: str, end_ms: Optional[int] = None, days: int = 7):
+    if not 1 <= days <= 366:
+        raise HTTPException(status_code=400, detail="days must be between 1 and 366")
+    try:
+        bundle = await db.run_read(evidence.get, device_id, metric_id, end_ms, days)
+    except sqlite3.OperationalError as e:
+        raise HTTPException(status_code=500, detail=f"DB error: {e}")
+    if bundle is None:
+        raise HTTPException(status_code=404, detail=f"No evidence for {metric_id} on {device_id}")
+    if bundle.fresh:
+        # stored after the response; a bundle outdated by then is dropped
+        writer.submit(lambda conn: evidence.store(conn, [bundle]))
+    return Response(bundle.body, media_type="application/json",
+                    headers={"ETag": f'"{bundle.content_hash}"'})
+
+
+@app.get("/explain/{device_id}/{metric_id}")
+async def get_explanation(device_id: str, metric_id: str, end_ms: Optional[int] = None,
+                          days: int = 7, priority: str = "interactive"):
+    if priority not in explain.PRIORITIES:
+        raise HTTPException(status_code=400, detail=f"priority must be one of {sorted(explain.PRIORITIES)}")
+    if not 1 <= days <= 366:
+        raise HTTPException(status_code=400, detail="days must be between 1 and 366")
+    try:
+        bundle = await db.run_read(evidence.get, device_id, metric_id, end_ms, days)
+        if bundle is None:
+            raise HTTPException(status_code=404, detail=f"No evidence for {metric_id} on {device_id}")
+        if bundle.fresh:
+            writer.submit(lambda conn: evidence.store(conn, [bundle]))
+        text, hit = await explainer.explain(bundle.content_hash, bundle.body,
+                                            explain.PRIORITIES[priority])
+    except explain.RuntimeUnavailable as e:
+        raise HTTPException(status_code=503, detail=f"Explanation runtime unavailable: {e}")
+    except sqlite3.OperationalError as e:
+        raise HTTPException(status_code=500, detail=f"DB error: {e}")
+    return {
+        "content_hash": bundle.content_hash,
+        "model": explainer.model,
+        "prompt_version": explain.PROMPT_VERSION,
+        "cached": hit,
+        "text": text,
+    }
+
+
+def insert_identified(conn, sql: str, params: tuple, event_id: str):
+    """
+    payload and provenance rows change an event's content hash, so they
+    are written together with its identity; a duplicate fails both
+    """
+    conn.execute(sql, params)
+    identity.register(conn, event_id)
+
+
 @app.post("/observation_provenance")
 async def add_provenance(entry:ObservationProvenanceIn):
     try:
-        with get_conn() as conn:
-            conn.execute(
-                """INSERT INTO observation_provenance
-                (event_id,source_kind,app_version,ingested_at,provenance_json) values(?,?,?,?,?)"""
-                ,
-                (
-                entry.event_id, 
-                entry.source_kind,
-                entry.app_version,
-                entry.ingested_at, 
-                entry.provenance_json
-                )
-            )
+        await writer.run(lambda conn: insert_identified(
+            conn,
+            """INSERT INTO observation_provenance
+            (event_id,source_kind,app_version,ingested_at,provenance_json) values(?,?,?,?,?)"""
+            ,
+            (
+            entry.event_id, 
+            entry.source_kind,
+            entry.app_version,
+            entry.ingested_at, 
+            entry.provenance_json
+            ),
+            entry.event_id,
+        ))
        
         return {"status": "OKAY", "Provenance Status": entry.source_kind}
     except sqlite3.IntegrityError as e:
@@ -349,24 +634,23 @@ async def add_provenance(entry:ObservationProvenanceIn):
     except Exception as e:
         # Catch other potential general errors
         raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {e}")
-    finally:
-        conn.close()
 
 
 
 @app.post("/obs_steps")
 async def add_steps(entry:ObsStepsIn):
     try:
-        with get_conn() as conn:
-            conn.execute(
-                """
-                INSERT INTO obs_steps
-                (event_id,step_value,step_mode) values(?,?,?)
-                """,
-                (entry.event_id, 
-                entry.step_value,
-                entry.step_mode)
-            )
+        await writer.run(lambda conn: insert_identified(
+            conn,
+            """
+            INSERT INTO obs_steps
+            (event_id,step_value,step_mode) values(?,?,?)
+            """,
+            (entry.event_id, 
+            entry.step_value,
+            entry.step_mode),
+            entry.event_id,
+        ))
      
         return {"status": "Okay", "Event Id": entry.event_id}
     except sqlite3.IntegrityError as e:
@@ -374,64 +658,59 @@ async def add_steps(entry:ObsStepsIn):
     except Exception as e:
         # Catch other potential general errors
         raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {e}")
-    finally:
-        conn.close()
 
 
 @app.post("/obs_weight")
 async def add_weight(entry:ObsWeightIn):
     try:
-        with get_conn() as conn:
-            conn.execute(
-                "INSERT INTO obs_weight(event_id,body_mass_kg) values(?,?)",
-                (entry.event_id, entry.body_mass_kg)
-            )
+        await writer.run(lambda conn: insert_identified(
+            conn,
+            "INSERT INTO obs_weight(event_id,body_mass_kg) values(?,?)",
+            (entry.event_id, entry.body_mass_kg),
+            entry.event_id,
+        ))
             
         return {"status:": "200", "Event Id": entry.event_id}
     except sqlite3.IntegrityError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f'An unexpected error occured:{e}')
-    finally:
-        conn.close()
 
 @app.post("/obs_sleep_state")
 async def add_sleep(entry: ObsSleepIn):        
     try:
-        with get_conn() as conn:
-            conn.execute(
-                """
-                INSERT INTO obs_sleep_state
-                (event_id,state)values
-                (?,?)
-                """,
-                (entry.event_id, entry.state)
-            )
+        await writer.run(lambda conn: insert_identified(
+            conn,
+            """
+            INSERT INTO obs_sleep_state
+            (event_id,state)values
+            (?,?)
+            """,
+            (entry.event_id, entry.state),
+            entry.event_id,
+        ))
             
         return {"status:": "200", "Event Id": entry.event_id}
     except sqlite3.IntegrityError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An unexpected error occured: {e}")
-    finally:
-        conn.close()
 
 @app.post("/metric_def")        
 async def add_metric_def (entry:MetricDefIn):
     try:
-        with get_conn() as conn:
-            conn.execute(
-                """
-                INSERT INTO metric_def
-                (metric_id,metric_name,watermark,unit,description)
-                values(?,?,?,?,?)
-                """,
-                (entry.metric_id, 
-                entry.metric_name,
-                entry.watermark, 
-                entry.unit,
-                entry.description)
-            )
+        await writer.execute(
+            """
+            INSERT INTO metric_def
+            (metric_id,metric_name,watermark,unit,description)
+            values(?,?,?,?,?)
+            """,
+            (entry.metric_id, 
+            entry.metric_name,
+            entry.watermark, 
+            entry.unit,
+            entry.description)
+        )
             
         
         return {"status:": "200", "Event Id": entry.metric_id}
@@ -439,33 +718,30 @@ async def add_metric_def (entry:MetricDefIn):
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An unexpected error occured: {e}")
-    finally:
-        conn.close()
 
     
 @app.post("/metric_value")
 async def add_metric_value(entry: MetricValueIn):
     try:
-        with get_conn() as conn:
-            conn.execute(
-                """
-                INSERT INTO metric_value(
-                metric_value_id,metric_id,device_id,window_start_ms,
-                window_end_ms, computed_at, value_real, value_int, value_text)
-                values(?,?,?,?,?,?,?,?,?)
-                """,
-                (
-                    entry.metric_value_id,
-                    entry.metric_id,
-                    entry.device_id,
-                    entry.window_start_ms,
-                    entry.window_end_ms,
-                    entry.computed_at,
-                    entry.value_real,
-                    entry.value_int,
-                    entry.value_text
-                )
+        await writer.execute(
+            """
+            INSERT INTO metric_value(
+            metric_value_id,metric_id,device_id,window_start_ms,
+            window_end_ms, computed_at, value_real, value_int, value_text)
+            values(?,?,?,?,?,?,?,?,?)
+            """,
+            (
+                entry.metric_value_id,
+                entry.metric_id,
+                entry.device_id,
+                entry.window_start_ms,
+                entry.window_end_ms,
+                entry.computed_at,
+                entry.value_real,
+                entry.value_int,
+                entry.value_text
             )
+        )
             
         
         return {"status:": "200", "Event Id": entry.metric_value_id}
@@ -473,89 +749,78 @@ async def add_metric_value(entry: MetricValueIn):
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An unexpected error occured: {e}")
-    finally:
-        conn.close()
 
 
 @app.post("/metric_run")
 async def add_metric_run(entry: MetricRunIn):
     try:
-        with get_conn() as conn:
-            conn.execute(
-                """
-                INSERT INTO metric_run
-                (metric_value_id ,confidence_score ,missing_data_ratio ,
-                is_imputed,logic_version,details_json)
-                values(?,?,?,?,?,?)
-                """,
-                (
-                    entry.metric_value_id,
-                    entry.confidence_score,
-                    entry.missing_data_ratio,
-                    entry.is_imputed,
-                    entry.logic_version,
-                    entry.details_json
-                )
+        await writer.execute(
+            """
+            INSERT INTO metric_run
+            (metric_value_id ,confidence_score ,missing_data_ratio ,
+            is_imputed,logic_version,details_json)
+            values(?,?,?,?,?,?)
+            """,
+            (
+                entry.metric_value_id,
+                entry.confidence_score,
+                entry.missing_data_ratio,
+                entry.is_imputed,
+                entry.logic_version,
+                entry.details_json
             )
+        )
         
         return {"status:": "200", "Event Id": entry.metric_value_id}
     except sqlite3.IntegrityError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An unexpected error occured: {e}")
-    finally:
-        conn.close()
 
 
 @app.post("/decision_run")
 async def add_decision_run(entry:DecisionRunIn):
     try:
-        with get_conn() as conn:
-            conn.execute(
-                """
-                INSERT INTO decision_run
-                (decision_run_id ,metric_value_id ,computed_at ,policy_version)
-                values(?,?,?,?)
-                """, (
-                    entry.decision_run_id,
-                    entry.metric_value_id,
-                    entry.computed_at,
-                    entry.policy_version
-                )
+        await writer.execute(
+            """
+            INSERT INTO decision_run
+            (decision_run_id ,metric_value_id ,computed_at ,policy_version)
+            values(?,?,?,?)
+            """, (
+                entry.decision_run_id,
+                entry.metric_value_id,
+                entry.computed_at,
+                entry.policy_version
             )
+        )
         
         return {"status:": "200", "Event Id": entry.decision_run_id}
     except sqlite3.IntegrityError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An unexpected error occured: {e}")
-    finally:
-        conn.close()
 
 @app.post("/decision_result")
 async def add_decision_result(entry:DecisionResultIn):
     try:
-        with get_conn() as conn:
-            conn.execute(
-                """
-                INSERT INTO decision_result
-                (decision_run_id, reversible,explain,action,msg,notify)
-                values (?,?,?,?,?,?)
-                """,
-                (
-                    entry.decision_run_id,
-                    entry.reversible,
-                    entry.explain,
-                    entry.action,
-                    entry.msg,
-                    entry.notify
-                )
+        await writer.execute(
+            """
+            INSERT INTO decision_result
+            (decision_run_id, reversible,explain,action,msg,notify)
+            values (?,?,?,?,?,?)
+            """,
+            (
+                entry.decision_run_id,
+                entry.reversible,
+                entry.explain,
+                entry.action,
+                entry.msg,
+                entry.notify
             )
+        )
         
         return {"status:": "200", "Event Id": entry.decision_run_id}
     except sqlite3.IntegrityError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"An unexpected error occured: {e}")
-    finally:
-        conn.close()
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"An unexpected error occured: {e}")
\ No newline at end of file
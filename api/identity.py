@@ -0,0 +1,230 @@
+"""
+Content-hash identity of observations.
+
+docs/note.md: same resource + time definition + original metadata means
+the same observation. content_hash() turns that into one key (device,
+kind, observed_ms, payload value and mode, source_kind) and
+observation_identity holds it under a unique index, so a re-upload with
+a fresh event_id is caught with a single index probe.
+
+An event gets its identity once its payload row exists; a provenance row
+posted later re-hashes it with the real source_kind.
+
+    python -m api.identity backfill   # hash existing history, supersede duplicates
+"""
+import hashlib
+import sqlite3
+import sys
+
+from . import derived
+
+IDENTITY_SQL = "INSERT INTO observation_identity(content_hash, event_id) values(?,?)"
+
+# everything content_hash() needs, one row per event
+SOURCE_COLUMNS = """
+    e.event_id, e.device_id, e.obs_kind, e.observed_ms,
+    w.body_mass_kg, s.step_value, s.step_mode, z.state,
+    COALESCE(p.source_kind, 'unknown')
+"""
+
+SOURCE_FROM = """
+    FROM observation_event e
+    LEFT JOIN event_weight w ON w.event_key = e.event_key
+    LEFT JOIN event_steps s ON s.event_key = e.event_key
+    LEFT JOIN event_sleep_state z ON z.event_key = e.event_key
+    LEFT JOIN event_provenance p ON p.event_key = e.event_key
+"""
+
+UNHASHED = "NOT EXISTS (SELECT 1 FROM observation_identity i WHERE i.event_id = e.event_id)"
+
+LOOKUP_CHUNK = 500
+
+
+def content_hash(device_id: str, obs_kind: str, observed_ms: int, value,
+                 mode: str | None, source_kind: str | None) -> str:
+    if isinstance(value, float):
+        value = repr(value)
+    key = "\x1f".join((
+        device_id, obs_kind, str(int(observed_ms)), str(value), mode or "",
+        source_kind or "unknown",
+    ))
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def row_hash(row) -> str | None:
+    """
+    hash of a SOURCE_COLUMNS row; None while the event has no payload
+    """
+    _, device_id, obs_kind, observed_ms, kg, steps, mode, state, source = row
+    if kg is not None:
+        return content_hash(device_id, obs_kind, observed_ms, float(kg), None, source)
+    if steps is not None:
+        return content_hash(device_id, obs_kind, observed_ms, int(steps), mode, source)
+    if state is not None:
+        return content_hash(device_id, obs_kind, observed_ms, state, None, source)
+    return None
+
+
+def record_hash(record: dict) -> str | None:
+    """
+    hash of a combined ingest record (see ingest.insert_observations)
+    """
+    event = record["event"]
+    source = (record.get("provenance") or {}).get("source_kind")
+    return row_hash((
+        event["event_id"], event["device_id"], event["obs_kind"], event["observed_ms"],
+        (record.get("weight") or {}).get("body_mass_kg"),
+        (record.get("steps") or {}).get("step_value"),
+        (record.get("steps") or {}).get("step_mode"),
+        (record.get("sleep_state") or {}).get("state"),
+        source,
+    ))
+
+
+def lookup(conn: sqlite3.Connection, hashes) -> dict[str, str]:
+    """
+    content_hash -> event_id for the hashes that are already taken,
+    archived events included
+    """
+    hashes = list(hashes)
+    found = {}
+    for i in range(0, len(hashes), LOOKUP_CHUNK):
+        part = hashes[i:i + LOOKUP_CHUNK]
+        marks = ",".join("?" * len(part))
+        found.update(conn.execute(
+            f"""
+            SELECT content_hash, event_id FROM observation_identity WHERE content_hash IN ({marks})
+            UNION ALL
+            SELECT content_hash, event_id FROM archived_identity WHERE content_hash IN ({marks})
+            """,
+            part + part,
+        ))
+    return found
+
+
+def register(conn: sqlite3.Connection, event_id: str) -> str | None:
+    """
+    (re)hash one event after its payload or provenance changed.
+    Raises sqlite3.IntegrityError when another event already has the content.
+    """
+    row = conn.execute(
+        f"SELECT {SOURCE_COLUMNS} {SOURCE_FROM} WHERE e.event_id = ?", (event_id,)
+    ).fetchone()
+    digest = row_hash(row) if row is not None else None
+    if digest is None:
+        return None
+    other = lookup(conn, [digest]).get(digest)
+    if other is not None and other != event_id:
+        raise sqlite3.IntegrityError(f"duplicate observation: same content as event {other}")
+    conn.execute(
+        IDENTITY_SQL + " ON CONFLICT(event_id) DO UPDATE SET content_hash = excluded.content_hash",
+        (digest, event_id),
+    )
+    return digest
+
+
+def pending(conn: sqlite3.Connection) -> bool:
+    """
+    True when some live event with a payload has no identity yet
+    """
+    return conn.execute(
+        f"""
+        SELECT 1 {SOURCE_FROM}
+        WHERE e.superseded_by IS NULL AND {UNHASHED}
+            AND COALESCE(w.event_key, s.event_key, z.event_key) IS NOT NULL
+        LIMIT 1
+        """
+    ).fetchone() is not None
+
+
+def _hash_rows(conn: sqlite3.Connection, rows: list) -> tuple[int, int]:
+    """
+    give unhashed SOURCE_COLUMNS rows their identity, or mark them
+    superseded_by the event that already has their content
+    """
+    fresh: dict[str, str] = {}
+    dupes: list[tuple[str, str]] = []
+    hashes = [(r[0], row_hash(r)) for r in rows]
+    taken = lookup(conn, {h for _, h in hashes if h is not None})
+    for event_id, digest in hashes:
+        if digest is None:
+            continue
+        first = taken.get(digest) or fresh.get(digest)
+        if first is None:
+            fresh[digest] = event_id
+        else:
+            dupes.append((first, event_id))
+    conn.executemany(IDENTITY_SQL, [(h, e) for h, e in fresh.items()])
+    conn.executemany(
+        "UPDATE event SET superseded_by = ? WHERE event_id = ? AND superseded_by IS NULL",
+        dupes,
+    )
+    return len(fresh), len(dupes)
+
+
+def hash_events(conn: sqlite3.Connection, event_ids: list[str]) -> tuple[int, int]:
+    """
+    _hash_rows for the given events (e.g. just applied from a changeset),
+    inside the caller's transaction
+    """
+    rows = []
+    for i in range(0, len(event_ids), LOOKUP_CHUNK):
+        part = event_ids[i:i + LOOKUP_CHUNK]
+        marks = ",".join("?" * len(part))
+        rows.extend(conn.execute(
+            f"SELECT {SOURCE_COLUMNS} {SOURCE_FROM} WHERE e.event_id IN ({marks}) AND {UNHASHED}",
+            part,
+        ))
+    return _hash_rows(conn, rows)
+
+
+def backfill(conn: sqlite3.Connection, chunk_rows: int = 5000) -> tuple[int, int]:
+    """
+    hash every event without an identity, in event_key order and one
+    transaction per chunk. A later event with the content of an earlier
+    one is marked superseded_by it instead of getting an identity, so
+    fused_minute and the metrics stop counting it.
+    Returns (hashed, superseded).
+    """
+    hashed = superseded = 0
+    last = -1
+    while True:
+        rows = conn.execute(
+            f"""
+            SELECT e.event_key, {SOURCE_COLUMNS} {SOURCE_FROM}
+            WHERE e.event_key > ? AND {UNHASHED}
+            ORDER BY e.event_key
+            LIMIT ?
+            """,
+            (last, chunk_rows),
+        ).fetchall()
+        if not rows:
+            break
+        last = rows[-1][0]
+        with conn:
+            n, d = _hash_rows(conn, [r[1:] for r in rows])
+            derived.refresh(conn)
+        hashed += n
+        superseded += d
+    return hashed, superseded
+
+
+def main(argv=None):
+    from . import db
+
+    argv = sys.argv[1:] if argv is None else argv
+    command = argv[0] if argv else "backfill"
+    if command != "backfill":
+        print("usage: python -m api.identity backfill")
+        return 2
+    conn = db.connect()
+    try:
+        hashed, superseded = backfill(conn)
+        print(f"identity backfill: {hashed} hashed, {superseded} duplicates superseded")
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
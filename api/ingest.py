@@ -0,0 +1,157 @@
+import sqlite3
+
+from . import identity
+from .schema import OBSERVED_AT_SQL, PAYLOAD_TABLES
+
+
+def compact_sql(table: str, verb: str = "INSERT") -> str:
+    """
+    {verb} of one row of observation_event or a PAYLOAD_TABLES view, with
+    the view's columns as parameters, straight into its compact table so
+    that rowcount counts it; devices and kinds must be intern()ed first
+    """
+    if table == "observation_event":
+        return f"""
+            {verb} INTO event
+            (event_id, device_key, observed_at, observed_ms, kind_key,
+            is_valid, superseded_by, note) values
+            (?1, (SELECT device_key FROM device WHERE device_id = ?2),
+            NULLIF(?3, {OBSERVED_AT_SQL.format(ms="?4")}), ?4,
+            (SELECT kind_key FROM event_kind WHERE obs_kind = ?5), ?6, ?7, ?8)
+        """
+    compact, columns = PAYLOAD_TABLES[table]
+    # an unknown event_id leaves the key NULL, which the table rejects
+    return (
+        f"{verb} INTO {compact}(event_key, {', '.join(columns)})"
+        f" values((SELECT event_key FROM event WHERE event_id = ?), {','.join('?' * len(columns))})"
+    )
+
+
+def intern(conn: sqlite3.Connection, device_ids, obs_kinds):
+    """
+    key the device ids and kinds that are new to the database
+    """
+    conn.executemany("INSERT OR IGNORE INTO device(device_id) values(?)",
+                     [(d,) for d in set(device_ids)])
+    conn.executemany("INSERT OR IGNORE INTO event_kind(obs_kind) values(?)",
+                     [(k,) for k in set(obs_kinds)])
+
+
+EVENT_SQL = compact_sql("observation_event")
+
+WEIGHT_SQL = compact_sql("obs_weight")
+
+STEPS_SQL = compact_sql("obs_steps")
+
+SLEEP_SQL = compact_sql("obs_sleep_state")
+
+PROVENANCE_SQL = """
+    INSERT INTO event_provenance
+    (event_key, source_kind, app_version, ingested_at, provenance_json)
+    values((SELECT event_key FROM event WHERE event_id = ?), ?, ?,
+    COALESCE(?, strftime('%Y-%m-%dT%H:%M:%fZ', 'now')), ?)
+"""
+
+
+def _rows(record: dict, content_hash: str | None = None):
+    """
+    split one combined record into (sql, params) pairs, parent rows first
+    """
+    event = record["event"]
+    event_id = event["event_id"]
+    rows = [(EVENT_SQL, (
+        event_id,
+        event["device_id"],
+        event["observed_at"],
+        event["observed_ms"],
+        event["obs_kind"],
+        int(event.get("is_valid", True)),
+        event.get("superseded_by"),
+        event.get("note"),
+    ))]
+
+    if record.get("weight") is not None:
+        rows.append((WEIGHT_SQL, (event_id, record["weight"]["body_mass_kg"])))
+    if record.get("steps") is not None:
+        steps = record["steps"]
+        rows.append((STEPS_SQL, (event_id, steps["step_value"], steps["step_mode"])))
+    if record.get("sleep_state") is not None:
+        rows.append((SLEEP_SQL, (event_id, record["sleep_state"]["state"])))
+
+    prov = record.get("provenance") or {}
+    rows.append((PROVENANCE_SQL, (
+        event_id,
+        prov.get("source_kind") or "unknown",
+        prov.get("app_version"),
+        prov.get("ingested_at"),
+        prov.get("provenance_json"),
+    )))
+    if content_hash is not None:
+        rows.append((identity.IDENTITY_SQL, (content_hash, event_id)))
+    return rows
+
+
+def insert_observations(conn: sqlite3.Connection, records: list[dict]) -> list[tuple[str, str | None]]:
+    """
+    insert combined event/payload/provenance records on conn.
+
+    Records whose content hash is already taken (in the database or
+    earlier in the chunk) are skipped after one identity probe. The rest
+    go in with one executemany per table; if any row breaks a constraint
+    the chunk is replayed record by record so the good ones still land.
+    Returns one (status, detail) per record: ('ok', None),
+    ('duplicate', event_id it duplicates) or ('rejected', error).
+    The caller owns the surrounding transaction.
+    """
+    if not records:
+        return []
+
+    results: list = [None] * len(records)
+    hashes = [identity.record_hash(record) for record in records]
+    taken = identity.lookup(conn, {h for h in hashes if h is not None})
+    todo = []
+    for i, (record, digest) in enumerate(zip(records, hashes)):
+        if digest is not None:
+            first = taken.get(digest)
+            if first is not None:
+                results[i] = ("duplicate", first)
+                continue
+            taken[digest] = record["event"]["event_id"]
+        todo.append(i)
+
+    per_table: dict[str, list[tuple]] = {}
+    for i in todo:
+        for sql, params in _rows(records[i], hashes[i]):
+            per_table.setdefault(sql, []).append(params)
+
+    # interning inside the savepoint: a write ahead of it would open the
+    # transaction and make every statement in the chunk keep a sub-journal
+    conn.execute("SAVEPOINT bulk_chunk")
+    try:
+        intern(conn, (records[i]["event"]["device_id"] for i in todo),
+               (records[i]["event"]["obs_kind"] for i in todo))
+        # dict keeps insertion order, so the event goes first
+        for sql, params in per_table.items():
+            conn.executemany(sql, params)
+        conn.execute("RELEASE bulk_chunk")
+        for i in todo:
+            results[i] = ("ok", None)
+        return results
+    except sqlite3.IntegrityError:
+        conn.execute("ROLLBACK TO bulk_chunk")
+        conn.execute("RELEASE bulk_chunk")
+
+    for i in todo:
+        conn.execute("SAVEPOINT bulk_row")
+        try:
+            event = records[i]["event"]
+            intern(conn, [event["device_id"]], [event["obs_kind"]])
+            for sql, params in _rows(records[i], hashes[i]):
+                conn.execute(sql, params)
+            conn.execute("RELEASE bulk_row")
+            results[i] = ("ok", None)
+        except sqlite3.IntegrityError as e:
+            conn.execute("ROLLBACK TO bulk_row")
+            conn.execute("RELEASE bulk_row")
+            results[i] = ("rejected", str(e))
+    return results
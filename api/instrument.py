@@ -0,0 +1,345 @@
+"""
+Low-overhead performance instrumentation, exposed at GET /metrics.
+
+- Middleware: a latency histogram per (method, route template, status
+  class), plus requests in flight.
+- InstrumentedConnection (db.connect uses it when HEALTH_INSTRUMENT is
+  on): time and rows changed per statement, labelled by operation and
+  first table, and "database is locked"/"busy" errors. The time is that
+  of execute() and fetchall()/fetchmany()/fetchone(); rows pulled by
+  iterating a cursor are not timed (nothing per-row runs in Python).
+- The writer and reader pool report queue waits, BEGIN IMMEDIATE lock
+  waits, commit times and transaction sizes here.
+- Slow-query log: statements over HEALTH_SLOW_QUERY_MS go to the
+  health.slow_query logger (HEALTH_SLOW_QUERY_LOG, else stderr) as one
+  JSON line with their EXPLAIN QUERY PLAN, captured at most once a
+  minute per statement.
+
+Everything is plain counters behind one lock per metric family; an
+observation costs a couple of microseconds.
+"""
+import bisect
+import functools
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+
+from . import config
+
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 50000)
+
+# EXPLAIN QUERY PLAN is captured at most this often per statement
+PLAN_INTERVAL_S = 60
+
+
+class _Child:
+    __slots__ = ("counts", "sum", "value")
+
+    def __init__(self, nbuckets: int):
+        self.counts = [0] * (nbuckets + 1)
+        self.sum = 0.0
+        self.value = 0.0
+
+
+class Family:
+    """
+    one metric name with a fixed set of label names; kind is counter,
+    gauge or histogram (observe() for histograms, inc() for the others)
+    """
+
+    def __init__(self, name: str, help: str, kind: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets) if kind == "histogram" else ()
+        self._children: dict[tuple, _Child] = {}
+        self._lock = threading.Lock()
+
+    def _child(self, labels: tuple) -> _Child:
+        child = self._children.get(labels)
+        if child is None:
+            child = self._children.setdefault(labels, _Child(len(self.buckets)))
+        return child
+
+    def observe(self, value: float, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            child = self._child(labels)
+            child.counts[i] += 1
+            child.sum += value
+
+    def inc(self, amount: float = 1, *labels):
+        with self._lock:
+            self._child(labels).value += amount
+
+    def set(self, value: float, *labels):
+        with self._lock:
+            self._child(labels).value = value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            children = [(k, list(c.counts), c.sum, c.value) for k, c in self._children.items()]
+        for labels, counts, total, value in sorted(children):
+            pairs = [f'{n}="{_escape(v)}"' for n, v in zip(self.labelnames, labels)]
+            if self.kind != "histogram":
+                lines.append(f"{self.name}{_labels(pairs)} {_num(value)}")
+                continue
+            running = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                running += n
+                le = "+Inf" if bound == float("inf") else _num(bound)
+                bucket = _labels(pairs + [f'le="{le}"'])
+                lines.append(f"{self.name}_bucket{bucket} {running}")
+            lines.append(f"{self.name}_sum{_labels(pairs)} {_num(total)}")
+            lines.append(f"{self.name}_count{_labels(pairs)} {running}")
+        return lines
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(pairs: list[str]) -> str:
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _num(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+REGISTRY: list[Family] = []
+# name -> (help, fn) for values read at scrape time
+GAUGES: dict[str, tuple[str, object]] = {}
+
+
+def family(name: str, help: str, kind: str, labelnames=(), buckets=LATENCY_BUCKETS) -> Family:
+    f = Family(name, help, kind, labelnames, buckets)
+    REGISTRY.append(f)
+    return f
+
+
+def gauge(name: str, help: str, fn):
+    """
+    register fn() -> number, called on every scrape
+    """
+    GAUGES[name] = (help, fn)
+
+
+HTTP_SECONDS = family("health_http_request_duration_seconds", "HTTP request latency by route",
+                      "histogram", ("method", "route", "status"))
+HTTP_IN_FLIGHT = family("health_http_requests_in_flight", "HTTP requests being served", "gauge")
+QUERY_SECONDS = family("health_db_query_duration_seconds", "SQL statement time by operation and table",
+                       "histogram", ("op", "table"))
+QUERY_ROWS = family("health_db_rows_changed_total", "rows inserted/updated/deleted", "counter",
+                    ("op", "table"))
+BUSY_ERRORS = family("health_db_busy_errors_total", "statements that failed with locked/busy",
+                     "counter", ("op", "table"))
+SLOW_QUERIES = family("health_db_slow_queries_total", "statements over HEALTH_SLOW_QUERY_MS",
+                      "counter", ("op", "table"))
+READ_WAIT = family("health_db_reader_wait_seconds",
+                   "time from run_read() to a pooled connection running it", "histogram")
+WRITER_QUEUE = family("health_writer_queue_seconds", "time a write job waited for its batch",
+                      "histogram")
+WRITER_LOCK = family("health_writer_lock_wait_seconds", "BEGIN IMMEDIATE time (database lock wait)",
+                     "histogram")
+WRITER_COMMIT = family("health_writer_transaction_seconds", "BEGIN to COMMIT of one batch",
+                       "histogram")
+WRITER_JOBS = family("health_writer_transaction_jobs", "jobs per committed batch", "histogram",
+                     buckets=SIZE_BUCKETS)
+WRITER_CHANGES = family("health_writer_transaction_changes", "rows changed per committed batch",
+                        "histogram", buckets=SIZE_BUCKETS)
+
+
+def render() -> str:
+    lines = []
+    for f in REGISTRY:
+        lines.extend(f.render())
+    for name, (help, fn) in GAUGES.items():
+        try:
+            value = fn()
+        except Exception:
+            continue
+        lines.extend((f"# HELP {name} {help}", f"# TYPE {name} gauge", f"{name} {_num(value)}"))
+    return "\n".join(lines) + "\n"
+
+
+_STATEMENT = re.compile(
+    r"^\s*(?:WITH\b.*?\)\s*)?(SELECT|INSERT(?:\s+OR\s+\w+)?\s+INTO|REPLACE\s+INTO|UPDATE(?:\s+OR\s+\w+)?"
+    r"|DELETE\s+FROM|BEGIN|COMMIT|ROLLBACK|SAVEPOINT|RELEASE|PRAGMA|CREATE|DROP|ATTACH|DETACH)"
+    r"\s*(?:(?:\w+\.)?(\w+))?",
+    re.I | re.S,
+)
+_FROM = re.compile(r"\bFROM\s+(?:\w+\.)?(\w+)", re.I)
+
+
+@functools.lru_cache(maxsize=2048)
+def statement_labels(sql: str) -> tuple[str, str]:
+    """
+    (operation, first table) for a statement; cached by the SQL text
+    """
+    m = _STATEMENT.match(sql)
+    if m is None:
+        return "other", ""
+    op = m.group(1).split()[0].lower()
+    if op == "select":
+        f = _FROM.search(sql)
+        return op, f.group(1) if f else ""
+    if op in ("insert", "replace", "update", "delete", "pragma"):
+        return op, m.group(2) or ""
+    return op, ""
+
+
+slow_log = logging.getLogger("health.slow_query")
+_plans: dict[str, float] = {}
+
+
+def _setup_slow_log():
+    if slow_log.handlers:
+        return
+    handler = (logging.FileHandler(config.SLOW_QUERY_LOG) if config.SLOW_QUERY_LOG
+               else logging.StreamHandler())
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    slow_log.addHandler(handler)
+    slow_log.setLevel(logging.INFO)
+    slow_log.propagate = False
+
+
+def _slow(conn: sqlite3.Connection, sql: str, params, seconds: float, labels: tuple):
+    SLOW_QUERIES.inc(1, *labels)
+    entry = {
+        "ts": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "ms": round(seconds * 1000, 3),
+        "op": labels[0],
+        "table": labels[1],
+        "sql": " ".join(sql.split()),
+        "params": repr(params)[:200] if params is not None else None,
+    }
+    now = time.monotonic()
+    explainable = labels[0] in ("select", "insert", "update", "delete") and params is not None
+    if explainable and now - _plans.get(sql, -PLAN_INTERVAL_S) >= PLAN_INTERVAL_S:
+        _plans[sql] = now
+        try:
+            plan = sqlite3.Connection.execute(conn, "EXPLAIN QUERY PLAN " + sql, params).fetchall()
+            entry["plan"] = [row[-1] for row in plan]
+        except sqlite3.Error as e:
+            entry["plan_error"] = str(e)
+    slow_log.info(json.dumps(entry))
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    _sql = None
+    _params = None
+
+    def _timed(self, fn, *args):
+        started = time.perf_counter()
+        try:
+            return fn(self, *args)
+        finally:
+            _record(self.connection, self._sql, self._params, time.perf_counter() - started, 0)
+
+    def execute(self, sql, params=()):
+        self._sql, self._params = sql, params
+        return self._run(sqlite3.Cursor.execute, sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        # the first row is enough to EXPLAIN a slow one
+        first = seq_of_params[0] if isinstance(seq_of_params, (list, tuple)) and seq_of_params else None
+        self._sql, self._params = sql, first
+        return self._run(sqlite3.Cursor.executemany, sql, seq_of_params)
+
+    def _run(self, fn, sql, params):
+        conn = self.connection
+        started = time.perf_counter()
+        try:
+            fn(self, sql, params)
+        except sqlite3.OperationalError as e:
+            text = str(e)
+            if "locked" in text or "busy" in text:
+                BUSY_ERRORS.inc(1, *statement_labels(sql))
+            raise
+        finally:
+            # rowcount: rows this statement changed, not counting triggers
+            _record(conn, sql, self._params, time.perf_counter() - started,
+                    max(self.rowcount, 0))
+        return self
+
+    def fetchall(self):
+        return self._timed(sqlite3.Cursor.fetchall)
+
+    def fetchmany(self, size=None):
+        return self._timed(sqlite3.Cursor.fetchmany, size if size is not None else self.arraysize)
+
+    def fetchone(self):
+        return self._timed(sqlite3.Cursor.fetchone)
+
+
+def _record(conn, sql, params, seconds: float, changed: int):
+    if sql is None:
+        return
+    labels = statement_labels(sql)
+    QUERY_SECONDS.observe(seconds, *labels)
+    if changed:
+        QUERY_ROWS.inc(changed, *labels)
+    if config.SLOW_QUERY_MS and seconds * 1000 >= config.SLOW_QUERY_MS:
+        _slow(conn, sql, params, seconds, labels)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """
+    sqlite3.connect(..., factory=InstrumentedConnection); every execute
+    goes through InstrumentedCursor
+    """
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+
+def connection_factory():
+    if config.SLOW_QUERY_MS:
+        _setup_slow_log()
+    return InstrumentedConnection if config.INSTRUMENT else sqlite3.Connection
+
+
+class Middleware:
+    """
+    pure ASGI middleware timing each request until its last body chunk;
+    labelled by the route template, so /x/{id} is one series
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = [500]
+
+        async def send_timed(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc(1)
+        try:
+            await self.app(scope, receive, send_timed)
+        finally:
+            HTTP_IN_FLIGHT.inc(-1)
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            HTTP_SECONDS.observe(time.perf_counter() - started, scope["method"], route,
+                                 f"{status[0] // 100}xx")
@@ -0,0 +1,599 @@
+"""
+In-process metric engine filling metric_value / metric_run.
+
+Metrics are registered with @metric under their metric_def.metric_id.
+Every metric is evaluated over daily windows that end on the device's
+local day boundary (see api/rollups.py). metric_def.watermark holds a
+JSON object {device_id: end_ms of the last window written}; a run only
+loads data from (watermark - window) onwards, computes all new windows
+at once with NumPy and writes values, runs and the new watermark in the
+same transaction.
+
+Data that arrives for a window already written (offline replay, history
+imports, sync) is found through metric_dirty, the days derived.refresh()
+saw change: a run also recomputes the written windows over those days
+(widened to the start of any sleep session reaching into them), writes
+the values that actually changed, deletes their decision_runs (and those
+of the windows whose trend rules compare against them) so the decision
+engine evaluates them again, and clears the marks it read.
+
+    python -m api.metrics          # compute and write everything due
+"""
+import json
+import math
+import sqlite3
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+
+import numpy as np
+
+from . import archive, decisions, rollups, sleep
+from .identity import LOOKUP_CHUNK
+
+
+DAY_MS = 86_400_000
+HOUR_MS = 3_600_000
+LOGIC_VERSION = "metric-engine-1"
+
+# uuid5 namespace for deterministic metric_value ids, so recomputing a
+# window updates the same row
+METRIC_NAMESPACE = uuid.UUID("5b2f3c0e-8d1a-4f3e-9a51-0c6f1d2e7a10")
+
+# metric source -> obs_kind it is computed from
+SOURCE_KINDS = {"weight": "weight", "steps": "steps", "sleep": "sleep_state"}
+
+
+class MetricSpec:
+    def __init__(self, metric_id, fn, source, window_days, unit, description,
+                 end_offset_ms=0):
+        self.metric_id = metric_id
+        self.fn = fn
+        self.source = source
+        self.window_days = window_days
+        self.window_ms = window_days * DAY_MS
+        self.unit = unit
+        self.description = description
+        # windows end at local midnight + end_offset_ms (sleep uses noon)
+        self.end_offset_ms = end_offset_ms
+
+
+REGISTRY: dict[str, MetricSpec] = {}
+
+
+def metric(metric_id: str, source: str, window_days: int, unit=None,
+           description=None, end_offset_ms: int = 0):
+    """
+    register fn(t, v, starts, ends) -> values for metric_id.
+    t/v are the sorted sample times/values of source, starts/ends the
+    window bounds; values may be NaN where a window has no answer.
+    """
+    def wrap(fn):
+        REGISTRY[metric_id] = MetricSpec(
+            metric_id, fn, source, window_days, unit, description, end_offset_ms
+        )
+        return fn
+    return wrap
+
+
+def _with_archive(conn, device_id, obs_kind, column, start_ms, end_ms, t, v):
+    """
+    add the cold-tier samples (see api/archive.py), keeping t sorted
+    """
+    at, av = archive.load(conn, device_id, obs_kind, column, start_ms, end_ms)
+    if not len(at):
+        return t, v
+    t, v = np.concatenate([at, t]), np.concatenate([av, v])
+    order = np.argsort(t, kind="stable")
+    return t[order], v[order]
+
+
+def load_weight(conn, device_id, start_ms, end_ms):
+    rows = conn.execute(
+        """
+        SELECT e.observed_ms, ow.body_mass_kg
+        FROM observation_event e
+        JOIN event_weight ow ON ow.event_key = e.event_key
+        WHERE e.device_id = ? AND e.observed_ms >= ? AND e.observed_ms < ?
+            AND e.obs_kind = 'weight' AND e.is_valid = 1 AND e.superseded_by IS NULL
+        ORDER BY e.observed_ms
+        """,
+        (device_id, start_ms, end_ms),
+    ).fetchall()
+    return _with_archive(conn, device_id, "weight", "body_mass_kg", start_ms, end_ms,
+                         *_arrays(rows))
+
+
+def load_steps(conn, device_id, start_ms, end_ms):
+    """
+    steps added per sample in every step_mode (see api/steps.py)
+    """
+    rows = conn.execute(
+        """
+        SELECT observed_ms, step_delta FROM steps_normalized
+        WHERE device_id = ? AND observed_ms >= ? AND observed_ms < ?
+        ORDER BY observed_ms
+        """,
+        (device_id, start_ms, end_ms),
+    ).fetchall()
+    return _with_archive(conn, device_id, "steps", "step_delta", start_ms, end_ms,
+                         *_arrays(rows))
+
+
+def load_sleep(conn, device_id, start_ms, end_ms):
+    """
+    (start time, asleep hours) per sleep session (see api/sleep.py), so
+    a night counts in the window it started in
+    """
+    rows = conn.execute(
+        """
+        SELECT start_ms, asleep_ms FROM sleep_session
+        WHERE device_id = ? AND end_ms >= ? AND start_ms >= ? AND start_ms < ?
+        ORDER BY start_ms
+        """,
+        (device_id, start_ms, start_ms, end_ms),
+    ).fetchall()
+    t, v = _arrays(rows)
+    return t, v / sleep.HOUR_MS
+
+
+LOADERS = {
+    "weight": load_weight,
+    "steps": load_steps,
+    "sleep": load_sleep,
+}
+
+
+def _arrays(rows):
+    n = len(rows)
+    t = np.fromiter((r[0] for r in rows), dtype=np.int64, count=n)
+    v = np.fromiter((r[1] for r in rows), dtype=np.float64, count=n)
+    return t, v
+
+
+def window_sums(t, v, starts, ends):
+    """
+    (sum of v, count) per [start, end) window, via prefix sums
+    """
+    csum = np.concatenate(([0.0], np.cumsum(v)))
+    lo = np.searchsorted(t, starts, side="left")
+    hi = np.searchsorted(t, ends, side="left")
+    return csum[hi] - csum[lo], hi - lo
+
+
+def sample_days(t, starts, ends):
+    """
+    number of distinct days with at least one sample per window
+    """
+    if len(t) == 0:
+        return np.zeros(len(starts), dtype=np.int64)
+    origin = ends[-1]
+    days = np.unique((t - origin) // DAY_MS)
+    lo = np.searchsorted(days, (starts - origin) // DAY_MS, side="left")
+    hi = np.searchsorted(days, (ends - 1 - origin) // DAY_MS, side="right")
+    return hi - lo
+
+
+def _rolling_mean(t, v, starts, ends):
+    total, n = window_sums(t, v, starts, ends)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(n > 0, total / n, np.nan)
+
+
+def _rolling_slope(t, v, starts, ends):
+    """
+    least-squares slope in kg/day over each window
+    """
+    x = (t - ends[-1]) / DAY_MS
+    sx, n = window_sums(t, x, starts, ends)
+    sy, _ = window_sums(t, v, starts, ends)
+    sxx, _ = window_sums(t, x * x, starts, ends)
+    sxy, _ = window_sums(t, x * v, starts, ends)
+    denom = n * sxx - sx * sx
+    with np.errstate(invalid="ignore", divide="ignore"):
+        slope = (n * sxy - sx * sy) / denom
+    return np.where((n >= 2) & (np.abs(denom) > 1e-12), slope, np.nan)
+
+
+def _window_total(t, v, starts, ends):
+    total, n = window_sums(t, v, starts, ends)
+    return np.where(n > 0, total, np.nan)
+
+
+for _days in (7, 14, 30):
+    metric(f"weight_mean_{_days}d", "weight", _days, "kg",
+           f"Mean body mass over the last {_days} days")(_rolling_mean)
+    metric(f"weight_slope_{_days}d", "weight", _days, "kg/day",
+           f"Least-squares body mass trend over the last {_days} days")(_rolling_slope)
+
+metric("steps_daily_total", "steps", 1, "count",
+       "Steps walked during the local day")(_window_total)
+
+metric("sleep_duration", "sleep", 1, "h",
+       "Hours asleep in the 24h ending at local noon",
+       end_offset_ms=12 * HOUR_MS)(_window_total)
+
+
+def parse_watermark(text: str | None) -> dict:
+    """
+    metric_def.watermark is a JSON {device_id: ms}; a bare number (e.g.
+    a hand-inserted '0') applies to every device
+    """
+    try:
+        value = json.loads(text) if text else {}
+    except ValueError:
+        return {}
+    if isinstance(value, dict):
+        return value
+    if isinstance(value, (int, float)):
+        return {"*": int(value)}
+    return {}
+
+
+def ensure_defs(conn: sqlite3.Connection):
+    conn.executemany(
+        """
+        INSERT OR IGNORE INTO metric_def
+        (metric_id, metric_name, watermark, unit, description)
+        values(?,?,?,?,?)
+        """,
+        [(s.metric_id, s.metric_id, "{}", s.unit, s.description) for s in REGISTRY.values()],
+    )
+
+
+def devices(conn: sqlite3.Connection) -> list[str]:
+    return [r[0] for r in conn.execute(
+        "SELECT DISTINCT device_id FROM rollup WHERE grain = 'week'"
+    )]
+
+
+SESSION_START_SQL = """
+SELECT MIN(start_ms) FROM sleep_session
+WHERE device_id = ? AND end_ms >= ? AND start_ms <= ?
+"""
+
+OLD_VALUES_SQL = """
+SELECT v.metric_value_id, v.value_real, r.missing_data_ratio
+FROM metric_value v
+LEFT JOIN metric_run r ON r.metric_value_id = v.metric_value_id
+WHERE v.metric_value_id IN ({marks})
+"""
+
+
+def session_start(conn, device_id: str, lo: int, hi: int) -> int | None:
+    """
+    start of the earliest sleep session overlapping [lo, hi]; a night
+    counts in the window it started in
+    """
+    return conn.execute(SESSION_START_SQL, (device_id, lo, hi)).fetchone()[0]
+
+
+def dirty_spans(conn: sqlite3.Connection) -> tuple[dict[str, list[list[int]]], int | None]:
+    """
+    device_id -> merged [start_ms, end_ms) runs of metric_dirty days, and
+    the last mark id read
+    """
+    spans: dict[str, list[list[int]]] = {}
+    last = None
+    for mark_id, device_id, day_ms in conn.execute(
+        "SELECT id, device_id, day_ms FROM metric_dirty ORDER BY device_id, day_ms"
+    ):
+        last = mark_id if last is None else max(last, mark_id)
+        runs = spans.setdefault(device_id, [])
+        if runs and day_ms <= runs[-1][1]:
+            runs[-1][1] = max(runs[-1][1], day_ms + DAY_MS)
+        else:
+            runs.append([day_ms, day_ms + DAY_MS])
+    return spans, last
+
+
+def window_ends(conn, spec: MetricSpec, device_id: str, after_ms: int | None,
+                until_ms: int) -> np.ndarray:
+    """
+    local day boundaries (+ spec offset) in (after_ms, until_ms]
+    """
+    tz = rollups.device_timezone(conn, device_id)
+    if after_ms is None:
+        row = conn.execute(
+            "SELECT MIN(bucket_start_ms) FROM rollup WHERE device_id = ? AND grain = 'day'",
+            (device_id,),
+        ).fetchone()
+        if row[0] is None:
+            return np.empty(0, dtype=np.int64)
+        after_ms = row[0] + spec.end_offset_ms
+    ends = []
+    start, end, _ = rollups.bucket_bounds(after_ms - spec.end_offset_ms, tz, "day")
+    while end + spec.end_offset_ms <= until_ms:
+        if end + spec.end_offset_ms > after_ms:
+            ends.append(end + spec.end_offset_ms)
+        start, end, _ = rollups.bucket_bounds(end, tz, "day")
+    return np.array(ends, dtype=np.int64)
+
+
+def compute_windows(conn, spec: MetricSpec, device_id: str, ends: np.ndarray):
+    """
+    (metric_value rows, metric_run rows) for the windows ending at ends
+    """
+    if len(ends) == 0:
+        return [], []
+    starts = ends - spec.window_ms
+    t, v = LOADERS[spec.source](conn, device_id, int(starts[0]), int(ends[-1]))
+    values = spec.fn(t, v, starts, ends)
+    covered = sample_days(t, starts, ends)
+    missing = 1.0 - np.minimum(covered / spec.window_days, 1.0)
+
+    computed_at = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    value_rows, run_rows = [], []
+    ok = ~np.isnan(values)
+    for ws, we, val, miss in zip(starts[ok].tolist(), ends[ok].tolist(),
+                                 values[ok].tolist(), missing[ok].tolist()):
+        mv_id = str(uuid.uuid5(METRIC_NAMESPACE, f"{spec.metric_id}|{device_id}|{ws}|{we}"))
+        value_rows.append((mv_id, spec.metric_id, device_id, ws, we, computed_at, val))
+        run_rows.append((mv_id, round(1.0 - miss, 4), round(miss, 4), LOGIC_VERSION,
+                         json.dumps({"window_days": spec.window_days, "source": spec.source})))
+    return value_rows, run_rows
+
+
+class MetricBatch:
+    def __init__(self):
+        self.values: list[tuple] = []
+        self.runs: list[tuple] = []
+        # metric_value_ids whose window no longer has any data
+        self.stale: list[str] = []
+        # metric_id -> {device_id: new watermark}
+        self.watermarks: dict[str, dict] = {}
+        # recomputed metric_value_ids whose decisions no longer hold
+        self.changed: list[str] = []
+        # last metric_dirty id this batch covers
+        self.dirty_id: int | None = None
+        # set by write()
+        self.decisions_cleared = 0
+
+    def __len__(self):
+        return len(self.values) + len(self.stale)
+
+
+def compute(conn: sqlite3.Connection, now_ms: int | None = None,
+            metric_ids=None) -> MetricBatch:
+    """
+    read-only half of a run: everything past each watermark, as one batch
+    """
+    now_ms = int(time.time() * 1000) if now_ms is None else now_ms
+    batch = MetricBatch()
+    stored = {r[0]: parse_watermark(r[1]) for r in conn.execute(
+        "SELECT metric_id, watermark FROM metric_def"
+    )}
+    device_ids = devices(conn)
+    for spec in REGISTRY.values():
+        if metric_ids is not None and spec.metric_id not in metric_ids:
+            continue
+        marks = stored.get(spec.metric_id, {})
+        for device_id in device_ids:
+            after = marks.get(device_id, marks.get("*"))
+            ends = window_ends(conn, spec, device_id, after, now_ms)
+            if len(ends) == 0:
+                continue
+            values, runs = compute_windows(conn, spec, device_id, ends)
+            batch.values.extend(values)
+            batch.runs.extend(runs)
+            batch.watermarks.setdefault(spec.metric_id, {})[device_id] = int(ends[-1])
+    if metric_ids is None:
+        # the marks are shared by every metric, so only a full run takes them
+        late = recompute_dirty(conn)
+        batch.values.extend(late.values)
+        batch.runs.extend(late.runs)
+        batch.stale.extend(late.stale)
+        batch.changed = late.changed
+        batch.dirty_id = late.dirty_id
+    return batch
+
+
+def recompute_dirty(conn: sqlite3.Connection) -> MetricBatch:
+    """
+    the windows already reached over the metric_dirty days, changed ones only
+    """
+    spans, dirty_id = dirty_spans(conn)
+    batch = MetricBatch()
+    batch.dirty_id = dirty_id
+    for device_id, runs in spans.items():
+        for lo, hi in runs:
+            start = session_start(conn, device_id, lo, hi)
+            part = recompute(conn, device_id, lo if start is None else min(lo, start), hi)
+            batch.values.extend(part.values)
+            batch.runs.extend(part.runs)
+            batch.stale.extend(part.stale)
+    changed_only(conn, batch)
+    return batch
+
+
+def _same(old, new) -> bool:
+    # sums over a differently sized load differ in the last bits
+    return old is not None and all(
+        a == b or (a is not None and b is not None and math.isclose(a, b, rel_tol=1e-9, abs_tol=1e-12))
+        for a, b in zip(old, new)
+    )
+
+
+def changed_only(conn: sqlite3.Connection, batch: MetricBatch) -> list[str]:
+    """
+    drop recomputed values and runs that match what is stored (and
+    repeats); sets and returns batch.changed, stale ids included
+    """
+    runs = {row[0]: row for row in batch.runs}
+    values = {row[0]: row for row in batch.values}
+    ids = list(values)
+    old = {}
+    for i in range(0, len(ids), LOOKUP_CHUNK):
+        part = ids[i:i + LOOKUP_CHUNK]
+        old.update((mv_id, (value, missing)) for mv_id, value, missing in conn.execute(
+            OLD_VALUES_SQL.format(marks=",".join("?" * len(part))), part
+        ))
+    keep = [mv_id for mv_id in ids
+            if not _same(old.get(mv_id), (values[mv_id][6], runs[mv_id][2]))]
+    batch.values = [values[mv_id] for mv_id in keep]
+    batch.runs = [runs[mv_id] for mv_id in keep]
+    batch.stale = list(dict.fromkeys(batch.stale))
+    batch.changed = keep + batch.stale
+    return batch.changed
+
+
+def recompute(conn: sqlite3.Connection, device_id: str, start_ms: int, end_ms: int,
+              metric_ids=None) -> MetricBatch:
+    """
+    recompute the windows of device_id overlapping [start_ms, end_ms)
+    that runs have already reached (up to the watermark), including ones
+    that had no value before; watermarks are left alone
+    """
+    stored = {r[0]: parse_watermark(r[1]) for r in conn.execute(
+        "SELECT metric_id, watermark FROM metric_def"
+    )}
+    batch = MetricBatch()
+    for spec in REGISTRY.values():
+        if metric_ids is not None and spec.metric_id not in metric_ids:
+            continue
+        marks = stored.get(spec.metric_id, {})
+        mark = marks.get(device_id, marks.get("*"))
+        if mark is None:
+            # never run for this device; the next run covers it
+            continue
+        # ends in (start_ms, end_ms + window): the windows overlapping the span
+        ends = window_ends(conn, spec, device_id, start_ms,
+                           min(mark, end_ms + spec.window_ms - 1))
+        values, runs = compute_windows(conn, spec, device_id, ends)
+        batch.values.extend(values)
+        batch.runs.extend(runs)
+        # stored windows that lost all their data (or no longer line up
+        # with a local day after a timezone change)
+        written = {r[0] for r in values}
+        batch.stale.extend(mv_id for (mv_id,) in conn.execute(
+            """
+            SELECT metric_value_id FROM metric_value
+            WHERE device_id = ? AND metric_id = ?
+                AND window_start_ms < ? AND window_end_ms > ? AND window_end_ms <= ?
+            """,
+            (device_id, spec.metric_id, end_ms, start_ms, mark),
+        ) if mv_id not in written)
+    return batch
+
+
+def lagged(conn: sqlite3.Connection, batch: MetricBatch) -> list[str]:
+    """
+    metric_value_ids of the stored windows whose trend rules read a changed
+    one as their earlier window (decisions.previous_values): those ending
+    lag_ms after it, give or take decisions.NEAREST_MS
+    """
+    lags = decisions.trend_lags(conn) if batch.changed else {}
+    if not lags:
+        return []
+    windows = {r[0]: (r[1], r[2], r[3], r[4]) for r in batch.values}
+    # stale windows are still stored, as write() has not run yet
+    stale = [mv_id for mv_id in batch.changed if mv_id not in windows]
+    for i in range(0, len(stale), LOOKUP_CHUNK):
+        part = stale[i:i + LOOKUP_CHUNK]
+        windows.update((r[0], r[1:]) for r in conn.execute(
+            f"""
+            SELECT metric_value_id, metric_id, device_id, window_start_ms, window_end_ms
+            FROM metric_value WHERE metric_value_id IN ({','.join('?' * len(part))})
+            """, part
+        ))
+    out = {}
+    for mv_id in batch.changed:
+        if mv_id not in windows:
+            continue
+        metric_id, device_id, start_ms, end_ms = windows[mv_id]
+        for lag in lags.get(metric_id, ()):
+            # the start bound only narrows the index range; the end decides
+            out.update(dict.fromkeys(mv for (mv,) in conn.execute(
+                """
+                SELECT metric_value_id FROM metric_value
+                WHERE device_id = ? AND window_start_ms BETWEEN ? AND ?
+                    AND window_end_ms > ? AND window_end_ms < ? AND metric_id = ?
+                """,
+                (device_id, start_ms + lag - DAY_MS, start_ms + lag + DAY_MS,
+                 end_ms + lag - decisions.NEAREST_MS, end_ms + lag + decisions.NEAREST_MS,
+                 metric_id),
+            )))
+    changed = set(batch.changed)
+    return [mv_id for mv_id in out if mv_id not in changed]
+
+
+def write(conn: sqlite3.Connection, batch: MetricBatch) -> int:
+    """
+    write half of a run, inside the caller's transaction
+    """
+    ensure_defs(conn)
+    batch.decisions_cleared = 0
+    cleared = batch.changed + lagged(conn, batch)
+    for i in range(0, len(cleared), LOOKUP_CHUNK):
+        part = cleared[i:i + LOOKUP_CHUNK]
+        batch.decisions_cleared += conn.execute(
+            f"DELETE FROM decision_run WHERE metric_value_id IN ({','.join('?' * len(part))})", part
+        ).rowcount
+    conn.executemany(
+        "DELETE FROM metric_value WHERE metric_value_id = ?",
+        [(mv_id,) for mv_id in batch.stale],
+    )
+    conn.executemany(
+        """
+        INSERT INTO metric_value
+        (metric_value_id, metric_id, device_id, window_start_ms, window_end_ms,
+        computed_at, value_real) values(?,?,?,?,?,?,?)
+        ON CONFLICT(metric_value_id) DO UPDATE SET
+            computed_at = excluded.computed_at,
+            value_real = excluded.value_real
+        """,
+        batch.values,
+    )
+    conn.executemany(
+        """
+        INSERT INTO metric_run
+        (metric_value_id, confidence_score, missing_data_ratio, is_imputed,
+        logic_version, details_json) values(?,?,?,0,?,?)
+        ON CONFLICT(metric_value_id) DO UPDATE SET
+            confidence_score = excluded.confidence_score,
+            missing_data_ratio = excluded.missing_data_ratio,
+            logic_version = excluded.logic_version,
+            details_json = excluded.details_json
+        """,
+        batch.runs,
+    )
+    for metric_id, marks in batch.watermarks.items():
+        row = conn.execute(
+            "SELECT watermark FROM metric_def WHERE metric_id = ?", (metric_id,)
+        ).fetchone()
+        merged = parse_watermark(row[0] if row else None)
+        for device_id, ms in marks.items():
+            merged[device_id] = max(ms, merged.get(device_id, ms))
+        conn.execute(
+            "UPDATE metric_def SET watermark = ? WHERE metric_id = ?",
+            (json.dumps(merged, sort_keys=True), metric_id),
+        )
+    if batch.dirty_id is not None:
+        conn.execute("DELETE FROM metric_dirty WHERE id <= ?", (batch.dirty_id,))
+    return len(batch.values)
+
+
+def run(conn: sqlite3.Connection, now_ms: int | None = None) -> int:
+    """
+    compute and write on one connection (CLI / scripts)
+    """
+    batch = compute(conn, now_ms)
+    with conn:
+        return write(conn, batch)
+
+
+def main(argv=None):
+    from . import db
+
+    conn = db.connect()
+    try:
+        n = run(conn)
+        print(f"metric engine: {n} metric values written")
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
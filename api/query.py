@@ -0,0 +1,327 @@
+"""
+Read endpoints over observations, fused minutes, metric values and decisions.
+
+Pages are keyset-paginated: the cursor is the sort key of the last row
+returned, so every page is an index range scan (idx_event_device_ms /
+idx_event_kind_ms for observations) instead of an OFFSET walk.
+format=ndjson or format=arrow streams the whole range page by page
+without ever holding it in memory. /observations also pages through
+archived months (api/archive.py), merged in on the same key.
+"""
+import base64
+import io
+import json
+import sqlite3
+from typing import Optional
+
+from fastapi import APIRouter, HTTPException, Query
+from fastapi.responses import StreamingResponse
+
+from . import archive, db
+
+
+router = APIRouter()
+
+PAGE_SIZE = 1000
+STREAM_PAGE_SIZE = 5000
+MAX_PAGE_SIZE = 10000
+
+MIN_MS = -(2**62)
+MAX_MS = 2**62
+
+
+class Resource:
+    """
+    one pageable result set.
+
+    select: SELECT ... FROM ... with a {where} placeholder
+    key: the ORDER BY columns; the last one must be unique
+    columns: (name, type) for every selected column, type in str/int/float
+    """
+
+    def __init__(self, select: str, key: list[str], columns: list[tuple[str, str]]):
+        self.select = select
+        self.key = key
+        self.columns = columns
+
+    def page(self, conn: sqlite3.Connection, where: list[str], params: list,
+             after: list | None, limit: int) -> tuple[list[dict], list | None]:
+        where = list(where)
+        params = list(params)
+        if after is not None:
+            # (k1, k2) > (a1, a2), spelled out so the planner keeps the
+            # range on the leading index column
+            where.append(f"{self.key[0]} >= ?")
+            params.append(after[0])
+            where.append(f"({', '.join(self.key)}) > ({', '.join('?' * len(self.key))})")
+            params.extend(after)
+        sql = self.select.format(where=" AND ".join(where) or "1")
+        sql += f" ORDER BY {', '.join(self.key)} LIMIT ?"
+        params.append(limit + 1)
+
+        cur = conn.execute(sql, params)
+        names = [d[0] for d in cur.description]
+        rows = [dict(zip(names, r)) for r in cur.fetchall()]
+        if len(rows) <= limit:
+            return rows, None
+        rows = rows[:limit]
+        last = rows[-1]
+        return rows, [last[k.split(".")[-1]] for k in self.key]
+
+
+OBSERVATIONS = Resource(
+    """
+    SELECT e.event_id, e.device_id, e.observed_at, e.observed_ms, e.obs_kind,
+        e.is_valid, e.superseded_by, e.note,
+        ow.body_mass_kg, os.step_value, os.step_mode, ss.state,
+        p.source_kind, p.app_version, p.ingested_at
+    FROM observation_event e
+    LEFT JOIN event_weight ow ON ow.event_key = e.event_key
+    LEFT JOIN event_steps os ON os.event_key = e.event_key
+    LEFT JOIN event_sleep_state ss ON ss.event_key = e.event_key
+    LEFT JOIN event_provenance p ON p.event_key = e.event_key
+    WHERE {where}
+    """,
+    ["e.observed_ms", "e.event_id"],
+    [("event_id", "str"), ("device_id", "str"), ("observed_at", "str"),
+     ("observed_ms", "int"), ("obs_kind", "str"), ("is_valid", "int"),
+     ("superseded_by", "str"), ("note", "str"), ("body_mass_kg", "float"),
+     ("step_value", "int"), ("step_mode", "str"), ("state", "str"),
+     ("source_kind", "str"), ("app_version", "str"), ("ingested_at", "str")],
+)
+
+class Tiered(Resource):
+    """
+    a Resource whose rows can also sit in the cold tier: each page merges
+    the live page with the same number of archived rows (archive.scan,
+    called with the cursor and the page size) on the sort key
+    """
+
+    def __init__(self, base: Resource, scan):
+        super().__init__(base.select, base.key, base.columns)
+        self.scan = scan
+
+    def page(self, conn, where, params, after, limit):
+        rows, next_key = super().page(conn, where, params, after, limit)
+        archived = self.scan(conn, after, limit + 1)
+        if not archived:
+            return rows, next_key
+        names = [name for name, _ in self.columns]
+        keys = [k.split(".")[-1] for k in self.key]
+        merged = sorted(rows + [{n: r[n] for n in names} for r in archived],
+                        key=lambda r: [r[k] for k in keys])
+        more = next_key is not None or len(merged) > limit
+        rows = merged[:limit]
+        return rows, [rows[-1][k] for k in keys] if more else None
+
+
+FUSED_MINUTE = Resource(
+    """
+    SELECT device_id, minute_bucket, minute_start_utc, body_mass_01,
+        steps_delta_sum, step_cum_last
+    FROM fused_minute
+    WHERE {where}
+    """,
+    ["minute_bucket"],
+    [("device_id", "str"), ("minute_bucket", "int"), ("minute_start_utc", "str"),
+     ("body_mass_01", "float"), ("steps_delta_sum", "int"), ("step_cum_last", "int")],
+)
+
+METRIC_VALUES = Resource(
+    """
+    SELECT mv.metric_value_id, mv.metric_id, mv.device_id, mv.window_start_ms,
+        mv.window_end_ms, mv.computed_at, mv.value_real, mv.value_int, mv.value_text,
+        mr.confidence_score, mr.missing_data_ratio, mr.is_imputed, mr.logic_version
+    FROM metric_value mv
+    LEFT JOIN metric_run mr ON mr.metric_value_id = mv.metric_value_id
+    WHERE {where}
+    """,
+    ["mv.window_start_ms", "mv.metric_value_id"],
+    [("metric_value_id", "str"), ("metric_id", "str"), ("device_id", "str"),
+     ("window_start_ms", "int"), ("window_end_ms", "int"), ("computed_at", "str"),
+     ("value_real", "float"), ("value_int", "int"), ("value_text", "str"),
+     ("confidence_score", "float"), ("missing_data_ratio", "float"),
+     ("is_imputed", "int"), ("logic_version", "str")],
+)
+
+DECISIONS = Resource(
+    """
+    SELECT dr.decision_run_id, dr.metric_value_id, dr.computed_at, dr.policy_version,
+        mv.metric_id, mv.device_id, mv.window_start_ms, mv.window_end_ms,
+        res.reversible, res.explain, res.action, res.msg, res.notify
+    FROM metric_value mv
+    JOIN decision_run dr ON dr.metric_value_id = mv.metric_value_id
+    LEFT JOIN decision_result res ON res.decision_run_id = dr.decision_run_id
+    WHERE {where}
+    """,
+    ["mv.window_start_ms", "dr.decision_run_id"],
+    [("decision_run_id", "str"), ("metric_value_id", "str"), ("computed_at", "str"),
+     ("policy_version", "str"), ("metric_id", "str"), ("device_id", "str"),
+     ("window_start_ms", "int"), ("window_end_ms", "int"), ("reversible", "int"),
+     ("explain", "str"), ("action", "str"), ("msg", "str"), ("notify", "int")],
+)
+
+
+def encode_cursor(key: list | None) -> str | None:
+    if key is None:
+        return None
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def decode_cursor(cursor: str | None, resource: Resource) -> list | None:
+    if not cursor:
+        return None
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    # one scalar per key column, or SQLite rejects the comparison with a 500
+    if not isinstance(key, list) or len(key) != len(resource.key) \
+            or not all(isinstance(k, (str, int, float)) for k in key):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return key
+
+
+def _iter_pages(resource: Resource, where, params, after, limit: int | None):
+    remaining = limit
+    while True:
+        size = STREAM_PAGE_SIZE if remaining is None else min(STREAM_PAGE_SIZE, remaining)
+        if size <= 0:
+            return
+        # a fresh checkout per page, so a slow client never pins a reader
+        with db.readers.reader() as conn:
+            rows, after = resource.page(conn, where, params, after, size)
+        if rows:
+            yield rows
+        if remaining is not None:
+            remaining -= len(rows)
+        if after is None:
+            return
+
+
+def _ndjson(resource, where, params, after, limit):
+    for rows in _iter_pages(resource, where, params, after, limit):
+        yield "".join(json.dumps(r) + "\n" for r in rows).encode()
+
+
+def _arrow_schema(resource: Resource):
+    import pyarrow as pa
+
+    types = {"str": pa.string(), "int": pa.int64(), "float": pa.float64()}
+    return pa.schema([(name, types[kind]) for name, kind in resource.columns])
+
+
+def _arrow(resource, where, params, after, limit):
+    import pyarrow as pa
+
+    schema = _arrow_schema(resource)
+    sink = io.BytesIO()
+    writer = pa.ipc.new_stream(sink, schema)
+
+    def drain():
+        data = sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+        return data
+
+    yield drain()
+    for rows in _iter_pages(resource, where, params, after, limit):
+        writer.write_batch(pa.RecordBatch.from_pylist(rows, schema=schema))
+        yield drain()
+    writer.close()
+    yield drain()
+
+
+async def respond(resource: Resource, where: list[str], params: list,
+                  cursor: str | None, limit: int | None, format: str):
+    after = decode_cursor(cursor, resource)
+    if format == "json":
+        size = min(limit or PAGE_SIZE, MAX_PAGE_SIZE)
+        rows, next_key = await db.run_read(resource.page, where, params, after, size)
+        return {"rows": rows, "next_cursor": encode_cursor(next_key)}
+    if format == "ndjson":
+        return StreamingResponse(
+            _ndjson(resource, where, params, after, limit),
+            media_type="application/x-ndjson",
+        )
+    if format == "arrow":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise HTTPException(status_code=406, detail="format=arrow needs pyarrow installed")
+        return StreamingResponse(
+            _arrow(resource, where, params, after, limit),
+            media_type="application/vnd.apache.arrow.stream",
+        )
+    raise HTTPException(status_code=400, detail="format must be json, ndjson or arrow")
+
+
+@router.get("/observations")
+async def get_observations(device_id: Optional[str] = None, obs_kind: Optional[str] = None,
+                           start_ms: Optional[int] = None, end_ms: Optional[int] = None,
+                           valid_only: bool = False, cursor: Optional[str] = None,
+                           limit: Optional[int] = Query(None, ge=1), format: str = "json"):
+    if device_id is None and obs_kind is None:
+        raise HTTPException(status_code=400, detail="device_id or obs_kind is required")
+    where = ["e.observed_ms >= ?", "e.observed_ms < ?"]
+    params: list = [start_ms if start_ms is not None else MIN_MS,
+                    end_ms if end_ms is not None else MAX_MS]
+    if device_id is not None:
+        where.append("e.device_id = ?")
+        params.append(device_id)
+    if obs_kind is not None:
+        where.append("e.obs_kind = ?")
+        params.append(obs_kind)
+    if valid_only:
+        where.append("e.is_valid = 1 AND e.superseded_by IS NULL")
+
+    def scan(conn, after, size):
+        return archive.scan(conn, device_id, obs_kind, params[0], params[1],
+                            valid_only, after, size)
+
+    return await respond(Tiered(OBSERVATIONS, scan), where, params, cursor, limit, format)
+
+
+@router.get("/fused_minute")
+async def get_fused_minute(device_id: str, start_ms: Optional[int] = None,
+                           end_ms: Optional[int] = None, cursor: Optional[str] = None,
+                           limit: Optional[int] = Query(None, ge=1), format: str = "json"):
+    where = ["device_id = ?", "minute_bucket >= ?", "minute_bucket < ?"]
+    params = [device_id,
+              (start_ms if start_ms is not None else MIN_MS) // 60000,
+              -(-(end_ms if end_ms is not None else MAX_MS) // 60000)]
+    return await respond(FUSED_MINUTE, where, params, cursor, limit, format)
+
+
+@router.get("/metric_values")
+async def get_metric_values(device_id: str, metric_id: Optional[str] = None,
+                            start_ms: Optional[int] = None, end_ms: Optional[int] = None,
+                            cursor: Optional[str] = None, limit: Optional[int] = Query(None, ge=1),
+                            format: str = "json"):
+    where = ["mv.device_id = ?", "mv.window_start_ms >= ?", "mv.window_start_ms < ?"]
+    params: list = [device_id,
+                    start_ms if start_ms is not None else MIN_MS,
+                    end_ms if end_ms is not None else MAX_MS]
+    if metric_id is not None:
+        where.append("mv.metric_id = ?")
+        params.append(metric_id)
+    return await respond(METRIC_VALUES, where, params, cursor, limit, format)
+
+
+@router.get("/decisions")
+async def get_decisions(device_id: str, metric_id: Optional[str] = None,
+                        policy_version: Optional[str] = None,
+                        start_ms: Optional[int] = None, end_ms: Optional[int] = None,
+                        cursor: Optional[str] = None, limit: Optional[int] = Query(None, ge=1),
+                        format: str = "json"):
+    where = ["mv.device_id = ?", "mv.window_start_ms >= ?", "mv.window_start_ms < ?"]
+    params: list = [device_id,
+                    start_ms if start_ms is not None else MIN_MS,
+                    end_ms if end_ms is not None else MAX_MS]
+    if metric_id is not None:
+        where.append("mv.metric_id = ?")
+        params.append(metric_id)
+    if policy_version is not None:
+        where.append("dr.policy_version = ?")
+        params.append(policy_version)
+    return await respond(DECISIONS, where, params, cursor, limit, format)
@@ -0,0 +1,464 @@
+"""
+Weekly and monthly reports, materialised from per-day partials.
+
+report_day holds one row per device and local day with everything a
+report needs from that day: weight first/last/min/max/sum/count, steps
+walked, sleep (a night counts on the day it ends, like sleep_duration),
+observations left out as invalid or superseded, and the day's alerts
+(decision_results other than 'none' under config.POLICY_VERSION for
+metric windows ending that day). A report is rendered from the partials
+of its days only and stored in report with a content hash.
+
+compute() finds the days that changed since the marks in report_state:
+- observations whose event_provenance.ingested_at is past the mark
+  (rescanned with OVERLAP, like sync/delta.py; an observation arriving
+  with an ingested_at older than that is only seen by rebuild())
+- is_valid / superseded_by changes logged in observation_change
+- metric_value and decision_run rows computed since the last build
+It recomputes the partials of those days, re-renders the weeks and
+months holding them, and writes only reports whose hash changed. When
+no mark has moved, a build is four index probes.
+
+    python -m api.reports build
+    python -m api.reports rebuild [device_id]
+    python -m api.reports show <device_id> [week|month]
+"""
+import hashlib
+import json
+import sqlite3
+import sys
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+import numpy as np
+
+from . import config, metrics, rollups
+
+
+DAY_MS = 86_400_000
+HOUR_MS = 3_600_000
+PERIODS = ("week", "month")
+
+OVERLAP = timedelta(minutes=5)
+
+# dirty points are collapsed to UTC quarter-hours before the day lookup;
+# UTC offsets are multiples of 15 minutes, so a quarter never spans two days
+QUARTER_MS = 900_000
+
+MARKS_SQL = """
+SELECT
+    (SELECT MAX(ingested_at) FROM event_provenance),
+    (SELECT MAX(seq) FROM observation_change),
+    (SELECT MAX(computed_at) FROM metric_value),
+    (SELECT MAX(computed_at) FROM decision_run)
+"""
+
+# (device_id, quarter) of everything that moved past the marks
+DIRTY_SQL = """
+SELECT DISTINCT e.device_id, e.observed_ms / 900000
+FROM event_provenance p
+JOIN observation_event e ON e.event_key = p.event_key
+WHERE p.ingested_at > ?
+UNION
+SELECT DISTINCT e.device_id, e.observed_ms / 900000
+FROM observation_change c
+JOIN observation_event e ON e.event_id = c.event_id
+WHERE c.seq > ?
+UNION
+SELECT DISTINCT device_id, (window_end_ms - 1) / 900000
+FROM metric_value
+WHERE computed_at > ?
+UNION
+SELECT DISTINCT v.device_id, (v.window_end_ms - 1) / 900000
+FROM decision_run d
+JOIN metric_value v ON v.metric_value_id = d.metric_value_id
+WHERE d.computed_at > ?
+"""
+
+ALERTS_SQL = """
+SELECT v.window_end_ms, v.metric_id, r.action, r.msg, r.notify
+FROM metric_value v
+JOIN decision_run d ON d.metric_value_id = v.metric_value_id
+JOIN decision_result r ON r.decision_run_id = d.decision_run_id
+WHERE v.device_id = ? AND v.window_start_ms >= ? AND v.window_start_ms < ?
+    AND v.window_end_ms > ? AND v.window_end_ms <= ?
+    AND d.policy_version = ? AND r.action IS NOT 'none'
+ORDER BY v.window_end_ms, v.metric_id
+"""
+
+EXCLUDED_SQL = """
+SELECT observed_ms FROM observation_event
+WHERE device_id = ? AND observed_ms >= ? AND observed_ms < ?
+    AND (is_valid = 0 OR superseded_by IS NOT NULL)
+ORDER BY observed_ms
+"""
+
+DAY_COLUMNS = (
+    "device_id", "day_start_ms", "day_end_ms", "day_label",
+    "weight_first", "weight_last", "weight_min", "weight_max", "weight_sum", "weight_count",
+    "steps_total", "sleep_hours", "sleep_nights", "excluded_count", "alerts_json",
+)
+
+# longest metric window, for the alert lookup's index range
+MAX_WINDOW_MS = max((s.window_ms for s in metrics.REGISTRY.values()), default=DAY_MS)
+
+
+def _to_ms(dt: datetime) -> int:
+    return int(dt.timestamp() * 1000)
+
+
+def period_bounds(ms: int, tz: ZoneInfo, period: str) -> tuple[int, int, str]:
+    """
+    (start_ms, end_ms, label) of the local ISO week or calendar month holding ms
+    """
+    if period == "week":
+        return rollups.bucket_bounds(ms, tz, "week")
+    if period != "month":
+        raise ValueError(f"unknown period '{period}'")
+    local = datetime.fromtimestamp(ms / 1000, tz)
+    first = datetime(local.year, local.month, 1, tzinfo=tz)
+    following = datetime(local.year + local.month // 12, local.month % 12 + 1, 1, tzinfo=tz)
+    return _to_ms(first), _to_ms(following), f"{local.year}-{local.month:02d}"
+
+
+def _days(points, tz: ZoneInfo) -> list[tuple[int, int, str]]:
+    """
+    distinct local days holding the sorted ms points
+    """
+    out = []
+    for ms in points:
+        if out and out[-1][0] <= ms < out[-1][1]:
+            continue
+        out.append(rollups.bucket_bounds(ms, tz, "day"))
+    return out
+
+
+def _slices(t: np.ndarray, starts: np.ndarray, ends: np.ndarray):
+    return np.searchsorted(t, starts, side="left"), np.searchsorted(t, ends, side="left")
+
+
+def day_partials(conn: sqlite3.Connection, device_id: str, days: list[tuple]) -> list[tuple]:
+    """
+    report_day rows for the given (start_ms, end_ms, label) days, sorted;
+    days without any data come back as None
+    """
+    starts = np.array([d[0] for d in days], dtype=np.int64)
+    ends = np.array([d[1] for d in days], dtype=np.int64)
+    lo, hi = int(starts[0]), int(ends[-1])
+
+    wt, wv = metrics.load_weight(conn, device_id, lo, hi)
+    w_lo, w_hi = _slices(wt, starts, ends)
+    st, sv = metrics.load_steps(conn, device_id, lo, hi)
+    s_lo, s_hi = _slices(st, starts, ends)
+    s_cum = np.concatenate([[0.0], np.cumsum(sv)])
+    # a night belongs to the day it ends on: sessions starting from noon
+    # the day before up to noon on the day
+    zt, zv = metrics.load_sleep(conn, device_id, lo - 12 * HOUR_MS, hi - 12 * HOUR_MS)
+    z_lo, z_hi = _slices(zt, starts - 12 * HOUR_MS, ends - 12 * HOUR_MS)
+    z_cum = np.concatenate([[0.0], np.cumsum(zv)])
+    xt = np.array([r[0] for r in conn.execute(EXCLUDED_SQL, (device_id, lo, hi))], dtype=np.int64)
+    x_lo, x_hi = _slices(xt, starts, ends)
+
+    alerts: dict[int, list] = {}
+    for we, metric_id, action, msg, notify in conn.execute(
+        ALERTS_SQL, (device_id, lo - MAX_WINDOW_MS, hi, lo, hi, config.POLICY_VERSION)
+    ):
+        i = int(np.searchsorted(ends, we, side="left"))
+        if i < len(ends) and starts[i] < we:
+            alerts.setdefault(i, []).append(
+                {"metric_id": metric_id, "action": action, "msg": msg, "notify": bool(notify)}
+            )
+
+    rows = []
+    for i, (start, end, label) in enumerate(days):
+        wa, wb = int(w_lo[i]), int(w_hi[i])
+        sa, sb = int(s_lo[i]), int(s_hi[i])
+        za, zb = int(z_lo[i]), int(z_hi[i])
+        excluded = int(x_hi[i] - x_lo[i])
+        day_alerts = alerts.get(i, [])
+        if wa == wb and sa == sb and za == zb and not excluded and not day_alerts:
+            rows.append(None)
+            continue
+        w = wv[wa:wb]
+        rows.append((
+            device_id, start, end, label,
+            float(w[0]) if len(w) else None,
+            float(w[-1]) if len(w) else None,
+            float(w.min()) if len(w) else None,
+            float(w.max()) if len(w) else None,
+            float(w.sum()),
+            len(w),
+            int(round(s_cum[sb] - s_cum[sa])),
+            round(float(z_cum[zb] - z_cum[za]), 4),
+            zb - za,
+            excluded,
+            json.dumps(day_alerts, sort_keys=True),
+        ))
+    return rows
+
+
+def render(device_id: str, period: str, start_ms: int, end_ms: int, label: str,
+           tz: ZoneInfo, days: list[tuple]) -> tuple[str, str]:
+    """
+    (body_json, content_hash) of one report from its report_day rows
+    """
+    d = [dict(zip(DAY_COLUMNS, row)) for row in sorted(days, key=lambda r: r[1])]
+    weighed = [r for r in d if r["weight_count"]]
+    walked = [r for r in d if r["steps_total"]]
+    slept = [r for r in d if r["sleep_nights"]]
+    n_weights = sum(r["weight_count"] for r in weighed)
+    best = max(walked, key=lambda r: r["steps_total"], default=None)
+    steps_total = sum(r["steps_total"] for r in walked)
+    sleep_total = sum(r["sleep_hours"] for r in slept)
+    body = {
+        "device_id": device_id,
+        "period": period,
+        "label": label,
+        "start_ms": start_ms,
+        "end_ms": end_ms,
+        "timezone": tz.key,
+        "days_with_data": len(d),
+        "weight": {
+            "count": n_weights,
+            "first": weighed[0]["weight_first"] if weighed else None,
+            "last": weighed[-1]["weight_last"] if weighed else None,
+            "min": min((r["weight_min"] for r in weighed), default=None),
+            "max": max((r["weight_max"] for r in weighed), default=None),
+            "mean": round(sum(r["weight_sum"] for r in weighed) / n_weights, 4) if n_weights else None,
+            "change": round(weighed[-1]["weight_last"] - weighed[0]["weight_first"], 4) if weighed else None,
+        },
+        "steps": {
+            "total": steps_total,
+            "days": len(walked),
+            "daily_mean": round(steps_total / len(walked), 1) if walked else None,
+            "best_day": best["day_label"] if best else None,
+            "best_day_steps": best["steps_total"] if best else None,
+        },
+        "sleep": {
+            "nights": sum(r["sleep_nights"] for r in slept),
+            "total_hours": round(sleep_total, 4),
+            "mean_hours_per_day": round(sleep_total / len(slept), 4) if slept else None,
+        },
+        "excluded_observations": sum(r["excluded_count"] for r in d),
+        "alerts": [
+            dict(alert, day=r["day_label"]) for r in d for alert in json.loads(r["alerts_json"])
+        ],
+    }
+    text = json.dumps(body, sort_keys=True, separators=(",", ":"))
+    content_hash = hashlib.sha256(text.encode()).hexdigest()
+    body["content_hash"] = content_hash
+    return json.dumps(body, sort_keys=True, separators=(",", ":")), content_hash
+
+
+class ReportBatch:
+    def __init__(self, marks):
+        # new report_state marks; None leaves report_state alone
+        self.marks = marks
+        self.days: list[tuple] = []
+        # (device_id, day_start_ms) of days that no longer have any data
+        self.empty: list[tuple] = []
+        self.reports: list[tuple] = []
+
+    def __len__(self):
+        return len(self.days) + len(self.empty) + len(self.reports)
+
+
+def _state(conn: sqlite3.Connection):
+    return conn.execute(
+        "SELECT ingested_hwm, change_hwm, computed_hwm, decided_hwm FROM report_state WHERE id = 1"
+    ).fetchone()
+
+
+def _dirty_days(conn: sqlite3.Connection, state) -> dict[str, list[tuple]]:
+    ingested, change, computed, decided = state
+    try:
+        ingested = (datetime.fromisoformat(ingested) - OVERLAP).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+    except (TypeError, ValueError):
+        pass
+    quarters: dict[str, set] = {}
+    for device_id, quarter in conn.execute(
+        DIRTY_SQL, (ingested or "", change or 0, computed or "", decided or "")
+    ):
+        q = quarters.setdefault(device_id, set())
+        q.add(quarter)
+        # the next day too: a night that starts today is counted there
+        q.add(quarter + 12 * HOUR_MS // QUARTER_MS)
+    out = {}
+    for device_id, qs in quarters.items():
+        tz = rollups.device_timezone(conn, device_id)
+        out[device_id] = _days((q * QUARTER_MS for q in sorted(qs)), tz)
+    return out
+
+
+def _all_days(conn: sqlite3.Connection, device_id: str, now_ms: int) -> list[tuple]:
+    row = conn.execute(
+        """
+        SELECT MIN(ms) FROM (
+            SELECT MIN(bucket_start_ms) AS ms FROM rollup WHERE device_id = ? AND grain = 'day'
+            UNION ALL SELECT MIN(start_ms) FROM sleep_session WHERE device_id = ?
+            UNION ALL SELECT MIN(start_ms) FROM archive_segment WHERE device_id = ?
+        )
+        """,
+        (device_id, device_id, device_id),
+    ).fetchone()
+    if row[0] is None:
+        return []
+    tz = rollups.device_timezone(conn, device_id)
+    days = [rollups.bucket_bounds(row[0], tz, "day")]
+    while days[-1][1] <= now_ms:
+        days.append(rollups.bucket_bounds(days[-1][1], tz, "day"))
+    return days
+
+
+def _render_periods(conn: sqlite3.Connection, batch: ReportBatch, device_id: str,
+                    days: list[tuple], rows: list):
+    tz = rollups.device_timezone(conn, device_id)
+    fresh = {d[0]: row for d, row in zip(days, rows)}
+    periods = set()
+    for start, _, _ in days:
+        for period in PERIODS:
+            periods.add((period, *period_bounds(start, tz, period)))
+    for period, start_ms, end_ms, label in sorted(periods):
+        stored = {r[1]: r for r in conn.execute(
+            f"SELECT {', '.join(DAY_COLUMNS)} FROM report_day"
+            " WHERE device_id = ? AND day_start_ms >= ? AND day_start_ms < ?",
+            (device_id, start_ms, end_ms),
+        )}
+        for day_start, row in fresh.items():
+            if start_ms <= day_start < end_ms:
+                if row is None:
+                    stored.pop(day_start, None)
+                else:
+                    stored[day_start] = row
+        old = conn.execute(
+            "SELECT content_hash FROM report WHERE device_id = ? AND period = ? AND period_start_ms = ?",
+            (device_id, period, start_ms),
+        ).fetchone()
+        if not stored:
+            if old is not None:
+                batch.reports.append((device_id, period, start_ms, None, None, None, None))
+            continue
+        body, content_hash = render(device_id, period, start_ms, end_ms, label, tz,
+                                    list(stored.values()))
+        if old is None or old[0] != content_hash:
+            batch.reports.append((device_id, period, start_ms, end_ms, label, body, content_hash))
+
+
+def compute(conn: sqlite3.Connection, full: bool = False, device_id: str | None = None,
+            now_ms: int | None = None) -> ReportBatch:
+    """
+    read-only half: partials of changed days (every day if full, or no
+    build has run yet) and the reports they change
+    """
+    # marks first: anything committed after this is picked up next time
+    batch = ReportBatch(conn.execute(MARKS_SQL).fetchone())
+    state = _state(conn)
+    if device_id is not None:
+        # one device's rebuild leaves the marks to the others' next build
+        batch.marks = None
+        full = True
+    if not full and state is not None:
+        if tuple(state) == tuple(batch.marks):
+            batch.marks = None
+            return batch
+        dirty = _dirty_days(conn, state)
+    else:
+        now_ms = int(datetime.now(timezone.utc).timestamp() * 1000) if now_ms is None else now_ms
+        devices = [device_id] if device_id is not None else metrics.devices(conn)
+        dirty = {d: _all_days(conn, d, now_ms) for d in devices}
+
+    for dev, days in dirty.items():
+        if not days:
+            continue
+        rows = day_partials(conn, dev, days)
+        for day, row in zip(days, rows):
+            if row is None:
+                batch.empty.append((dev, day[0]))
+            else:
+                batch.days.append(row)
+        _render_periods(conn, batch, dev, days, rows)
+    return batch
+
+
+def write(conn: sqlite3.Connection, batch: ReportBatch) -> int:
+    """
+    write half, inside the caller's transaction; returns reports written
+    """
+    conn.executemany(
+        f"INSERT OR REPLACE INTO report_day ({', '.join(DAY_COLUMNS)})"
+        f" values({', '.join('?' * len(DAY_COLUMNS))})",
+        batch.days,
+    )
+    conn.executemany("DELETE FROM report_day WHERE device_id = ? AND day_start_ms = ?", batch.empty)
+    built_at = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    conn.executemany(
+        "DELETE FROM report WHERE device_id = ? AND period = ? AND period_start_ms = ?",
+        [r[:3] for r in batch.reports if r[5] is None],
+    )
+    conn.executemany(
+        """
+        INSERT OR REPLACE INTO report
+        (device_id, period, period_start_ms, period_end_ms, period_label, body_json,
+        content_hash, built_at) values(?,?,?,?,?,?,?,?)
+        """,
+        [(*r, built_at) for r in batch.reports if r[5] is not None],
+    )
+    if batch.marks is None:
+        return len(batch.reports)
+    conn.execute(
+        """
+        INSERT INTO report_state(id, ingested_hwm, change_hwm, computed_hwm, decided_hwm, built_at)
+        VALUES (1, ?, ?, ?, ?, ?)
+        ON CONFLICT(id) DO UPDATE SET
+            ingested_hwm = excluded.ingested_hwm,
+            change_hwm = excluded.change_hwm,
+            computed_hwm = excluded.computed_hwm,
+            decided_hwm = excluded.decided_hwm,
+            built_at = excluded.built_at
+        """,
+        (*batch.marks, built_at),
+    )
+    return len(batch.reports)
+
+
+def query(conn: sqlite3.Connection, device_id: str, period: str, start_ms: int | None = None,
+          end_ms: int | None = None) -> list[dict]:
+    rows = conn.execute(
+        """
+        SELECT body_json FROM report
+        WHERE device_id = ? AND period = ? AND period_start_ms >= ? AND period_start_ms < ?
+        ORDER BY period_start_ms
+        """,
+        (device_id, period, start_ms if start_ms is not None else -(2**62),
+         end_ms if end_ms is not None else 2**62),
+    ).fetchall()
+    return [json.loads(r[0]) for r in rows]
+
+
+def main(argv=None):
+    from . import db
+
+    argv = sys.argv[1:] if argv is None else argv
+    command = argv[0] if argv else "build"
+    conn = db.connect()
+    try:
+        if command in ("build", "rebuild"):
+            device_id = argv[1] if command == "rebuild" and len(argv) > 1 else None
+            batch = compute(conn, full=command == "rebuild", device_id=device_id)
+            with conn:
+                n = write(conn, batch)
+            print(f"reports: {len(batch.days)} days recomputed, {n} reports written")
+        elif command == "show" and len(argv) > 1:
+            period = argv[2] if len(argv) > 2 else "week"
+            for report in query(conn, argv[1], period):
+                print(json.dumps(report))
+        else:
+            print("usage: python -m api.reports build | rebuild [device_id] | show <device_id> [week|month]")
+            return 2
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,321 @@
+"""
+Hour / day / ISO-week rollups per device.
+
+Buckets follow the device's local timezone (device_settings.timezone,
+falling back to config.DEFAULT_TIMEZONE), so a "day" is a local calendar
+day including DST changes. refresh() is handed the minute buckets that
+api/fused.py just recomputed and rebuilds only the rollup buckets that
+contain them. Buckets reaching into archived months (api/archive.py)
+add the archived events to the live ones, so rebuilds and timezone
+changes keep and re-bucket archived history.
+
+    python -m api.rollups rebuild [device_id]
+"""
+import sqlite3
+import sys
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+import numpy as np
+
+from . import archive, config
+
+
+GRAINS = ("hour", "day", "week")
+
+AGGREGATE_SQL = """
+INSERT INTO rollup
+(device_id, grain, bucket_start_ms, bucket_end_ms, bucket_label,
+weight_last, weight_mean, weight_count,
+steps_delta_sum, steps_cum_max, steps_count, sample_count)
+SELECT
+    d.device_id,
+    d.grain,
+    d.bucket_start_ms,
+    d.bucket_end_ms,
+    d.bucket_label,
+    (
+        SELECT ow2.body_mass_kg
+        FROM observation_event e2
+        JOIN event_weight ow2 ON ow2.event_key = e2.event_key
+        WHERE e2.device_id = d.device_id
+            AND e2.observed_ms >= d.bucket_start_ms
+            AND e2.observed_ms < d.bucket_end_ms
+            AND e2.obs_kind = 'weight'
+            AND e2.is_valid = 1 AND e2.superseded_by IS NULL
+        ORDER BY e2.observed_ms DESC
+        LIMIT 1
+    ) AS weight_last,
+    AVG(ow.body_mass_kg),
+    COUNT(ow.event_key),
+    COALESCE(SUM(sn.step_delta), 0),
+    MAX(CASE WHEN os.step_mode = 'cumulative' THEN os.step_value END),
+    COUNT(os.event_key),
+    COUNT(e.event_id)
+FROM temp.rollup_dirty d
+JOIN observation_event e
+    ON e.device_id = d.device_id
+    AND e.observed_ms >= d.bucket_start_ms
+    AND e.observed_ms < d.bucket_end_ms
+LEFT JOIN event_weight ow ON ow.event_key = e.event_key AND e.obs_kind = 'weight'
+LEFT JOIN event_steps os ON os.event_key = e.event_key AND e.obs_kind = 'steps'
+LEFT JOIN steps_normalized sn ON sn.event_id = e.event_id AND os.event_key IS NOT NULL
+WHERE e.is_valid = 1 AND e.superseded_by IS NULL
+GROUP BY d.device_id, d.grain, d.bucket_start_ms
+"""
+
+
+# time of the live weight_last of a bucket, to merge it with the archive
+LAST_WEIGHT_MS_SQL = """
+SELECT MAX(e.observed_ms)
+FROM observation_event e
+JOIN event_weight ow ON ow.event_key = e.event_key
+WHERE e.device_id = ? AND e.observed_ms >= ? AND e.observed_ms < ?
+    AND e.obs_kind = 'weight' AND e.is_valid = 1 AND e.superseded_by IS NULL
+"""
+
+ROLLUP_COLUMNS = """
+device_id, grain, bucket_start_ms, bucket_end_ms, bucket_label,
+weight_last, weight_mean, weight_count,
+steps_delta_sum, steps_cum_max, steps_count, sample_count
+"""
+
+
+def device_timezone(conn: sqlite3.Connection, device_id: str) -> ZoneInfo:
+    row = conn.execute(
+        "SELECT timezone FROM device_settings WHERE device_id = ?", (device_id,)
+    ).fetchone()
+    return ZoneInfo(row[0] if row else config.DEFAULT_TIMEZONE)
+
+
+def _to_ms(dt: datetime) -> int:
+    return int(dt.timestamp() * 1000)
+
+
+def bucket_bounds(ms: int, tz: ZoneInfo, grain: str) -> tuple[int, int, str]:
+    """
+    (start_ms, end_ms, label) of the local hour/day/ISO week holding ms
+    """
+    local = datetime.fromtimestamp(ms / 1000, tz)
+    if grain == "hour":
+        start = local.replace(minute=0, second=0, microsecond=0)
+        start_ms = _to_ms(start)
+        # one elapsed hour, also across DST changes
+        return start_ms, start_ms + 3_600_000, start.strftime("%Y-%m-%dT%H")
+
+    day = local.date()
+    if grain == "day":
+        first, days, label = day, 1, day.isoformat()
+    elif grain == "week":
+        first, days = day - timedelta(days=day.weekday()), 7
+        year, week, _ = day.isocalendar()
+        label = f"{year}-W{week:02d}"
+    else:
+        raise ValueError(f"unknown grain '{grain}'")
+
+    start = datetime(first.year, first.month, first.day, tzinfo=tz)
+    last = first + timedelta(days=days)
+    end = datetime(last.year, last.month, last.day, tzinfo=tz)
+    return _to_ms(start), _to_ms(end), label
+
+
+def buckets_for_minutes(conn: sqlite3.Connection, keys) -> set[tuple]:
+    """
+    (device_id, grain, start_ms, end_ms, label) for every bucket holding
+    one of the (device_id, minute_bucket) keys
+    """
+    zones: dict[str, ZoneInfo] = {}
+    seen: set[tuple] = set()
+    buckets: set[tuple] = set()
+    for device_id, minute_bucket in keys:
+        tz = zones.get(device_id)
+        if tz is None:
+            tz = zones[device_id] = device_timezone(conn, device_id)
+        # UTC offsets are multiples of 15 minutes, so every minute of a UTC
+        # quarter-hour falls in the same local hour/day/week
+        quarter = (device_id, minute_bucket // 15)
+        if quarter in seen:
+            continue
+        seen.add(quarter)
+        ms = minute_bucket * 60_000
+        for grain in GRAINS:
+            buckets.add((device_id, grain, *bucket_bounds(ms, tz, grain)))
+    return buckets
+
+
+def _archived(conn: sqlite3.Connection, buckets) -> dict[tuple, tuple]:
+    """
+    (device_id, grain, start_ms) -> (weight_last_ms, weight_last,
+    weight_sum, weight_count, steps_delta_sum, steps_cum_max, steps_count,
+    sample_count) of the archived events in each bucket that has any
+    """
+    by_device: dict[str, list[tuple]] = {}
+    for bucket in buckets:
+        by_device.setdefault(bucket[0], []).append(bucket)
+    parts = {}
+    for device_id, items in by_device.items():
+        lo = min(b[2] for b in items)
+        hi = max(b[3] for b in items)
+        if not archive.segments(conn, device_id, lo, hi):
+            continue
+        ev = archive.events(conn, device_id, lo, hi)
+        t = ev["observed_ms"]
+        weight = (ev["obs_kind"] == "weight") & ~np.isnan(ev["body_mass_kg"])
+        steps = (ev["obs_kind"] == "steps") & ~np.isnan(ev["step_value"])
+        cum = steps & (ev["step_mode"] == "cumulative")
+        wt, wv = t[weight], ev["body_mass_kg"][weight]
+        st, sd = t[steps], np.nan_to_num(ev["step_delta"][steps])
+        ct, cv = t[cum], ev["step_value"][cum]
+        for _, grain, start, end, _ in items:
+            i0, i1 = np.searchsorted(t, [start, end])
+            if i0 == i1:
+                continue
+            w0, w1 = np.searchsorted(wt, [start, end])
+            s0, s1 = np.searchsorted(st, [start, end])
+            c0, c1 = np.searchsorted(ct, [start, end])
+            parts[(device_id, grain, start)] = (
+                int(wt[w1 - 1]) if w1 > w0 else None,
+                float(wv[w1 - 1]) if w1 > w0 else None,
+                float(wv[w0:w1].sum()), int(w1 - w0),
+                int(sd[s0:s1].sum()),
+                int(cv[c0:c1].max()) if c1 > c0 else None,
+                int(s1 - s0), int(i1 - i0),
+            )
+    return parts
+
+
+def _merge_archived(conn: sqlite3.Connection, buckets) -> None:
+    """
+    fold the archived events into the freshly aggregated live rows
+    """
+    parts = _archived(conn, buckets)
+    if not parts:
+        return
+    rows = []
+    for bucket in buckets:
+        part = parts.get(bucket[:3])
+        if part is None:
+            continue
+        last_ms, last, w_sum, w_n, s_sum, cum_max, s_n, n = part
+        live = conn.execute(
+            """
+            SELECT weight_last, weight_mean, weight_count, steps_delta_sum,
+                steps_cum_max, steps_count, sample_count
+            FROM rollup WHERE device_id = ? AND grain = ? AND bucket_start_ms = ?
+            """,
+            bucket[:3],
+        ).fetchone()
+        if live is not None:
+            l_last, l_mean, l_wn, l_ssum, l_cum, l_sn, l_n = live
+            if l_wn and (last is None or conn.execute(
+                LAST_WEIGHT_MS_SQL, (bucket[0], bucket[2], bucket[3])
+            ).fetchone()[0] >= last_ms):
+                last = l_last
+            w_sum += (l_mean or 0.0) * l_wn
+            w_n += l_wn
+            s_sum += l_ssum
+            cum_max = max((c for c in (cum_max, l_cum) if c is not None), default=None)
+            s_n += l_sn
+            n += l_n
+        rows.append((*bucket, last, w_sum / w_n if w_n else None, w_n, s_sum, cum_max, s_n, n))
+    conn.executemany(
+        f"INSERT OR REPLACE INTO rollup ({ROLLUP_COLUMNS}) VALUES (?,?,?,?,?,?,?,?,?,?,?,?)", rows
+    )
+
+
+def refresh_buckets(conn: sqlite3.Connection, buckets) -> int:
+    if not buckets:
+        return 0
+    conn.execute(
+        """
+        CREATE TEMP TABLE IF NOT EXISTS rollup_dirty (
+            device_id TEXT NOT NULL,
+            grain TEXT NOT NULL,
+            bucket_start_ms INTEGER NOT NULL,
+            bucket_end_ms INTEGER NOT NULL,
+            bucket_label TEXT NOT NULL,
+            PRIMARY KEY (device_id, grain, bucket_start_ms)
+        ) WITHOUT ROWID
+        """
+    )
+    conn.execute("DELETE FROM temp.rollup_dirty")
+    conn.executemany(
+        "INSERT OR IGNORE INTO temp.rollup_dirty VALUES (?,?,?,?,?)", list(buckets)
+    )
+    conn.execute(
+        """
+        DELETE FROM rollup
+        WHERE (device_id, grain, bucket_start_ms) IN
+            (SELECT device_id, grain, bucket_start_ms FROM temp.rollup_dirty)
+        """
+    )
+    conn.execute(AGGREGATE_SQL)
+    conn.execute("DELETE FROM temp.rollup_dirty")
+    _merge_archived(conn, buckets)
+    return len(buckets)
+
+
+def refresh(conn: sqlite3.Connection, keys) -> int:
+    """
+    recompute the rollups holding the given (device_id, minute_bucket) keys
+    """
+    return refresh_buckets(conn, buckets_for_minutes(conn, keys))
+
+
+def rebuild(conn: sqlite3.Connection, device_id: str | None = None) -> int:
+    """
+    drop and recompute the rollups of one device, or of every device;
+    fused_minute still holds the minutes of archived months, whose
+    buckets are recomputed from the archive
+    """
+    if device_id is None:
+        conn.execute("DELETE FROM rollup")
+        keys = conn.execute("SELECT device_id, minute_bucket FROM fused_minute").fetchall()
+    else:
+        conn.execute("DELETE FROM rollup WHERE device_id = ?", (device_id,))
+        keys = conn.execute(
+            "SELECT device_id, minute_bucket FROM fused_minute WHERE device_id = ?",
+            (device_id,),
+        ).fetchall()
+    return refresh(conn, keys)
+
+
+def query(conn: sqlite3.Connection, device_id: str, grain: str,
+          start_ms: int | None = None, end_ms: int | None = None) -> list[dict]:
+    conn.row_factory = sqlite3.Row
+    try:
+        rows = conn.execute(
+            """
+            SELECT * FROM rollup
+            WHERE device_id = ? AND grain = ?
+                AND bucket_start_ms >= ? AND bucket_start_ms < ?
+            ORDER BY bucket_start_ms
+            """,
+            (device_id, grain,
+             start_ms if start_ms is not None else -(2**62),
+             end_ms if end_ms is not None else 2**62),
+        ).fetchall()
+    finally:
+        conn.row_factory = None
+    return [dict(r) for r in rows]
+
+
+def main(argv=None):
+    from . import db
+
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] != "rebuild":
+        print("usage: python -m api.rollups rebuild [device_id]")
+        return 2
+    conn = db.connect()
+    try:
+        with conn:
+            n = rebuild(conn, argv[1] if len(argv) > 1 else None)
+        print(f"rollup rebuilt: {n} buckets")
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
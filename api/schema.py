@@ -0,0 +1,907 @@
+"""
+Current schema. A new database gets all of it as migration 1 (see
+api/migrations.py); a change here also needs a migration so existing
+databases pick it up, written to be a no-op on a database created from
+this text.
+
+Observations are stored compactly: event has an INTEGER key, device_id
+and obs_kind are interned in device / event_kind, and observed_at is
+only stored where it is not observed_ms spelled out (OBSERVED_AT_SQL).
+The payload and provenance tables are WITHOUT ROWID tables on that key.
+
+observation_event and the payload / provenance tables of the old layout
+(PAYLOAD_TABLES) are views over them with their old columns, so readers
+and the HTTP API keep working; observation_event adds event_key, which
+internal readers use to join the compact tables. The views take writes
+through the INSTEAD OF triggers in COMPAT_SQL. A write through a view
+reports no rowcount, so code that counts rows writes the tables
+(api/ingest.py). COMPAT_SQL is applied apart from SCHEMA_SQL because it
+cannot be created on a database that still has the old tables.
+"""
+
+# observed_at of an event whose stored observed_at is NULL
+OBSERVED_AT_SQL = "strftime('%Y-%m-%dT%H:%M:%fZ', {ms} / 1000.0, 'unixepoch')"
+
+# old table, now a view -> (compact table, columns besides the key), in
+# foreign-key order
+PAYLOAD_TABLES = {
+    "obs_weight": ("event_weight", ["body_mass_kg"]),
+    "obs_steps": ("event_steps", ["step_value", "step_mode"]),
+    "obs_sleep_state": ("event_sleep_state", ["state"]),
+    "observation_provenance": (
+        "event_provenance", ["source_kind", "app_version", "ingested_at", "provenance_json"],
+    ),
+}
+
+SCHEMA_SQL = """
+-- Core tables (compact layout, see the module docstring)
+CREATE TABLE IF NOT EXISTS device (
+    device_key INTEGER PRIMARY KEY,
+    device_id TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS event_kind (
+    kind_key INTEGER PRIMARY KEY,
+    obs_kind TEXT NOT NULL UNIQUE     -- 'weight' | 'steps' | 'sleep_state'
+);
+
+CREATE TABLE IF NOT EXISTS event (
+    event_key INTEGER PRIMARY KEY,
+    event_id TEXT NOT NULL UNIQUE,
+    device_key INTEGER NOT NULL REFERENCES device(device_key),
+    kind_key INTEGER NOT NULL REFERENCES event_kind(kind_key),
+    observed_ms INTEGER NOT NULL,
+    observed_at TEXT DEFAULT NULL,    -- NULL when it is OBSERVED_AT_SQL of observed_ms
+    is_valid INTEGER NOT NULL DEFAULT 1,
+    superseded_by TEXT DEFAULT NULL,
+    note TEXT DEFAULT NULL,
+    CHECK (is_valid IN (0, 1))
+);
+
+CREATE INDEX IF NOT EXISTS idx_event_device_ms
+    ON event(device_key, observed_ms);
+
+CREATE INDEX IF NOT EXISTS idx_event_kind_ms
+    ON event(kind_key, observed_ms);
+
+CREATE INDEX IF NOT EXISTS idx_event_device_superseded
+    ON event(device_key, superseded_by);
+
+-- the event as readers know it, plus event_key to join the compact tables
+CREATE VIEW IF NOT EXISTS observation_event AS
+SELECT
+    e.event_id,
+    d.device_id,
+    COALESCE(e.observed_at, strftime('%Y-%m-%dT%H:%M:%fZ', e.observed_ms / 1000.0, 'unixepoch'))
+        AS observed_at,
+    e.observed_ms,
+    k.obs_kind,
+    e.is_valid,
+    e.superseded_by,
+    e.note,
+    e.event_key
+FROM event e
+JOIN device d ON d.device_key = e.device_key
+JOIN event_kind k ON k.kind_key = e.kind_key;
+
+-- is_valid / superseded_by changes, in order; the sync change key for updates
+CREATE TABLE IF NOT EXISTS observation_change (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    event_id TEXT NOT NULL,
+    changed_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ', 'now'))
+);
+
+CREATE TRIGGER IF NOT EXISTS trg_change_event_update
+AFTER UPDATE OF is_valid, superseded_by ON event
+WHEN OLD.is_valid IS NOT NEW.is_valid OR OLD.superseded_by IS NOT NEW.superseded_by
+BEGIN
+    INSERT INTO observation_change(event_id) VALUES (NEW.event_id);
+END;
+
+-- per-peer high-water marks for delta sync (sync/delta.py)
+CREATE TABLE IF NOT EXISTS sync_peer (
+    peer_id TEXT PRIMARY KEY,
+    ingested_hwm TEXT NOT NULL DEFAULT '',
+    change_hwm INTEGER NOT NULL DEFAULT 0,
+    computed_hwm TEXT NOT NULL DEFAULT '',
+    updated_at TEXT DEFAULT NULL
+);
+
+-- incoming databases already merged, by content hash (sync/merge.py)
+CREATE TABLE IF NOT EXISTS sync_merge_log (
+    file_hash TEXT PRIMARY KEY,
+    source_path TEXT DEFAULT NULL,
+    merged_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ', 'now')),
+    counts_json TEXT NOT NULL
+);
+
+-- resumable bulk imports (scripts/import_apple_health.py)
+CREATE TABLE IF NOT EXISTS import_checkpoint (
+    source_path TEXT PRIMARY KEY,
+    file_size INTEGER NOT NULL,
+    file_mtime INTEGER NOT NULL,
+    records_done INTEGER NOT NULL DEFAULT 0,
+    updated_at TEXT DEFAULT NULL
+);
+
+CREATE TABLE IF NOT EXISTS event_provenance (
+    event_key INTEGER PRIMARY KEY,
+    source_kind TEXT NOT NULL DEFAULT 'unknown',
+    app_version TEXT DEFAULT NULL,
+    ingested_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ', 'now')),
+    provenance_json TEXT DEFAULT NULL,
+    FOREIGN KEY (event_key) REFERENCES event(event_key) ON DELETE CASCADE
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_event_provenance_ingested
+    ON event_provenance(ingested_at);
+
+-- Payload tables
+CREATE TABLE IF NOT EXISTS event_steps (
+    event_key INTEGER PRIMARY KEY,
+    step_value INTEGER NOT NULL,
+    step_mode TEXT NOT NULL, -- 'delta'|'cumulative'|'device_total'
+    CHECK (step_value >= 0),
+    CHECK (step_mode IN ('delta', 'cumulative', 'device_total')),
+    FOREIGN KEY (event_key) REFERENCES event(event_key) ON DELETE CASCADE
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS event_weight (
+    event_key INTEGER PRIMARY KEY,
+    body_mass_kg REAL NOT NULL,
+    body_mass_01 REAL GENERATED ALWAYS AS (round(body_mass_kg, 1)) VIRTUAL,
+    CHECK (body_mass_kg > 0),
+    FOREIGN KEY (event_key) REFERENCES event(event_key) ON DELETE CASCADE
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS event_sleep_state (
+    event_key INTEGER PRIMARY KEY,
+    state TEXT NOT NULL,
+    CHECK(state <> ''),
+    FOREIGN KEY (event_key) REFERENCES event(event_key) ON DELETE CASCADE
+) WITHOUT ROWID;
+
+-- the payload and provenance tables of the old layout
+CREATE VIEW IF NOT EXISTS observation_provenance AS
+SELECT e.event_id, p.source_kind, p.app_version, p.ingested_at, p.provenance_json
+FROM event_provenance p JOIN event e ON e.event_key = p.event_key;
+
+CREATE VIEW IF NOT EXISTS obs_steps AS
+SELECT e.event_id, s.step_value, s.step_mode
+FROM event_steps s JOIN event e ON e.event_key = s.event_key;
+
+CREATE VIEW IF NOT EXISTS obs_weight AS
+SELECT e.event_id, w.body_mass_kg, w.body_mass_01
+FROM event_weight w JOIN event e ON e.event_key = w.event_key;
+
+CREATE VIEW IF NOT EXISTS obs_sleep_state AS
+SELECT e.event_id, z.state
+FROM event_sleep_state z JOIN event e ON e.event_key = z.event_key;
+
+-- steps each valid obs_steps sample adds, whatever its step_mode (api/steps.py)
+CREATE TABLE IF NOT EXISTS steps_normalized (
+    event_id TEXT PRIMARY KEY,
+    device_id TEXT NOT NULL,
+    observed_ms INTEGER NOT NULL,
+    step_mode TEXT NOT NULL,
+    step_delta INTEGER NOT NULL,
+    is_reset INTEGER NOT NULL DEFAULT 0,
+    FOREIGN KEY (event_id) REFERENCES event(event_id) ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS idx_steps_normalized_device_time
+    ON steps_normalized(device_id, observed_ms, step_delta);
+
+-- sleep sessions derived from obs_sleep_state (api/sleep.py)
+CREATE TABLE IF NOT EXISTS sleep_session (
+    session_id TEXT PRIMARY KEY,       -- event_id of the first sample
+    device_id TEXT NOT NULL,
+    start_ms INTEGER NOT NULL,
+    end_ms INTEGER NOT NULL,
+    asleep_ms INTEGER NOT NULL,
+    state_ms_json TEXT NOT NULL,       -- {state: ms}
+    sample_count INTEGER NOT NULL,
+    source_kind TEXT NOT NULL,
+    CHECK (end_ms >= start_ms)
+);
+
+CREATE INDEX IF NOT EXISTS idx_sleep_session_interval
+    ON sleep_session(device_id, end_ms, start_ms);
+
+-- one row per distinct observation content (api/identity.py)
+CREATE TABLE IF NOT EXISTS observation_identity (
+    content_hash TEXT PRIMARY KEY,
+    event_id TEXT NOT NULL UNIQUE,
+    FOREIGN KEY (event_id) REFERENCES event(event_id) ON DELETE CASCADE
+) WITHOUT ROWID;
+
+-- cold tier manifest: one Arrow IPC file per device and UTC month (api/archive.py)
+CREATE TABLE IF NOT EXISTS archive_segment (
+    device_id TEXT NOT NULL,
+    month TEXT NOT NULL,               -- 'YYYY-MM'
+    start_ms INTEGER NOT NULL,         -- first / last observed_ms in the file
+    end_ms INTEGER NOT NULL,
+    path TEXT NOT NULL,                -- relative to HEALTH_ARCHIVE_DIR
+    row_count INTEGER NOT NULL,
+    byte_size INTEGER NOT NULL,
+    archived_at TEXT NOT NULL,
+    PRIMARY KEY (device_id, month)
+);
+
+CREATE INDEX IF NOT EXISTS idx_archive_segment_interval
+    ON archive_segment(device_id, end_ms, start_ms);
+
+-- content hashes of archived events, still checked for duplicates
+CREATE TABLE IF NOT EXISTS archived_identity (
+    content_hash TEXT PRIMARY KEY,
+    event_id TEXT NOT NULL
+) WITHOUT ROWID;
+
+-- Metrics
+CREATE TABLE IF NOT EXISTS metric_def (
+    metric_id TEXT PRIMARY KEY,
+    metric_name TEXT NOT NULL UNIQUE,
+    watermark TEXT NOT NULL,
+    unit TEXT DEFAULT NULL,
+    description TEXT DEFAULT NULL
+);
+
+CREATE TABLE IF NOT EXISTS metric_value (
+    metric_value_id TEXT PRIMARY KEY,
+    metric_id TEXT NOT NULL,
+    device_id TEXT NOT NULL,
+    window_start_ms INTEGER NOT NULL,
+    window_end_ms INTEGER NOT NULL,
+    computed_at TEXT NOT NULL,
+    value_real REAL DEFAULT NULL,
+    value_int INTEGER DEFAULT NULL,
+    value_text TEXT DEFAULT NULL,
+    CHECK (window_end_ms > window_start_ms),
+    FOREIGN KEY (metric_id) REFERENCES metric_def(metric_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_metric_value_device_window
+    ON metric_value(device_id, window_start_ms, window_end_ms);
+
+CREATE INDEX IF NOT EXISTS idx_metric_value_computed
+    ON metric_value(computed_at);
+
+-- UTC days whose observations changed, written by derived.refresh();
+-- the metric engine recomputes the windows already written over them
+-- and deletes the marks it read (id <= the last one it saw)
+CREATE TABLE IF NOT EXISTS metric_dirty (
+    id INTEGER PRIMARY KEY,
+    device_id TEXT NOT NULL,
+    day_ms INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS metric_run (
+    metric_value_id TEXT PRIMARY KEY,
+    confidence_score REAL NOT NULL,
+    missing_data_ratio REAL NOT NULL,
+    is_imputed INTEGER NOT NULL DEFAULT 0,
+    logic_version TEXT DEFAULT NULL,
+    details_json TEXT DEFAULT NULL,
+    CHECK (confidence_score >= 0 AND confidence_score <= 1),
+    CHECK (missing_data_ratio >= 0 AND missing_data_ratio <= 1),
+    CHECK (is_imputed IN (0, 1)),
+    FOREIGN KEY (metric_value_id) REFERENCES metric_value(metric_value_id) ON DELETE CASCADE
+);
+
+-- Decisions
+CREATE TABLE IF NOT EXISTS decision_run (
+    decision_run_id TEXT PRIMARY KEY,
+    metric_value_id TEXT NOT NULL,
+    computed_at TEXT NOT NULL,
+    policy_version TEXT DEFAULT NULL,
+    FOREIGN KEY (metric_value_id) REFERENCES metric_value(metric_value_id) ON DELETE CASCADE
+);
+
+-- anti-join for the decision engine: "values without a run for this policy"
+CREATE INDEX IF NOT EXISTS idx_decision_run_metric_policy
+    ON decision_run(metric_value_id, policy_version);
+
+CREATE INDEX IF NOT EXISTS idx_decision_run_computed
+    ON decision_run(computed_at);
+
+CREATE TABLE IF NOT EXISTS decision_result (
+    decision_run_id TEXT PRIMARY KEY,
+    reversible INTEGER NOT NULL DEFAULT 1,
+    explain TEXT DEFAULT NULL,
+    action TEXT DEFAULT NULL,
+    msg TEXT DEFAULT NULL,
+    notify INTEGER NOT NULL DEFAULT 0,
+    CHECK (reversible IN (0, 1)),
+    CHECK (notify IN (0, 1)),
+    FOREIGN KEY (decision_run_id) REFERENCES decision_run(decision_run_id) ON DELETE CASCADE
+);
+
+-- Fused view (minute alignment), the reference definition for fused_minute
+CREATE VIEW IF NOT EXISTS fused_minute_view AS
+WITH base AS (
+    SELECT
+        device_id,
+        CAST(observed_ms / 60000 AS INTEGER) AS minute_bucket,
+        observed_ms,
+        event_id,
+        obs_kind
+    FROM observation_event
+    WHERE is_valid = 1 AND superseded_by IS NULL
+),
+weight_ranked AS (
+    SELECT
+        b.device_id,
+        b.minute_bucket,
+        ow.body_mass_01,
+        ROW_NUMBER() OVER (
+            PARTITION BY b.device_id, b.minute_bucket
+            ORDER BY b.observed_ms DESC
+        ) AS rn
+    FROM base b
+    JOIN obs_weight ow ON ow.event_id = b.event_id
+    WHERE b.obs_kind = 'weight'
+),
+weight_final AS (
+    SELECT device_id, minute_bucket, body_mass_01
+    FROM weight_ranked
+    WHERE rn = 1
+),
+steps_agg AS (
+    SELECT
+        b.device_id,
+        b.minute_bucket,
+        SUM(CASE WHEN os.step_mode='delta' THEN os.step_value ELSE 0 END) AS steps_delta_sum,
+        MAX(CASE WHEN os.step_mode='cumulative' THEN os.step_value ELSE NULL END) AS step_cum_last
+    FROM base b
+    JOIN obs_steps os ON os.event_id = b.event_id
+    WHERE b.obs_kind = 'steps'
+    GROUP BY b.device_id, b.minute_bucket
+)
+SELECT
+    x.device_id,
+    x.minute_bucket,
+    datetime(x.minute_bucket * 60, 'unixepoch') AS minute_start_utc,
+    wf.body_mass_01,
+    COALESCE(sa.steps_delta_sum, 0) AS steps_delta_sum,
+    sa.step_cum_last
+FROM (SELECT DISTINCT device_id, minute_bucket FROM base) x
+LEFT JOIN weight_final wf
+    ON wf.device_id = x.device_id AND wf.minute_bucket = x.minute_bucket
+LEFT JOIN steps_agg sa
+    ON sa.device_id = x.device_id AND sa.minute_bucket = x.minute_bucket;
+
+-- Materialised fused_minute, kept in step with fused_minute_view by api/fused.py
+CREATE TABLE IF NOT EXISTS fused_minute (
+    device_id TEXT NOT NULL,
+    minute_bucket INTEGER NOT NULL,
+    minute_start_utc TEXT NOT NULL,
+    body_mass_01 REAL DEFAULT NULL,
+    steps_delta_sum INTEGER NOT NULL DEFAULT 0,
+    step_cum_last INTEGER DEFAULT NULL,
+    PRIMARY KEY (device_id, minute_bucket)
+) WITHOUT ROWID;
+
+-- (device_id, minute_bucket) pairs touched since the last refresh
+CREATE TABLE IF NOT EXISTS fused_minute_dirty (
+    device_id TEXT NOT NULL,
+    minute_bucket INTEGER NOT NULL,
+    PRIMARY KEY (device_id, minute_bucket)
+) WITHOUT ROWID;
+
+CREATE TRIGGER IF NOT EXISTS trg_fused_event_insert
+AFTER INSERT ON event
+BEGIN
+    INSERT OR IGNORE INTO fused_minute_dirty
+    SELECT device_id, CAST(NEW.observed_ms / 60000 AS INTEGER)
+    FROM device WHERE device_key = NEW.device_key;
+END;
+
+-- writes through the observation_event view set every column, so only
+-- real changes count
+CREATE TRIGGER IF NOT EXISTS trg_fused_event_update
+AFTER UPDATE OF device_key, observed_ms, kind_key, is_valid, superseded_by ON event
+WHEN OLD.device_key IS NOT NEW.device_key OR OLD.observed_ms IS NOT NEW.observed_ms
+    OR OLD.kind_key IS NOT NEW.kind_key OR OLD.is_valid IS NOT NEW.is_valid
+    OR OLD.superseded_by IS NOT NEW.superseded_by
+BEGIN
+    INSERT OR IGNORE INTO fused_minute_dirty
+    SELECT device_id, CAST(OLD.observed_ms / 60000 AS INTEGER)
+    FROM device WHERE device_key = OLD.device_key
+    UNION ALL
+    SELECT device_id, CAST(NEW.observed_ms / 60000 AS INTEGER)
+    FROM device WHERE device_key = NEW.device_key;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_fused_event_delete
+AFTER DELETE ON event
+BEGIN
+    INSERT OR IGNORE INTO fused_minute_dirty
+    SELECT device_id, CAST(OLD.observed_ms / 60000 AS INTEGER)
+    FROM device WHERE device_key = OLD.device_key;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_fused_weight_insert
+AFTER INSERT ON event_weight
+BEGIN
+    INSERT OR IGNORE INTO fused_minute_dirty
+    SELECT d.device_id, CAST(e.observed_ms / 60000 AS INTEGER)
+    FROM event e JOIN device d ON d.device_key = e.device_key
+    WHERE e.event_key = NEW.event_key;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_fused_weight_update
+AFTER UPDATE ON event_weight
+BEGIN
+    INSERT OR IGNORE INTO fused_minute_dirty
+    SELECT d.device_id, CAST(e.observed_ms / 60000 AS INTEGER)
+    FROM event e JOIN device d ON d.device_key = e.device_key
+    WHERE e.event_key IN (OLD.event_key, NEW.event_key);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_fused_weight_delete
+AFTER DELETE ON event_weight
+BEGIN
+    INSERT OR IGNORE INTO fused_minute_dirty
+    SELECT d.device_id, CAST(e.observed_ms / 60000 AS INTEGER)
+    FROM event e JOIN device d ON d.device_key = e.device_key
+    WHERE e.event_key = OLD.event_key;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_fused_steps_insert
+AFTER INSERT ON event_steps
+BEGIN
+    INSERT OR IGNORE INTO fused_minute_dirty
+    SELECT d.device_id, CAST(e.observed_ms / 60000 AS INTEGER)
+    FROM event e JOIN device d ON d.device_key = e.device_key
+    WHERE e.event_key = NEW.event_key;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_fused_steps_update
+AFTER UPDATE ON event_steps
+BEGIN
+    INSERT OR IGNORE INTO fused_minute_dirty
+    SELECT d.device_id, CAST(e.observed_ms / 60000 AS INTEGER)
+    FROM event e JOIN device d ON d.device_key = e.device_key
+    WHERE e.event_key IN (OLD.event_key, NEW.event_key);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_fused_steps_delete
+AFTER DELETE ON event_steps
+BEGIN
+    INSERT OR IGNORE INTO fused_minute_dirty
+    SELECT d.device_id, CAST(e.observed_ms / 60000 AS INTEGER)
+    FROM event e JOIN device d ON d.device_key = e.device_key
+    WHERE e.event_key = OLD.event_key;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_fused_sleep_insert
+AFTER INSERT ON event_sleep_state
+BEGIN
+    INSERT OR IGNORE INTO fused_minute_dirty
+    SELECT d.device_id, CAST(e.observed_ms / 60000 AS INTEGER)
+    FROM event e JOIN device d ON d.device_key = e.device_key
+    WHERE e.event_key = NEW.event_key;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_fused_sleep_update
+AFTER UPDATE ON event_sleep_state
+BEGIN
+    INSERT OR IGNORE INTO fused_minute_dirty
+    SELECT d.device_id, CAST(e.observed_ms / 60000 AS INTEGER)
+    FROM event e JOIN device d ON d.device_key = e.device_key
+    WHERE e.event_key IN (OLD.event_key, NEW.event_key);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_fused_sleep_delete
+AFTER DELETE ON event_sleep_state
+BEGIN
+    INSERT OR IGNORE INTO fused_minute_dirty
+    SELECT d.device_id, CAST(e.observed_ms / 60000 AS INTEGER)
+    FROM event e JOIN device d ON d.device_key = e.device_key
+    WHERE e.event_key = OLD.event_key;
+END;
+
+-- Per-device settings (rollup day boundaries use the local timezone)
+CREATE TABLE IF NOT EXISTS device_settings (
+    device_id TEXT PRIMARY KEY,
+    timezone TEXT NOT NULL DEFAULT 'UTC'
+);
+
+-- Hour / day / ISO-week rollups, maintained by api/rollups.py
+CREATE TABLE IF NOT EXISTS rollup (
+    device_id TEXT NOT NULL,
+    grain TEXT NOT NULL,               -- 'hour' | 'day' | 'week'
+    bucket_start_ms INTEGER NOT NULL,
+    bucket_end_ms INTEGER NOT NULL,
+    bucket_label TEXT NOT NULL,        -- local time, e.g. '2025-01-31', '2025-W05'
+    weight_last REAL DEFAULT NULL,
+    weight_mean REAL DEFAULT NULL,
+    weight_count INTEGER NOT NULL DEFAULT 0,
+    steps_delta_sum INTEGER NOT NULL DEFAULT 0,
+    steps_cum_max INTEGER DEFAULT NULL,
+    steps_count INTEGER NOT NULL DEFAULT 0,
+    sample_count INTEGER NOT NULL DEFAULT 0,
+    CHECK (grain IN ('hour', 'day', 'week')),
+    CHECK (bucket_end_ms > bucket_start_ms),
+    PRIMARY KEY (device_id, grain, bucket_start_ms)
+) WITHOUT ROWID;
+
+-- JSON evidence for the LLM layer, per device, metric and window
+-- (api/evidence.py). The triggers below drop every bundle a write could
+-- change and bump the device's epoch, so a bundle built before such a
+-- write is never stored.
+CREATE TABLE IF NOT EXISTS evidence_bundle (
+    device_id TEXT NOT NULL,
+    metric_id TEXT NOT NULL,
+    start_ms INTEGER NOT NULL,         -- values with window_end_ms in (start_ms, end_ms]
+    end_ms INTEGER NOT NULL,
+    data_start_ms INTEGER NOT NULL,    -- ... and window_start_ms >= data_start_ms
+    obs_kind TEXT NOT NULL,            -- observations the metric is computed from
+    content_hash TEXT NOT NULL,
+    body_json TEXT NOT NULL,
+    built_at TEXT NOT NULL,
+    PRIMARY KEY (device_id, metric_id, start_ms, end_ms)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS evidence_epoch (
+    device_id TEXT PRIMARY KEY,
+    epoch INTEGER NOT NULL
+) WITHOUT ROWID;
+
+CREATE TRIGGER IF NOT EXISTS trg_evidence_value_insert
+AFTER INSERT ON metric_value
+BEGIN
+    DELETE FROM evidence_bundle
+    WHERE device_id = NEW.device_id AND metric_id = NEW.metric_id
+        AND start_ms < NEW.window_end_ms AND end_ms >= NEW.window_end_ms
+        AND data_start_ms <= NEW.window_start_ms;
+    INSERT INTO evidence_epoch VALUES (NEW.device_id, 1)
+        ON CONFLICT(device_id) DO UPDATE SET epoch = epoch + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_evidence_value_update
+AFTER UPDATE ON metric_value
+BEGIN
+    DELETE FROM evidence_bundle
+    WHERE (device_id = OLD.device_id AND metric_id = OLD.metric_id
+            AND start_ms < OLD.window_end_ms AND end_ms >= OLD.window_end_ms
+            AND data_start_ms <= OLD.window_start_ms)
+        OR (device_id = NEW.device_id AND metric_id = NEW.metric_id
+            AND start_ms < NEW.window_end_ms AND end_ms >= NEW.window_end_ms
+            AND data_start_ms <= NEW.window_start_ms);
+    INSERT INTO evidence_epoch VALUES (OLD.device_id, 1), (NEW.device_id, 1)
+        ON CONFLICT(device_id) DO UPDATE SET epoch = epoch + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_evidence_value_delete
+AFTER DELETE ON metric_value
+BEGIN
+    DELETE FROM evidence_bundle
+    WHERE device_id = OLD.device_id AND metric_id = OLD.metric_id
+        AND start_ms < OLD.window_end_ms AND end_ms >= OLD.window_end_ms
+        AND data_start_ms <= OLD.window_start_ms;
+    INSERT INTO evidence_epoch VALUES (OLD.device_id, 1)
+        ON CONFLICT(device_id) DO UPDATE SET epoch = epoch + 1;
+END;
+
+-- runs, decisions and results reach their bundles through metric_value;
+-- setting computed_at fires trg_evidence_value_update above
+CREATE TRIGGER IF NOT EXISTS trg_evidence_run_insert
+AFTER INSERT ON metric_run
+BEGIN
+    UPDATE metric_value SET computed_at = computed_at
+    WHERE metric_value_id = NEW.metric_value_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_evidence_run_update
+AFTER UPDATE ON metric_run
+BEGIN
+    UPDATE metric_value SET computed_at = computed_at
+    WHERE metric_value_id IN (OLD.metric_value_id, NEW.metric_value_id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_evidence_decision_insert
+AFTER INSERT ON decision_run
+BEGIN
+    UPDATE metric_value SET computed_at = computed_at
+    WHERE metric_value_id = NEW.metric_value_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_evidence_decision_delete
+AFTER DELETE ON decision_run
+BEGIN
+    UPDATE metric_value SET computed_at = computed_at
+    WHERE metric_value_id = OLD.metric_value_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_evidence_result_insert
+AFTER INSERT ON decision_result
+BEGIN
+    UPDATE metric_value SET computed_at = computed_at
+    WHERE metric_value_id = (
+        SELECT metric_value_id FROM decision_run WHERE decision_run_id = NEW.decision_run_id
+    );
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_evidence_result_update
+AFTER UPDATE ON decision_result
+BEGIN
+    UPDATE metric_value SET computed_at = computed_at
+    WHERE metric_value_id IN (
+        SELECT metric_value_id FROM decision_run
+        WHERE decision_run_id IN (OLD.decision_run_id, NEW.decision_run_id)
+    );
+END;
+
+-- bundles count the observations left out of their window, so an event
+-- that is (or stops being) invalid or superseded touches them too
+CREATE TRIGGER IF NOT EXISTS trg_evidence_event_insert
+AFTER INSERT ON event
+WHEN NEW.is_valid = 0 OR NEW.superseded_by IS NOT NULL
+BEGIN
+    DELETE FROM evidence_bundle
+    WHERE device_id = (SELECT device_id FROM device WHERE device_key = NEW.device_key)
+        AND obs_kind = (SELECT obs_kind FROM event_kind WHERE kind_key = NEW.kind_key)
+        AND data_start_ms <= NEW.observed_ms AND end_ms > NEW.observed_ms;
+    INSERT INTO evidence_epoch
+    SELECT device_id, 1 FROM device WHERE device_key = NEW.device_key
+        ON CONFLICT(device_id) DO UPDATE SET epoch = epoch + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_evidence_event_update
+AFTER UPDATE OF device_key, observed_ms, kind_key, is_valid, superseded_by ON event
+WHEN OLD.is_valid = 0 OR OLD.superseded_by IS NOT NULL
+    OR NEW.is_valid = 0 OR NEW.superseded_by IS NOT NULL
+BEGIN
+    DELETE FROM evidence_bundle
+    WHERE (device_id = (SELECT device_id FROM device WHERE device_key = OLD.device_key)
+            AND obs_kind = (SELECT obs_kind FROM event_kind WHERE kind_key = OLD.kind_key)
+            AND data_start_ms <= OLD.observed_ms AND end_ms > OLD.observed_ms)
+        OR (device_id = (SELECT device_id FROM device WHERE device_key = NEW.device_key)
+            AND obs_kind = (SELECT obs_kind FROM event_kind WHERE kind_key = NEW.kind_key)
+            AND data_start_ms <= NEW.observed_ms AND end_ms > NEW.observed_ms);
+    INSERT INTO evidence_epoch
+    SELECT device_id, 1 FROM device WHERE device_key IN (OLD.device_key, NEW.device_key)
+        ON CONFLICT(device_id) DO UPDATE SET epoch = epoch + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_evidence_event_delete
+AFTER DELETE ON event
+WHEN OLD.is_valid = 0 OR OLD.superseded_by IS NOT NULL
+BEGIN
+    DELETE FROM evidence_bundle
+    WHERE device_id = (SELECT device_id FROM device WHERE device_key = OLD.device_key)
+        AND obs_kind = (SELECT obs_kind FROM event_kind WHERE kind_key = OLD.kind_key)
+        AND data_start_ms <= OLD.observed_ms AND end_ms > OLD.observed_ms;
+    INSERT INTO evidence_epoch
+    SELECT device_id, 1 FROM device WHERE device_key = OLD.device_key
+        ON CONFLICT(device_id) DO UPDATE SET epoch = epoch + 1;
+END;
+
+-- model output per evidence content (api/explain.py)
+CREATE TABLE IF NOT EXISTS explanation_cache (
+    content_hash TEXT NOT NULL,        -- evidence_bundle.content_hash
+    model TEXT NOT NULL,
+    prompt_version TEXT NOT NULL,
+    text TEXT NOT NULL,
+    duration_ms INTEGER NOT NULL,
+    created_at TEXT NOT NULL,
+    PRIMARY KEY (content_hash, model, prompt_version)
+) WITHOUT ROWID;
+
+-- weekly / monthly reports and the per-day partials they are rendered
+-- from (api/reports.py)
+CREATE TABLE IF NOT EXISTS report_day (
+    device_id TEXT NOT NULL,
+    day_start_ms INTEGER NOT NULL,     -- local day
+    day_end_ms INTEGER NOT NULL,
+    day_label TEXT NOT NULL,
+    weight_first REAL DEFAULT NULL,
+    weight_last REAL DEFAULT NULL,
+    weight_min REAL DEFAULT NULL,
+    weight_max REAL DEFAULT NULL,
+    weight_sum REAL NOT NULL DEFAULT 0,
+    weight_count INTEGER NOT NULL DEFAULT 0,
+    steps_total INTEGER NOT NULL DEFAULT 0,
+    sleep_hours REAL NOT NULL DEFAULT 0,  -- nights ending this day
+    sleep_nights INTEGER NOT NULL DEFAULT 0,
+    excluded_count INTEGER NOT NULL DEFAULT 0,
+    alerts_json TEXT NOT NULL DEFAULT '[]',
+    PRIMARY KEY (device_id, day_start_ms)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS report (
+    device_id TEXT NOT NULL,
+    period TEXT NOT NULL,              -- 'week' | 'month'
+    period_start_ms INTEGER NOT NULL,
+    period_end_ms INTEGER NOT NULL,
+    period_label TEXT NOT NULL,        -- '2025-W05', '2025-01'
+    body_json TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    built_at TEXT NOT NULL,
+    CHECK (period IN ('week', 'month')),
+    PRIMARY KEY (device_id, period, period_start_ms)
+) WITHOUT ROWID;
+
+-- marks of the last report build
+CREATE TABLE IF NOT EXISTS report_state (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    ingested_hwm TEXT DEFAULT NULL,
+    change_hwm INTEGER DEFAULT NULL,
+    computed_hwm TEXT DEFAULT NULL,
+    decided_hwm TEXT DEFAULT NULL,
+    built_at TEXT DEFAULT NULL
+);
+"""
+
+# writes to the old layout's tables, which are views now (see the module
+# docstring); an omitted column arrives as NULL, so the defaults of the
+# old tables are filled in here
+COMPAT_SQL = """
+CREATE TRIGGER IF NOT EXISTS trg_observation_event_insert
+INSTEAD OF INSERT ON observation_event
+BEGIN
+    SELECT RAISE(ABORT, 'NOT NULL constraint failed: observation_event.observed_at')
+    WHERE NEW.observed_at IS NULL;
+    INSERT INTO device(device_id) SELECT NEW.device_id
+    WHERE NOT EXISTS (SELECT 1 FROM device WHERE device_id = NEW.device_id);
+    INSERT INTO event_kind(obs_kind) SELECT NEW.obs_kind
+    WHERE NOT EXISTS (SELECT 1 FROM event_kind WHERE obs_kind = NEW.obs_kind);
+    INSERT INTO event
+    (event_id, device_key, kind_key, observed_ms, observed_at, is_valid, superseded_by, note)
+    VALUES (
+        NEW.event_id,
+        (SELECT device_key FROM device WHERE device_id = NEW.device_id),
+        (SELECT kind_key FROM event_kind WHERE obs_kind = NEW.obs_kind),
+        NEW.observed_ms,
+        NULLIF(NEW.observed_at,
+               strftime('%Y-%m-%dT%H:%M:%fZ', NEW.observed_ms / 1000.0, 'unixepoch')),
+        COALESCE(NEW.is_valid, 1),
+        NEW.superseded_by,
+        NEW.note
+    );
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_observation_event_update
+INSTEAD OF UPDATE ON observation_event
+BEGIN
+    SELECT RAISE(ABORT, 'NOT NULL constraint failed: observation_event.observed_at')
+    WHERE NEW.observed_at IS NULL;
+    INSERT INTO device(device_id) SELECT NEW.device_id
+    WHERE NOT EXISTS (SELECT 1 FROM device WHERE device_id = NEW.device_id);
+    INSERT INTO event_kind(obs_kind) SELECT NEW.obs_kind
+    WHERE NOT EXISTS (SELECT 1 FROM event_kind WHERE obs_kind = NEW.obs_kind);
+    UPDATE event SET
+        event_id = NEW.event_id,
+        device_key = (SELECT device_key FROM device WHERE device_id = NEW.device_id),
+        kind_key = (SELECT kind_key FROM event_kind WHERE obs_kind = NEW.obs_kind),
+        observed_ms = NEW.observed_ms,
+        observed_at = NULLIF(NEW.observed_at,
+                             strftime('%Y-%m-%dT%H:%M:%fZ', NEW.observed_ms / 1000.0, 'unixepoch')),
+        is_valid = NEW.is_valid,
+        superseded_by = NEW.superseded_by,
+        note = NEW.note
+    WHERE event_key = OLD.event_key;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_observation_event_delete
+INSTEAD OF DELETE ON observation_event
+BEGIN
+    DELETE FROM event WHERE event_key = OLD.event_key;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_observation_provenance_insert
+INSTEAD OF INSERT ON observation_provenance
+BEGIN
+    SELECT RAISE(ABORT, 'FOREIGN KEY constraint failed')
+    WHERE NOT EXISTS (SELECT 1 FROM event WHERE event_id = NEW.event_id);
+    INSERT INTO event_provenance
+    (event_key, source_kind, app_version, ingested_at, provenance_json)
+    SELECT event_key, COALESCE(NEW.source_kind, 'unknown'), NEW.app_version,
+        COALESCE(NEW.ingested_at, strftime('%Y-%m-%dT%H:%M:%fZ', 'now')), NEW.provenance_json
+    FROM event WHERE event_id = NEW.event_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_observation_provenance_update
+INSTEAD OF UPDATE ON observation_provenance
+BEGIN
+    SELECT RAISE(ABORT, 'FOREIGN KEY constraint failed')
+    WHERE NOT EXISTS (SELECT 1 FROM event WHERE event_id = NEW.event_id);
+    UPDATE event_provenance SET
+        event_key = (SELECT event_key FROM event WHERE event_id = NEW.event_id),
+        source_kind = NEW.source_kind,
+        app_version = NEW.app_version,
+        ingested_at = NEW.ingested_at,
+        provenance_json = NEW.provenance_json
+    WHERE event_key = (SELECT event_key FROM event WHERE event_id = OLD.event_id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_observation_provenance_delete
+INSTEAD OF DELETE ON observation_provenance
+BEGIN
+    DELETE FROM event_provenance
+    WHERE event_key = (SELECT event_key FROM event WHERE event_id = OLD.event_id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_obs_steps_insert
+INSTEAD OF INSERT ON obs_steps
+BEGIN
+    SELECT RAISE(ABORT, 'FOREIGN KEY constraint failed')
+    WHERE NOT EXISTS (SELECT 1 FROM event WHERE event_id = NEW.event_id);
+    INSERT INTO event_steps(event_key, step_value, step_mode)
+    SELECT event_key, NEW.step_value, NEW.step_mode FROM event WHERE event_id = NEW.event_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_obs_steps_update
+INSTEAD OF UPDATE ON obs_steps
+BEGIN
+    SELECT RAISE(ABORT, 'FOREIGN KEY constraint failed')
+    WHERE NOT EXISTS (SELECT 1 FROM event WHERE event_id = NEW.event_id);
+    UPDATE event_steps SET
+        event_key = (SELECT event_key FROM event WHERE event_id = NEW.event_id),
+        step_value = NEW.step_value,
+        step_mode = NEW.step_mode
+    WHERE event_key = (SELECT event_key FROM event WHERE event_id = OLD.event_id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_obs_steps_delete
+INSTEAD OF DELETE ON obs_steps
+BEGIN
+    DELETE FROM event_steps
+    WHERE event_key = (SELECT event_key FROM event WHERE event_id = OLD.event_id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_obs_weight_insert
+INSTEAD OF INSERT ON obs_weight
+BEGIN
+    SELECT RAISE(ABORT, 'FOREIGN KEY constraint failed')
+    WHERE NOT EXISTS (SELECT 1 FROM event WHERE event_id = NEW.event_id);
+    INSERT INTO event_weight(event_key, body_mass_kg)
+    SELECT event_key, NEW.body_mass_kg FROM event WHERE event_id = NEW.event_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_obs_weight_update
+INSTEAD OF UPDATE ON obs_weight
+BEGIN
+    SELECT RAISE(ABORT, 'FOREIGN KEY constraint failed')
+    WHERE NOT EXISTS (SELECT 1 FROM event WHERE event_id = NEW.event_id);
+    UPDATE event_weight SET
+        event_key = (SELECT event_key FROM event WHERE event_id = NEW.event_id),
+        body_mass_kg = NEW.body_mass_kg
+    WHERE event_key = (SELECT event_key FROM event WHERE event_id = OLD.event_id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_obs_weight_delete
+INSTEAD OF DELETE ON obs_weight
+BEGIN
+    DELETE FROM event_weight
+    WHERE event_key = (SELECT event_key FROM event WHERE event_id = OLD.event_id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_obs_sleep_state_insert
+INSTEAD OF INSERT ON obs_sleep_state
+BEGIN
+    SELECT RAISE(ABORT, 'FOREIGN KEY constraint failed')
+    WHERE NOT EXISTS (SELECT 1 FROM event WHERE event_id = NEW.event_id);
+    INSERT INTO event_sleep_state(event_key, state)
+    SELECT event_key, NEW.state FROM event WHERE event_id = NEW.event_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_obs_sleep_state_update
+INSTEAD OF UPDATE ON obs_sleep_state
+BEGIN
+    SELECT RAISE(ABORT, 'FOREIGN KEY constraint failed')
+    WHERE NOT EXISTS (SELECT 1 FROM event WHERE event_id = NEW.event_id);
+    UPDATE event_sleep_state SET
+        event_key = (SELECT event_key FROM event WHERE event_id = NEW.event_id),
+        state = NEW.state
+    WHERE event_key = (SELECT event_key FROM event WHERE event_id = OLD.event_id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_obs_sleep_state_delete
+INSTEAD OF DELETE ON obs_sleep_state
+BEGIN
+    DELETE FROM event_sleep_state
+    WHERE event_key = (SELECT event_key FROM event WHERE event_id = OLD.event_id);
+END;
+"""
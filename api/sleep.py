@@ -0,0 +1,238 @@
+"""
+Sleep sessions derived from obs_sleep_state transitions.
+
+Each valid sleep_state sample lasts until the next sample of its
+device, capped at MAX_SLEEP_GAP_MS. A session is a run of non-wake
+samples. Wake samples between them count towards the session's
+per-state durations, but a stretch of more than SESSION_BREAK_MS
+without a non-wake sample ends it. So a night with a short wake-up is
+one session, and the next night or a nap is a new one.
+
+sleep_session keeps start/end, asleep time, per-state durations and
+source per session, with an interval index on (device_id, end_ms,
+start_ms); "sleep in the last 14 nights" is a range read. refresh() is
+handed the dirty minute keys and re-derives only the sessions near them.
+
+    python -m api.sleep rebuild [device_id]
+"""
+import json
+import sqlite3
+import sys
+
+import numpy as np
+
+from . import archive
+
+
+HOUR_MS = 3_600_000
+
+# sleep_state strings that do not count as sleep
+AWAKE_STATES = ("awake", "inBed", "in_bed", "HKCategoryValueSleepAnalysisAwake",
+                "HKCategoryValueSleepAnalysisInBed")
+# ...and the ones that are not part of a session at all
+WAKE_STATES = ("awake", "HKCategoryValueSleepAnalysisAwake")
+# an unfinished sleep state stops counting after this long
+MAX_SLEEP_GAP_MS = 4 * HOUR_MS
+SESSION_BREAK_MS = 2 * HOUR_MS
+
+SAMPLES_SQL = """
+    SELECT e.event_id, e.observed_ms, ss.state, COALESCE(p.source_kind, 'unknown')
+    FROM observation_event e
+    JOIN event_sleep_state ss ON ss.event_key = e.event_key
+    LEFT JOIN event_provenance p ON p.event_key = e.event_key
+    WHERE e.device_id = ? AND e.observed_ms >= ? AND e.observed_ms < ?
+        AND e.obs_kind = 'sleep_state' AND e.is_valid = 1 AND e.superseded_by IS NULL
+    ORDER BY e.observed_ms, e.event_id
+"""
+
+NEXT_SQL = """
+    SELECT e.event_id, e.observed_ms, ss.state, 'unknown'
+    FROM observation_event e
+    JOIN event_sleep_state ss ON ss.event_key = e.event_key
+    WHERE e.device_id = ? AND e.observed_ms >= ?
+        AND e.obs_kind = 'sleep_state' AND e.is_valid = 1 AND e.superseded_by IS NULL
+    ORDER BY e.observed_ms, e.event_id
+    LIMIT 1
+"""
+
+OVERLAP_SQL = """
+    SELECT MIN(start_ms), MAX(end_ms) FROM sleep_session
+    WHERE device_id = ? AND end_ms >= ? AND start_ms <= ?
+"""
+
+INSERT_SQL = """
+    INSERT INTO sleep_session
+    (session_id, device_id, start_ms, end_ms, asleep_ms, state_ms_json, sample_count, source_kind)
+    values(?,?,?,?,?,?,?,?)
+"""
+
+
+def sessions(device_id: str, rows: list[tuple]) -> list[tuple]:
+    """
+    INSERT_SQL rows for the sessions in time-ordered SAMPLES_SQL rows.
+    The last row only bounds the one before it unless nothing follows.
+    """
+    if not rows:
+        return []
+    t = np.fromiter((r[1] for r in rows), dtype=np.int64, count=len(rows))
+    states = np.array([r[2] for r in rows], dtype=object)
+    duration = np.minimum(np.diff(t, append=t[-1]), MAX_SLEEP_GAP_MS)
+    member = ~np.isin(states, WAKE_STATES)
+    asleep = ~np.isin(states, AWAKE_STATES)
+
+    idx = np.flatnonzero(member)
+    if not len(idx):
+        return []
+    ends = t[idx] + duration[idx]
+    # a new session starts where the previous member ended too long ago
+    breaks = np.flatnonzero(t[idx[1:]] - ends[:-1] > SESSION_BREAK_MS) + 1
+    out = []
+    for part in np.split(np.arange(len(idx)), breaks):
+        first, last = idx[part[0]], idx[part[-1]]
+        span = slice(first, last + 1)
+        per_state: dict[str, int] = {}
+        for state, ms in zip(states[span].tolist(), duration[span].tolist()):
+            per_state[state] = per_state.get(state, 0) + ms
+        sources = {r[3] for r in rows[first:last + 1]}
+        out.append((
+            rows[first][0], device_id, int(t[first]), int(ends[part[-1]]),
+            int(duration[span][asleep[span]].sum()),
+            json.dumps(per_state, sort_keys=True), int(last - first + 1),
+            sources.pop() if len(sources) == 1 else "mixed",
+        ))
+    return out
+
+
+def _window(conn: sqlite3.Connection, device_id: str, lo: int, hi: int) -> tuple[int, int]:
+    """
+    grow [lo, hi) over every session close enough to chain into it; once
+    stable, no non-wake sample outside it can join a session inside it
+    """
+    reach = MAX_SLEEP_GAP_MS + SESSION_BREAK_MS
+    while True:
+        row = conn.execute(OVERLAP_SQL, (device_id, lo - reach, hi + reach)).fetchone()
+        if row[0] is None or (row[0] >= lo and row[1] <= hi):
+            return lo, hi
+        lo, hi = min(lo, row[0]), max(hi, row[1])
+
+
+def _derive(conn: sqlite3.Connection, device_id: str, lo: int, hi: int) -> int:
+    lo, hi = _window(conn, device_id, lo, hi)
+    conn.execute(
+        "DELETE FROM sleep_session WHERE device_id = ? AND end_ms >= ? AND start_ms < ?",
+        (device_id, lo, hi),
+    )
+    # up to a gap past hi, plus the sample after that if any, so every
+    # duration inside the window is bounded the same way a full scan would
+    rows = conn.execute(SAMPLES_SQL, (device_id, lo, hi + MAX_SLEEP_GAP_MS)).fetchall()
+    nxt = conn.execute(NEXT_SQL, (device_id, hi + MAX_SLEEP_GAP_MS)).fetchone()
+    if nxt is not None:
+        rows.append(nxt)
+    found = [s for s in sessions(device_id, rows) if lo <= s[2] < hi]
+    conn.executemany(INSERT_SQL, found)
+    return len(found)
+
+
+def refresh(conn: sqlite3.Connection, keys) -> int:
+    """
+    re-derive the sessions near the (device_id, minute_bucket) keys
+    """
+    by_device: dict[str, list[int]] = {}
+    for device_id, minute_bucket in keys:
+        by_device.setdefault(device_id, []).append(minute_bucket * 60_000)
+    n = 0
+    for device_id, times in by_device.items():
+        times.sort()
+        lo = prev = times[0]
+        for ms in times[1:]:
+            if ms - prev > MAX_SLEEP_GAP_MS + SESSION_BREAK_MS:
+                n += _derive(conn, device_id, lo, prev + 60_000)
+                lo = ms
+            prev = ms
+        n += _derive(conn, device_id, lo, prev + 60_000)
+    return n
+
+
+def _rebuild_span(conn: sqlite3.Connection, device_id: str, lo: int, hi: int) -> int:
+    """
+    re-derive the sessions starting in [lo, hi), a span without archived
+    months; a session from an archived month before it keeps the samples
+    it runs on into the span
+    """
+    conn.execute(
+        "DELETE FROM sleep_session WHERE device_id = ? AND start_ms >= ? AND start_ms < ?",
+        (device_id, lo, hi),
+    )
+    start = conn.execute(
+        "SELECT MAX(end_ms) FROM sleep_session WHERE device_id = ? AND start_ms < ? AND end_ms > ?",
+        (device_id, lo, lo),
+    ).fetchone()[0]
+    rows = conn.execute(SAMPLES_SQL, (device_id, start or lo, hi + MAX_SLEEP_GAP_MS)).fetchall()
+    nxt = conn.execute(NEXT_SQL, (device_id, hi + MAX_SLEEP_GAP_MS)).fetchone()
+    if nxt is not None:
+        rows.append(nxt)
+    found = [s for s in sessions(device_id, rows) if lo <= s[2] < hi]
+    conn.executemany(INSERT_SQL, found)
+    return len(found)
+
+
+def rebuild(conn: sqlite3.Connection, device_id: str | None = None) -> int:
+    if device_id is None:
+        conn.execute("DELETE FROM sleep_session WHERE NOT " + archive.ARCHIVED_SQL.format(
+            table="sleep_session", ms="sleep_session.start_ms"
+        ))
+        devices = [r[0] for r in conn.execute(
+            "SELECT DISTINCT device_id FROM observation_event WHERE obs_kind = 'sleep_state'"
+        )]
+    else:
+        devices = [device_id]
+    return sum(
+        _rebuild_span(conn, device, lo, hi)
+        for device in devices
+        for lo, hi in archive.live_spans(conn, device)
+    )
+
+
+def query(conn: sqlite3.Connection, device_id: str, start_ms: int, end_ms: int) -> list[dict]:
+    """
+    sessions overlapping [start_ms, end_ms), on the interval index
+    """
+    conn.row_factory = sqlite3.Row
+    try:
+        rows = conn.execute(
+            """
+            SELECT * FROM sleep_session
+            WHERE device_id = ? AND end_ms > ? AND start_ms < ?
+            ORDER BY start_ms
+            """,
+            (device_id, start_ms, end_ms),
+        ).fetchall()
+    finally:
+        conn.row_factory = None
+    out = []
+    for r in rows:
+        d = dict(r)
+        d["state_ms"] = json.loads(d.pop("state_ms_json"))
+        out.append(d)
+    return out
+
+
+def main(argv=None):
+    from . import db
+
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] != "rebuild":
+        print("usage: python -m api.sleep rebuild [device_id]")
+        return 2
+    conn = db.connect()
+    try:
+        with conn:
+            n = rebuild(conn, argv[1] if len(argv) > 1 else None)
+        print(f"sleep_session rebuilt: {n} sessions")
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
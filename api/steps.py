@@ -0,0 +1,256 @@
+"""
+Step-mode normalisation into steps_normalized.
+
+obs_steps mixes three modes: 'delta' (steps in the interval),
+'cumulative' (a counter that restarts, e.g. every local day) and
+'device_total' (a lifetime counter that restarts on reboot). Every valid
+sample gets one steps_normalized row with the steps it adds, so totals
+over any range are a plain indexed SUM(step_delta) on
+idx_steps_normalized_device_time.
+
+Counters are diffed per (device, mode) series with NumPy. A drop marks a
+reset, and the sample then counts as its own value. The first sample of
+a series has no baseline: a cumulative one counts its value, while a
+device_total one counts nothing.
+
+A device that reports the same walking in several modes (a phone's
+deltas and a watch's counter) would count it twice, so within each UTC
+hour only the first of MODES the device has samples in counts; the
+other modes' rows are kept with step_delta 0. A counter sample right
+after hours another mode had still counts everything since its previous
+sample.
+
+refresh() is handed the minute keys that api/fused.py refreshed. It
+re-derives those ranges plus the next sample after each one, whose delta
+depends on them, and reports every minute whose steps changed. Archived
+events (api/archive.py) keep their deltas; the sample just before a
+range may come from the archive, and rebuild() skips archived months.
+
+    python -m api.steps rebuild [device_id]
+"""
+import sqlite3
+import sys
+
+import numpy as np
+
+from . import archive
+
+
+# in precedence order: per hour, the first mode with samples counts
+MODES = ("delta", "cumulative", "device_total")
+
+HOUR_MS = 3_600_000
+
+# dirty minutes closer than this are re-derived as one range
+MERGE_GAP_MS = 6 * 3_600_000
+
+SAMPLES_SQL = """
+    SELECT e.event_id, e.observed_ms, os.step_value
+    FROM observation_event e
+    JOIN event_steps os ON os.event_key = e.event_key
+    WHERE e.device_id = ? AND os.step_mode = ?
+        AND e.observed_ms >= ? AND e.observed_ms < ?
+        AND e.obs_kind = 'steps' AND e.is_valid = 1 AND e.superseded_by IS NULL
+    ORDER BY e.observed_ms, e.event_id
+"""
+
+# neighbours of a range in one series; same filters as SAMPLES_SQL
+BEFORE_SQL = """
+    SELECT e.observed_ms, e.event_id, os.step_value
+    FROM observation_event e
+    JOIN event_steps os ON os.event_key = e.event_key
+    WHERE e.device_id = ? AND os.step_mode = ? AND e.observed_ms < ?
+        AND e.obs_kind = 'steps' AND e.is_valid = 1 AND e.superseded_by IS NULL
+    ORDER BY e.observed_ms DESC, e.event_id DESC
+    LIMIT 1
+"""
+
+AFTER_SQL = """
+    SELECT e.event_id, e.observed_ms, os.step_value
+    FROM observation_event e
+    JOIN event_steps os ON os.event_key = e.event_key
+    WHERE e.device_id = ? AND os.step_mode = ? AND e.observed_ms >= ?
+        AND e.obs_kind = 'steps' AND e.is_valid = 1 AND e.superseded_by IS NULL
+    ORDER BY e.observed_ms, e.event_id
+    LIMIT 1
+"""
+
+# step modes with a sample in one hour; same filters as SAMPLES_SQL
+HOUR_MODES_SQL = """
+    SELECT DISTINCT os.step_mode
+    FROM observation_event e
+    JOIN event_steps os ON os.event_key = e.event_key
+    WHERE e.device_id = ? AND e.observed_ms >= ? AND e.observed_ms < ?
+        AND e.obs_kind = 'steps' AND e.is_valid = 1 AND e.superseded_by IS NULL
+"""
+
+INSERT_SQL = """
+    INSERT OR REPLACE INTO steps_normalized
+    (event_id, device_id, observed_ms, step_mode, step_delta, is_reset)
+    values(?,?,?,?,?,?)
+"""
+
+
+def normalize(values: np.ndarray, mode: str, baseline: float | None = None):
+    """
+    (deltas, resets) for one time-ordered series; baseline is the value
+    of the sample just before it, if any
+    """
+    values = values.astype(np.int64)
+    if mode == "delta":
+        return np.maximum(values, 0), np.zeros(len(values), dtype=bool)
+    prev = np.empty(len(values), dtype=np.float64)
+    prev[:1] = np.nan if baseline is None else baseline
+    prev[1:] = values[:-1]
+    with np.errstate(invalid="ignore"):
+        diff = values - prev
+        dropped = diff < 0
+    start = np.isnan(prev)
+    deltas = np.where(dropped, values, np.nan_to_num(diff)).astype(np.int64)
+    if mode == "cumulative":
+        deltas[start] = values[start]
+    else:
+        deltas[start] = 0
+    return deltas, dropped | start
+
+
+def _ranges(minutes: list[int]) -> list[tuple[int, int]]:
+    """
+    [lo, hi) ms ranges covering sorted minute buckets, split at big gaps
+    """
+    out = []
+    lo = prev = minutes[0] * 60_000
+    for m in minutes[1:]:
+        ms = m * 60_000
+        if ms - prev > MERGE_GAP_MS:
+            out.append((lo, prev + 60_000))
+            lo = ms
+        prev = ms
+    out.append((lo, prev + 60_000))
+    return out
+
+
+def _normalize_range(conn: sqlite3.Connection, device_id: str, lo: int, hi: int) -> list[tuple]:
+    """
+    re-derive [lo, hi) of one device, widened to whole hours, plus the
+    next sample of each series. Only rows whose delta changed are written;
+    returns their (device_id, minute_bucket) keys, so rollups can follow.
+    """
+    lo, hi = lo - lo % HOUR_MS, hi + -hi % HOUR_MS
+    old = {
+        r[0]: r[1:]
+        for r in conn.execute(
+            """
+            SELECT event_id, observed_ms, step_delta, is_reset FROM steps_normalized
+            WHERE device_id = ? AND observed_ms >= ? AND observed_ms < ?
+            """,
+            (device_id, lo, hi),
+        )
+    }
+    rows = []
+    for mode in MODES:
+        samples = conn.execute(SAMPLES_SQL, (device_id, mode, lo, hi)).fetchall()
+        if mode != "delta":
+            nxt = conn.execute(AFTER_SQL, (device_id, mode, hi)).fetchone()
+            if nxt is not None:
+                samples.append(nxt)
+                prior = conn.execute(
+                    "SELECT observed_ms, step_delta, is_reset FROM steps_normalized WHERE event_id = ?",
+                    (nxt[0],),
+                ).fetchone()
+                if prior is not None:
+                    old[nxt[0]] = prior
+        if not samples:
+            continue
+        baseline = None
+        if mode != "delta":
+            row = conn.execute(BEFORE_SQL, (device_id, mode, lo)).fetchone()
+            # only archived samples after the live one can replace it
+            archived = archive.last_step(conn, device_id, mode, row[0] if row else -(2**62), lo)
+            row = max((r for r in (row, archived) if r is not None), default=None)
+            baseline = row[2] if row else None
+        values = np.fromiter((s[2] for s in samples), dtype=np.int64, count=len(samples))
+        deltas, resets = normalize(values, mode, baseline)
+        rows.extend(
+            (s[0], device_id, s[1], mode, d, int(r))
+            for s, d, r in zip(samples, deltas.tolist(), resets.tolist())
+        )
+
+    # every sample of [lo, hi) was read; the hours of next samples past it are looked up
+    first: dict[int, int] = {}
+    for r in rows:
+        if r[2] < hi:
+            hour = r[2] // HOUR_MS
+            first[hour] = min(first.get(hour, len(MODES)), MODES.index(r[3]))
+    for r in rows:
+        hour = r[2] // HOUR_MS
+        if hour not in first:
+            first[hour] = min(MODES.index(m) for (m,) in conn.execute(
+                HOUR_MODES_SQL, (device_id, hour * HOUR_MS, (hour + 1) * HOUR_MS)
+            ))
+    rows = [r if MODES.index(r[3]) == first[r[2] // HOUR_MS] else (*r[:4], 0, r[5])
+            for r in rows]
+
+    changed = [r for r in rows if old.pop(r[0], None) != (r[2], r[4], r[5])]
+    # what is left in old is no longer a valid sample
+    conn.executemany("DELETE FROM steps_normalized WHERE event_id = ?", [(e,) for e in old])
+    conn.executemany(INSERT_SQL, changed)
+    return ([(device_id, r[2] // 60_000) for r in changed]
+            + [(device_id, ms // 60_000) for ms, _, _ in old.values()])
+
+
+def refresh(conn: sqlite3.Connection, keys) -> list[tuple]:
+    """
+    re-derive the ranges holding the (device_id, minute_bucket) keys.
+    Returns the keys whose steps changed, which can reach past the given
+    ones (a counter sample also sets the delta of the sample after it).
+    """
+    by_device: dict[str, list[int]] = {}
+    for device_id, minute_bucket in keys:
+        by_device.setdefault(device_id, []).append(minute_bucket)
+    changed = []
+    for device_id, minutes in by_device.items():
+        for lo, hi in _ranges(sorted(set(minutes))):
+            changed.extend(_normalize_range(conn, device_id, lo, hi))
+    return changed
+
+
+def rebuild(conn: sqlite3.Connection, device_id: str | None = None) -> int:
+    """
+    re-derive every month without an archive segment, of one device or
+    of every device
+    """
+    if device_id is None:
+        conn.execute("DELETE FROM steps_normalized WHERE NOT " + archive.ARCHIVED_SQL.format(
+            table="steps_normalized", ms="steps_normalized.observed_ms"
+        ))
+        devices = [r[0] for r in conn.execute(
+            "SELECT DISTINCT device_id FROM observation_event WHERE obs_kind = 'steps'"
+        )]
+    else:
+        devices = [device_id]
+    for device in devices:
+        for lo, hi in archive.live_spans(conn, device):
+            _normalize_range(conn, device, lo, hi)
+    return conn.execute("SELECT COUNT(*) FROM steps_normalized").fetchone()[0]
+
+
+def main(argv=None):
+    from . import db
+
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] != "rebuild":
+        print("usage: python -m api.steps rebuild [device_id]")
+        return 2
+    conn = db.connect()
+    try:
+        with conn:
+            n = rebuild(conn, argv[1] if len(argv) > 1 else None)
+        print(f"steps_normalized rebuilt: {n} rows")
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,183 @@
+import asyncio
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+from . import instrument
+
+
+_STOP = object()
+
+
+class _Job:
+    __slots__ = ("fn", "rows", "future", "queued")
+
+    def __init__(self, fn, rows):
+        self.fn = fn
+        self.rows = rows
+        self.future = Future()
+        self.queued = time.perf_counter()
+
+
+class GroupCommitWriter:
+    """
+    single writer thread that owns the only write connection.
+
+    Jobs from every endpoint are queued and coalesced into one transaction
+    per batch (at most batch_ms after the first job, or batch_rows rows).
+    Each job runs inside its own SAVEPOINT, so a constraint failure only
+    rolls back and fails that job; its future resolves once the batch has
+    committed. before_commit(conn), if given, runs after the last job and
+    inside the same transaction (derived tables are refreshed there); if it
+    or the COMMIT fails, the batch is rolled back and every job in it fails.
+    """
+
+    def __init__(self, connect, batch_ms: float = 10, batch_rows: int = 1000,
+                 before_commit=None):
+        self._connect = connect
+        self._before_commit = before_commit
+        self.batch_ms = batch_ms
+        self.batch_rows = batch_rows
+        self._queue: queue.Queue = queue.Queue()
+        self._thread: threading.Thread | None = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._loop, name="sqlite-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10):
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def submit(self, fn, rows: int = 1) -> Future:
+        """
+        queue fn(conn) for the next batch; rows is only used for batch sizing
+        """
+        if self._thread is None:
+            raise RuntimeError("writer is not running")
+        job = _Job(fn, rows)
+        self._queue.put(job)
+        return job.future
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    async def run(self, fn, rows: int = 1):
+        return await asyncio.wrap_future(self.submit(fn, rows))
+
+    async def execute(self, sql: str, params=()) -> int:
+        return await self.run(lambda conn: conn.execute(sql, params).rowcount)
+
+    async def executemany(self, sql: str, seq_of_params: list) -> int:
+        return await self.run(
+            lambda conn: conn.executemany(sql, seq_of_params).rowcount,
+            rows=max(1, len(seq_of_params)),
+        )
+
+    def _loop(self):
+        conn = self._connect()
+        conn.isolation_level = None  # explicit BEGIN/COMMIT below
+        try:
+            stopping = False
+            while not stopping:
+                job = self._queue.get()
+                if job is _STOP:
+                    break
+                batch = [job]
+                rows = job.rows
+                deadline = time.monotonic() + self.batch_ms / 1000
+                while rows < self.batch_rows:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    try:
+                        job = self._queue.get(timeout=timeout)
+                    except queue.Empty:
+                        break
+                    if job is _STOP:
+                        stopping = True
+                        break
+                    batch.append(job)
+                    rows += job.rows
+                self._commit_safely(conn, batch)
+
+            # drain whatever was queued behind the stop marker
+            leftover = []
+            while True:
+                try:
+                    job = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if job is not _STOP:
+                    leftover.append(job)
+            if leftover:
+                self._commit_safely(conn, leftover)
+        finally:
+            conn.close()
+
+    def _commit_safely(self, conn: sqlite3.Connection, batch: list):
+        """
+        _commit, but an error outside the transaction (instrumentation,
+        resolving futures) fails the jobs still pending instead of ending
+        the writer thread
+        """
+        try:
+            self._commit(conn, batch)
+        except Exception as e:
+            for job in batch:
+                if not job.future.done():
+                    job.future.set_exception(e)
+
+    def _commit(self, conn: sqlite3.Connection, batch: list):
+        batch = [job for job in batch if job.future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+
+        outcomes = []
+        started = time.perf_counter()
+        for job in batch:
+            instrument.WRITER_QUEUE.observe(started - job.queued)
+        changes = conn.total_changes
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            instrument.WRITER_LOCK.observe(time.perf_counter() - started)
+            for job in batch:
+                conn.execute("SAVEPOINT job")
+                try:
+                    result = job.fn(conn)
+                    conn.execute("RELEASE job")
+                    outcomes.append((job, result, None))
+                except Exception as e:
+                    conn.execute("ROLLBACK TO job")
+                    conn.execute("RELEASE job")
+                    outcomes.append((job, None, e))
+            if self._before_commit is not None:
+                self._before_commit(conn)
+            conn.execute("COMMIT")
+            instrument.WRITER_COMMIT.observe(time.perf_counter() - started)
+            instrument.WRITER_JOBS.observe(len(batch))
+            instrument.WRITER_CHANGES.observe(conn.total_changes - changes)
+        except Exception as e:
+            # anything after BEGIN (before_commit included) fails the whole
+            # batch; the thread lives on for the next one
+            try:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+            except sqlite3.Error:
+                pass
+            for job in batch:
+                job.future.set_exception(e)
+            return
+
+        for job, result, error in outcomes:
+            if error is None:
+                job.future.set_result(result)
+            else:
+                job.future.set_exception(error)
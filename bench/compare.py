@@ -0,0 +1,50 @@
+"""
+Side-by-side view of two bench.run reports.
+
+    python -m bench.compare old.json new.json
+"""
+import json
+import sys
+
+
+def _ratio(old, new) -> str:
+    if not old or new is None:
+        return ""
+    return f"{new / old:6.2f}x"
+
+
+def rows(old: dict, new: dict):
+    """
+    (label, old, new) for every number worth comparing
+    """
+    for key in ("ingest_bulk", "ingest_single"):
+        yield f"{key} rows/s", old.get(key, {}).get("rows_per_s"), new.get(key, {}).get("rows_per_s")
+    for path in sorted(set(old.get("engines", {})) | set(new.get("engines", {}))):
+        yield (f"{path} s", old.get("engines", {}).get(path, {}).get("seconds"),
+               new.get("engines", {}).get(path, {}).get("seconds"))
+    for section in ("endpoints", "sql"):
+        labels = sorted(set(old.get(section, {})) | set(new.get(section, {})))
+        for label in labels:
+            for stat in ("p50_ms", "p99_ms"):
+                yield (f"{label} {stat}", old.get(section, {}).get(label, {}).get(stat),
+                       new.get(section, {}).get(label, {}).get(stat))
+    yield "db bytes", old.get("db", {}).get("bytes"), new.get("db", {}).get("bytes")
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 2:
+        print("usage: python -m bench.compare old.json new.json")
+        return 2
+    with open(argv[0], encoding="utf-8") as f:
+        old = json.load(f)
+    with open(argv[1], encoding="utf-8") as f:
+        new = json.load(f)
+    print(f"old: {old['meta'].get('commit')}  new: {new['meta'].get('commit')}")
+    for label, a, b in rows(old, new):
+        print(f"{label:<48} {a if a is not None else '-':>12} {b if b is not None else '-':>12} {_ratio(a, b)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,162 @@
+"""
+Seeded synthetic observations for benchmarks.
+
+Every device gets, per day:
+- one or two weigh-ins (a slow drift plus noise), a few later corrected
+  by a new reading that supersedes them, a few marked invalid
+- steps in all three step_modes, the same walking seen three ways:
+  hourly 'delta' samples from a phone, a 'cumulative' counter that
+  restarts at local midnight, and a 'device_total' lifetime counter with
+  the odd reboot (api/steps.py counts one mode per hour)
+- a night of sleep_state transitions (in bed, light/deep/REM, short
+  wake-ups) ending in 'awake'
+
+Records are the combined shape POST /observations/bulk and
+ingest.insert_observations take, ordered by time. The same seed always
+gives the same records, event ids included.
+
+    python -m bench.generate --devices 3 --days 30 [--seed 1] [--out data.ndjson]
+"""
+import argparse
+import json
+import random
+import sys
+import uuid
+from datetime import datetime, timezone
+
+
+BENCH_NAMESPACE = uuid.UUID("9c1e7b52-3f0a-4d8e-b6a2-5e4f1c0d7a93")
+
+DAY_MS = 86_400_000
+HOUR_MS = 3_600_000
+MINUTE_MS = 60_000
+
+# 2024-01-01T00:00:00Z
+DEFAULT_START_MS = 1_704_067_200_000
+
+SLEEP_STAGES = ("asleepCore", "asleepDeep", "asleepREM")
+
+
+def iso(ms: int) -> str:
+    dt = datetime.fromtimestamp(ms // 1000, tz=timezone.utc)
+    return f"{dt:%Y-%m-%dT%H:%M:%S}.{ms % 1000:03d}Z"
+
+
+class Device:
+    def __init__(self, index: int, seed: int, start_ms: int):
+        self.device_id = f"bench-{index:03d}"
+        self.seed = seed
+        self.rng = random.Random(f"{seed}:{index}")
+        self.start_ms = start_ms
+        self.weight = self.rng.uniform(55, 95)
+        self.lifetime = self.rng.randrange(0, 5_000_000)
+        self.n = 0
+
+    def _record(self, ms: int, kind: str, source: str, **payload) -> dict:
+        self.n += 1
+        event_id = str(uuid.uuid5(BENCH_NAMESPACE, f"{self.seed}:{self.device_id}:{self.n}"))
+        record = {
+            "event": {
+                "event_id": event_id,
+                "device_id": self.device_id,
+                "observed_at": iso(ms),
+                "observed_ms": ms,
+                "obs_kind": kind,
+            },
+            "provenance": {"source_kind": source, "app_version": "bench-1"},
+        }
+        record.update(payload)
+        return record
+
+    def _weights(self, day_ms: int) -> list[dict]:
+        out = []
+        self.weight += self.rng.gauss(0, 0.08)
+        for _ in range(self.rng.choice((1, 1, 2))):
+            ms = day_ms + self.rng.randrange(6 * HOUR_MS, 22 * HOUR_MS)
+            kg = round(self.weight + self.rng.gauss(0, 0.3), 2)
+            rec = self._record(ms, "weight", "scale", weight={"body_mass_kg": kg})
+            roll = self.rng.random()
+            if roll < 0.03:
+                # corrected a few minutes later; the first reading is superseded
+                fix = self._record(ms + self.rng.randrange(1, 10) * MINUTE_MS, "weight", "manual",
+                                   weight={"body_mass_kg": round(self.weight, 2)})
+                rec["event"]["superseded_by"] = fix["event"]["event_id"]
+                out.extend((rec, fix))
+                continue
+            if roll < 0.05:
+                rec["event"]["is_valid"] = False
+                rec["event"]["note"] = "bench: flagged outlier"
+            out.append(rec)
+        return out
+
+    def _steps(self, day_ms: int) -> list[dict]:
+        out = []
+        today = 0
+        if self.rng.random() < 0.02:
+            self.lifetime = 0  # reboot
+        for hour in range(7, 23):
+            ms = day_ms + hour * HOUR_MS + self.rng.randrange(0, HOUR_MS)
+            walked = max(0, int(self.rng.gauss(450, 300)))
+            today += walked
+            self.lifetime += walked
+            out.append(self._record(ms, "steps", "phone",
+                                    steps={"step_value": walked, "step_mode": "delta"}))
+            if hour % 2 == 0:
+                out.append(self._record(ms + MINUTE_MS, "steps", "watch",
+                                        steps={"step_value": today, "step_mode": "cumulative"}))
+            if hour % 4 == 0:
+                out.append(self._record(ms + 2 * MINUTE_MS, "steps", "band",
+                                        steps={"step_value": self.lifetime, "step_mode": "device_total"}))
+        return out
+
+    def _sleep(self, day_ms: int) -> list[dict]:
+        out = []
+        ms = day_ms - self.rng.randrange(0, 2 * HOUR_MS) - HOUR_MS  # ~22:00-23:00
+        out.append(self._record(ms, "sleep_state", "watch", sleep_state={"state": "inBed"}))
+        end = ms + self.rng.randrange(6 * HOUR_MS, 9 * HOUR_MS)
+        ms += self.rng.randrange(5, 30) * MINUTE_MS
+        while ms < end:
+            state = "awake" if self.rng.random() < 0.08 else self.rng.choice(SLEEP_STAGES)
+            out.append(self._record(ms, "sleep_state", "watch", sleep_state={"state": state}))
+            ms += self.rng.randrange(10, 60) * MINUTE_MS
+        out.append(self._record(end, "sleep_state", "watch", sleep_state={"state": "awake"}))
+        return out
+
+    def day(self, d: int) -> list[dict]:
+        day_ms = self.start_ms + d * DAY_MS
+        records = self._sleep(day_ms) + self._weights(day_ms) + self._steps(day_ms)
+        records.sort(key=lambda r: r["event"]["observed_ms"])
+        return records
+
+
+def generate(devices: int, days: int, seed: int = 1, start_ms: int = DEFAULT_START_MS):
+    """
+    yield combined records, day by day and time-ordered within a day
+    """
+    fleet = [Device(i, seed, start_ms) for i in range(devices)]
+    for d in range(days):
+        for device in fleet:
+            yield from device.day(d)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench.generate")
+    parser.add_argument("--devices", type=int, default=3)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--start-ms", type=int, default=DEFAULT_START_MS)
+    parser.add_argument("--out", default=None, help="NDJSON file (default: stdout)")
+    args = parser.parse_args(argv)
+
+    out = open(args.out, "w", encoding="utf-8") if args.out else sys.stdout
+    try:
+        for record in generate(args.devices, args.days, args.seed, args.start_ms):
+            out.write(json.dumps(record) + "\n")
+    finally:
+        if args.out:
+            out.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
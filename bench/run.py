@@ -0,0 +1,422 @@
+"""
+Ingest and query benchmark for api/health_api.py.
+
+Builds a fresh database from bench.generate, then drives the API:
+- ingest: the records through POST /observations/bulk (rows/s), and a
+  sample through the single-row endpoints
+- the metric and decision engines, once each
+- reads: /observations, /fused_minute, /rollups, /sleep_sessions,
+  /metric_values and /decisions over seeded random windows
+- SQL: fused_minute against fused_minute_view, and metric_value ranges,
+  straight on the database file
+- the database size on disk, per table where dbstat is available
+
+The target is the app in-process (FastAPI TestClient, needs httpx) or a
+local uvicorn on a free port (real HTTP, one keep-alive connection per
+thread). Results go out as JSON, tagged with the git commit, so runs can
+be compared with bench.compare.
+
+    python -m bench.run [--devices 3] [--days 90] [--target inprocess|uvicorn] [--out result.json]
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+from urllib.parse import urlencode
+
+import numpy as np
+
+from .generate import DAY_MS, DEFAULT_START_MS, generate, iso
+
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+
+
+class Latencies:
+    """
+    seconds per call, by endpoint label; thread-safe
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples: dict[str, list[float]] = {}
+        self.errors: dict[str, int] = {}
+
+    def add(self, label: str, seconds: float, ok: bool = True):
+        with self._lock:
+            self.samples.setdefault(label, []).append(seconds)
+            if not ok:
+                self.errors[label] = self.errors.get(label, 0) + 1
+
+    def report(self) -> dict:
+        out = {}
+        for label, values in sorted(self.samples.items()):
+            ms = np.asarray(values) * 1000
+            out[label] = {
+                "count": len(values),
+                "errors": self.errors.get(label, 0),
+                "mean_ms": round(float(ms.mean()), 3),
+                "p50_ms": round(float(np.percentile(ms, 50)), 3),
+                "p90_ms": round(float(np.percentile(ms, 90)), 3),
+                "p99_ms": round(float(np.percentile(ms, 99)), 3),
+                "max_ms": round(float(ms.max()), 3),
+            }
+        return out
+
+
+class InProcess:
+    """
+    the app behind FastAPI's TestClient; the database path must be set
+    before api.health_api is imported
+    """
+
+    name = "inprocess"
+
+    def __init__(self, db_path: str):
+        os.environ["HEALTH_DB_PATH"] = db_path
+        try:
+            from fastapi.testclient import TestClient
+        except ImportError as e:
+            raise SystemExit(f"the in-process target needs fastapi and httpx: {e}")
+        from api import health_api
+
+        self._client = TestClient(health_api.app)
+
+    def __enter__(self):
+        self._client.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        self._client.__exit__(*exc)
+
+    def request(self, method: str, path: str, params=None, body: bytes | None = None,
+                content_type: str = "application/json") -> tuple[int, bytes]:
+        r = self._client.request(method, path, params=params, content=body,
+                                 headers={"content-type": content_type} if body is not None else None)
+        return r.status_code, r.content
+
+
+class Uvicorn:
+    """
+    python -m uvicorn api.health_api:app on a free local port
+    """
+
+    name = "uvicorn"
+
+    def __init__(self, db_path: str, startup_s: float = 30):
+        self.db_path = db_path
+        self.startup_s = startup_s
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            self.port = s.getsockname()[1]
+        self._local = threading.local()
+        self._proc = None
+
+    def __enter__(self):
+        env = dict(os.environ, HEALTH_DB_PATH=self.db_path)
+        self._proc = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "api.health_api:app",
+             "--host", "127.0.0.1", "--port", str(self.port), "--log-level", "warning"],
+            cwd=ROOT_DIR, env=env,
+        )
+        deadline = time.monotonic() + self.startup_s
+        while True:
+            try:
+                if self.request("GET", "/openapi.json")[0] == 200:
+                    return self
+            except OSError:
+                pass
+            if self._proc.poll() is not None or time.monotonic() > deadline:
+                self.__exit__(None, None, None)
+                raise SystemExit("uvicorn did not come up")
+            time.sleep(0.2)
+
+    def __exit__(self, *exc):
+        if self._proc is not None:
+            self._proc.terminate()
+            try:
+                self._proc.wait(10)
+            except subprocess.TimeoutExpired:
+                self._proc.kill()
+
+    def request(self, method: str, path: str, params=None, body: bytes | None = None,
+                content_type: str = "application/json") -> tuple[int, bytes]:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=600)
+        if params:
+            path = f"{path}?{urlencode(params)}"
+        headers = {"content-type": content_type} if body is not None else {}
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            r = conn.getresponse()
+            return r.status, r.read()
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            self._local.conn = None
+            raise
+
+
+TARGETS = {"inprocess": InProcess, "uvicorn": Uvicorn}
+
+
+def timed(target, latencies: Latencies, label: str, method: str, path: str, **kw) -> bytes:
+    started = time.perf_counter()
+    status, body = target.request(method, path, **kw)
+    latencies.add(label, time.perf_counter() - started, status < 400)
+    return body
+
+
+def bench_ingest(target, latencies: Latencies, records: list[dict], batch: int,
+                 concurrency: int) -> dict:
+    chunks = [
+        "".join(json.dumps(r) + "\n" for r in records[i:i + batch]).encode()
+        for i in range(0, len(records), batch)
+    ]
+    counts: dict[str, int] = {}
+    lock = threading.Lock()
+
+    def post(body):
+        out = timed(target, latencies, "POST /observations/bulk", "POST", "/observations/bulk",
+                    body=body, content_type="application/x-ndjson")
+        try:
+            results = json.loads(out).get("results", [])
+        except ValueError:
+            results = []
+        with lock:
+            for r in results:
+                counts[r["status"]] = counts.get(r["status"], 0) + 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(post, chunks))
+    seconds = time.perf_counter() - started
+    return {
+        "records": len(records),
+        "requests": len(chunks),
+        "batch": batch,
+        "concurrency": concurrency,
+        "seconds": round(seconds, 3),
+        "rows_per_s": round(len(records) / seconds, 1),
+        "statuses": counts,
+    }
+
+
+def bench_single(target, latencies: Latencies, records: list[dict], concurrency: int) -> dict:
+    """
+    event, payload and provenance as three calls, the way the app posts them
+    """
+    def post(record):
+        event_id = record["event"]["event_id"]
+        timed(target, latencies, "POST /observation_event", "POST", "/observation_event",
+              body=json.dumps(record["event"]).encode())
+        for kind in ("weight", "steps", "sleep_state"):
+            if record.get(kind) is not None:
+                path = "/obs_sleep_state" if kind == "sleep_state" else f"/obs_{kind}"
+                timed(target, latencies, f"POST {path}", "POST", path,
+                      body=json.dumps(dict(record[kind], event_id=event_id)).encode())
+        timed(target, latencies, "POST /observation_provenance", "POST", "/observation_provenance",
+              body=json.dumps(dict(record["provenance"], event_id=event_id,
+                                   ingested_at=iso(int(time.time() * 1000)))).encode())
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(post, records))
+    seconds = time.perf_counter() - started
+    return {"records": len(records), "seconds": round(seconds, 3),
+            "rows_per_s": round(len(records) / seconds, 1)}
+
+
+def bench_engines(target, latencies: Latencies) -> dict:
+    out = {}
+    for path in ("/metric_engine/run", "/decision_engine/run"):
+        started = time.perf_counter()
+        status, body = target.request("POST", path)
+        seconds = time.perf_counter() - started
+        latencies.add(f"POST {path}", seconds, status < 400)
+        out[path] = {"status": status, "seconds": round(seconds, 4)}
+        try:
+            out[path]["response"] = json.loads(body)
+        except ValueError:
+            pass
+    return out
+
+
+def bench_reads(target, latencies: Latencies, devices: list[str], start_ms: int, days: int,
+                queries: int, seed: int):
+    rng = random.Random(seed)
+    span = max(days - 30, 1)
+    for _ in range(queries):
+        device = rng.choice(devices)
+        day = start_ms + rng.randrange(span) * DAY_MS
+        one_day = {"start_ms": day, "end_ms": day + DAY_MS}
+        month = {"start_ms": day, "end_ms": day + 30 * DAY_MS}
+        calls = [
+            ("GET /observations (device, 1d)", "/observations", dict(device_id=device, **one_day)),
+            ("GET /observations (weight, 30d)", "/observations",
+             dict(obs_kind="weight", valid_only="true", **month)),
+            ("GET /fused_minute (1d)", "/fused_minute", dict(device_id=device, **one_day)),
+            ("GET /rollups (hour, 1d)", "/rollups", dict(device_id=device, grain="hour", **one_day)),
+            ("GET /rollups (day, 30d)", "/rollups", dict(device_id=device, grain="day", **month)),
+            ("GET /sleep_sessions (30d)", "/sleep_sessions", dict(device_id=device, **month)),
+            ("GET /metric_values (30d)", "/metric_values", dict(device_id=device, **month)),
+            ("GET /decisions (30d)", "/decisions", dict(device_id=device, **month)),
+        ]
+        for label, path, params in calls:
+            timed(target, latencies, label, "GET", path, params=params)
+
+
+def bench_sql(db_path: str, devices: list[str], start_ms: int, days: int, queries: int,
+              seed: int) -> dict:
+    """
+    the fused_minute table against the view it materialises, and
+    metric_value ranges, without the HTTP layer
+    """
+    from api import db
+
+    latencies = Latencies()
+    rng = random.Random(seed)
+    conn = db.connect(readonly=True, path=db_path)
+    statements = {
+        "fused_minute (1d)": (
+            "SELECT * FROM fused_minute WHERE device_id = ? AND minute_bucket >= ? AND minute_bucket < ?",
+            lambda d, t: (d, t // 60000, (t + DAY_MS) // 60000)),
+        "fused_minute_view (1d)": (
+            "SELECT * FROM fused_minute_view WHERE device_id = ? AND minute_bucket >= ? AND minute_bucket < ?",
+            lambda d, t: (d, t // 60000, (t + DAY_MS) // 60000)),
+        "metric_value (30d)": (
+            "SELECT * FROM metric_value WHERE device_id = ? AND window_start_ms >= ? AND window_start_ms < ?",
+            lambda d, t: (d, t, t + 30 * DAY_MS)),
+    }
+    try:
+        span = max(days - 30, 1)
+        for _ in range(queries):
+            device = rng.choice(devices)
+            day = start_ms + rng.randrange(span) * DAY_MS
+            for label, (sql, params) in statements.items():
+                started = time.perf_counter()
+                conn.execute(sql, params(device, day)).fetchall()
+                latencies.add(label, time.perf_counter() - started)
+    finally:
+        conn.close()
+    return latencies.report()
+
+
+def db_size(db_path: str) -> dict:
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        out = {
+            "bytes": os.path.getsize(db_path),
+            "page_size": conn.execute("PRAGMA page_size").fetchone()[0],
+            "pages": conn.execute("PRAGMA page_count").fetchone()[0],
+            "freelist_pages": conn.execute("PRAGMA freelist_count").fetchone()[0],
+        }
+        wal = db_path + "-wal"
+        out["wal_bytes"] = os.path.getsize(wal) if os.path.exists(wal) else 0
+        try:
+            out["tables"] = dict(conn.execute(
+                "SELECT name, SUM(pgsize) FROM dbstat GROUP BY name ORDER BY 2 DESC"
+            ).fetchall())
+        except sqlite3.OperationalError:
+            pass  # SQLite built without dbstat
+        out["rows"] = {
+            table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            for table in ("observation_event", "fused_minute", "rollup", "steps_normalized",
+                          "sleep_session", "metric_value", "decision_run")
+        }
+        return out
+    finally:
+        conn.close()
+
+
+def git_commit() -> dict:
+    def git(*args):
+        try:
+            return subprocess.run(["git", *args], cwd=ROOT_DIR, capture_output=True,
+                                  text=True, timeout=10).stdout.strip()
+        except (OSError, subprocess.SubprocessError):
+            return ""
+    return {"commit": git("rev-parse", "HEAD") or None,
+            "dirty": bool(git("status", "--porcelain", "--untracked-files=no"))}
+
+
+def run(args) -> dict:
+    records = list(generate(args.devices, args.days, args.seed, args.start_ms))
+    extra = list(generate(1, 1, args.seed + 1, args.start_ms + args.days * DAY_MS))[:args.single]
+    devices = sorted({r["event"]["device_id"] for r in records})
+
+    workdir = None
+    db_path = args.db
+    if db_path is None:
+        workdir = tempfile.TemporaryDirectory(prefix="health-bench-")
+        db_path = os.path.join(workdir.name, "bench.db")
+    elif os.path.exists(db_path):
+        raise SystemExit(f"{db_path} exists; the benchmark needs a fresh database")
+
+    latencies = Latencies()
+    report = {
+        "meta": {
+            **git_commit(),
+            "started_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "target": args.target,
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "machine": platform.machine(),
+            "params": {k: v for k, v in vars(args).items() if k not in ("out", "db")},
+        },
+    }
+    try:
+        with TARGETS[args.target](db_path) as target:
+            report["ingest_bulk"] = bench_ingest(target, latencies, records, args.batch, args.concurrency)
+            report["ingest_single"] = bench_single(target, latencies, extra, args.concurrency)
+            report["engines"] = bench_engines(target, latencies)
+            bench_reads(target, latencies, devices, args.start_ms, args.days, args.queries, args.seed)
+        report["endpoints"] = latencies.report()
+        report["sql"] = bench_sql(db_path, devices, args.start_ms, args.days, args.queries, args.seed)
+        report["db"] = db_size(db_path)
+    finally:
+        if workdir is not None:
+            workdir.cleanup()
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench.run")
+    parser.add_argument("--devices", type=int, default=3)
+    parser.add_argument("--days", type=int, default=90)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--start-ms", type=int, default=DEFAULT_START_MS)
+    parser.add_argument("--target", choices=sorted(TARGETS), default="inprocess")
+    parser.add_argument("--batch", type=int, default=1000, help="records per bulk request")
+    parser.add_argument("--concurrency", type=int, default=4, help="client threads")
+    parser.add_argument("--single", type=int, default=200, help="records posted one by one")
+    parser.add_argument("--queries", type=int, default=50, help="rounds of read requests")
+    parser.add_argument("--db", default=None, help="database to create (default: a temp file)")
+    parser.add_argument("--out", default=None, help="JSON report (default: stdout)")
+    args = parser.parse_args(argv)
+
+    report = run(args)
+    text = json.dumps(report, indent=2)
+    if args.out:
+        Path(args.out).write_text(text + "\n", encoding="utf-8")
+        print(f"report written to {args.out}")
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
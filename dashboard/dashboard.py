@@ -1,51 +1,24 @@
-import sqlite3
 import pandas as pd
 import streamlit as st
 from pathlib import Path
 
+from data_layer import DashboardData
+from downsample import RANGES, clip_range, downsample, point_budget, rollup_grain
+
 DB_PATH = Path(__file__).parent / "health.db"
 
 
-def load_data():
-    if not DB_PATH.exists():
-        return pd.DataFrame(columns=["id", "weight", "note", "timestamp"])
+@st.cache_resource
+def get_store():
+    return DashboardData(DB_PATH)
 
-    conn = sqlite3.connect(DB_PATH)
-    df = pd.read_sql_query(
-        "SELECT id, weight, note, timestamp FROM weigh_in ORDER BY id",
-        conn,
-    )
-    conn.close()
-    return df
+
+def load_data():
+    return get_store().weigh_ins()
 
 
 def load_checkins():
-    if not DB_PATH.exists():
-        return pd.DataFrame(
-            columns=[
-                "id",
-                "timestamp",
-                "mood",
-                "diet_note",
-                "exercise_minutes",
-                "exercise_note",
-                "sleep_hours",
-                "weight",
-            ]
-        )
-
-    conn = sqlite3.connect(DB_PATH)
-    df = pd.read_sql_query(
-        """
-        SELECT id, timestamp, mood, diet_note, exercise_minutes,
-               exercise_note, sleep_hours, weight
-        FROM daily_checkin
-        ORDER BY timestamp
-        """,
-        conn,
-    )
-    conn.close()
-    return df
+    return get_store().checkins()
 
 
 st.title("Health & Weight Tracking Dashboard")
@@ -85,9 +58,20 @@ with st.form("checkin_form", clear_on_submit=True):
 
 st.header("Weight Tracking")
 
+range_label = st.radio("Chart range", list(RANGES), index=1, horizontal=True)
+span = RANGES[range_label]
+
 df_w = load_data()
 df_c = load_checkins()
 
+
+def chart_budget(frame):
+    if span is not None:
+        return point_budget(span)
+    if frame.empty:
+        return point_budget(pd.Timedelta(days=1))
+    return point_budget(frame.index.max() - frame.index.min())
+
 if df_w.empty and df_c.empty:
     st.info("No weight data yet")
 else:
@@ -111,7 +95,8 @@ else:
         df_all = df_all.set_index("timestamp")
 
         st.subheader("Weight Trend")
-        st.line_chart(df_all["weight"])
+        df_zoom = clip_range(df_all, span)
+        st.line_chart(downsample(df_zoom["weight"], chart_budget(df_zoom)))
 
         st.subheader("Recent Weight Entries")
         st.dataframe(df_all[["weight", "source"]].sort_index(ascending=False).head(10))
@@ -130,13 +115,16 @@ else:
     df_plot["timestamp"] = pd.to_datetime(df_plot["timestamp"])
     df_plot = df_plot.set_index("timestamp")
 
+    df_zoom = clip_range(df_plot.sort_index(), span)
+    budget = chart_budget(df_zoom)
+
     if df_plot["exercise_minutes"].notna().any():
         st.subheader("Exercise Minutes")
-        st.line_chart(df_plot["exercise_minutes"])
+        st.line_chart(downsample(df_zoom["exercise_minutes"], budget, method="minmax"))
 
     if df_plot["sleep_hours"].notna().any():
         st.subheader("Sleep Hours")
-        st.line_chart(df_plot["sleep_hours"])
+        st.line_chart(downsample(df_zoom["sleep_hours"], budget))
 
     last_7 = df_plot.last("7D")
 
@@ -160,3 +148,33 @@ else:
             st.metric("Avg Sleep (7D)", f"{last_7['sleep_hours'].mean():.1f} h")
         else:
             st.metric("Avg Sleep (7D)", "N/A")
+
+# === Observation rollups (hour/day/week buckets maintained by the API) ===
+devices = get_store().rollup_devices()
+if devices:
+    st.markdown("---")
+    st.header("Observations")
+
+    GRAIN_LABELS = {"hour": "hourly", "day": "daily", "week": "weekly"}
+    device_id = st.selectbox("Device", devices)
+    rollup_span = span if span is not None else pd.Timedelta(days=365 * 10)
+    grain = rollup_grain(rollup_span, point_budget(rollup_span))
+    since_ms = None
+    if span is not None:
+        since_ms = int((pd.Timestamp.now(tz="UTC") - span).timestamp() * 1000)
+
+    df_r = get_store().rollups(device_id, grain, since_ms)
+    if df_r.empty:
+        st.info("No observations in this range")
+    else:
+        df_r["bucket_start"] = pd.to_datetime(df_r["bucket_start_ms"], unit="ms")
+        df_r = df_r.set_index("bucket_start")
+        budget = chart_budget(df_r)
+
+        if df_r["weight_mean"].notna().any():
+            st.subheader(f"Weight ({GRAIN_LABELS[grain]} mean)")
+            st.line_chart(downsample(df_r["weight_mean"], budget))
+
+        if (df_r["steps_delta_sum"] > 0).any():
+            st.subheader(f"Steps per {grain}")
+            st.bar_chart(downsample(df_r["steps_delta_sum"], budget, method="minmax"))
@@ -0,0 +1,161 @@
+"""
+Change-aware data layer for the dashboard.
+
+Frames stay cached across Streamlit reruns (see dashboard.py, which keeps
+one DashboardData per process with st.cache_resource). On every rerun the
+cache asks SQLite whether anything changed at all (PRAGMA data_version on
+a long-lived connection); if it did, only rows past the cached max id
+are fetched and appended. A full reload only happens when rows
+disappear from under the cache.
+"""
+import sqlite3
+import threading
+from pathlib import Path
+
+import pandas as pd
+
+
+class IncrementalFrame:
+    def __init__(self, table: str, columns: list[str], key: str = "id",
+                 sort_by: str | None = None):
+        self.table = table
+        self.columns = columns
+        self.key = key
+        self.sort_by = sort_by
+        self.frame: pd.DataFrame | None = None
+        self._count = 0
+        self._max_key = None
+
+    def empty(self) -> pd.DataFrame:
+        return pd.DataFrame(columns=self.columns)
+
+    def _select(self, conn, where: str = "", params=()):
+        cols = ", ".join(self.columns)
+        order = self.sort_by or self.key
+        return pd.read_sql_query(
+            f"SELECT {cols} FROM {self.table} {where} ORDER BY {order}, {self.key}",
+            conn,
+            params=params,
+        )
+
+    def _stats(self, conn):
+        return conn.execute(f"SELECT COUNT(*), MAX({self.key}) FROM {self.table}").fetchone()
+
+    def refresh(self, conn: sqlite3.Connection) -> pd.DataFrame:
+        try:
+            count, max_key = self._stats(conn)
+        except sqlite3.OperationalError:
+            # table not created yet
+            self.frame, self._count, self._max_key = self.empty(), 0, None
+            return self.frame
+
+        if self.frame is not None and count == self._count and max_key == self._max_key:
+            return self.frame
+
+        tail = None
+        if self.frame is not None and self._max_key is not None and max_key is not None \
+                and max_key >= self._max_key:
+            tail = self._select(conn, f"WHERE {self.key} > ?", (self._max_key,))
+            if self._count + len(tail) != count:
+                # something below the tail was deleted; start over
+                tail = None
+
+        if tail is None:
+            self.frame = self._select(conn)
+        elif not tail.empty:
+            frame = pd.concat([self.frame, tail], ignore_index=True)
+            if self.sort_by and not frame[self.sort_by].is_monotonic_increasing:
+                frame = frame.sort_values([self.sort_by, self.key], kind="stable", ignore_index=True)
+            self.frame = frame
+        self._count, self._max_key = count, max_key
+        return self.frame
+
+
+class DashboardData:
+    """
+    one long-lived read connection plus the cached frames built on it
+    """
+
+    def __init__(self, db_path: Path):
+        self.db_path = Path(db_path)
+        self._conn: sqlite3.Connection | None = None
+        self._data_version = None
+        self._lock = threading.Lock()
+        self.weigh_in = IncrementalFrame(
+            "weigh_in", ["id", "weight", "note", "timestamp"],
+        )
+        self.daily_checkin = IncrementalFrame(
+            "daily_checkin",
+            ["id", "timestamp", "mood", "diet_note", "exercise_minutes",
+             "exercise_note", "sleep_hours", "weight"],
+            sort_by="timestamp",
+        )
+        self.frames = [self.weigh_in, self.daily_checkin]
+
+    def _connection(self) -> sqlite3.Connection | None:
+        if self._conn is None and self.db_path.exists():
+            # Streamlit reruns on different threads; access is serialised by _lock
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.execute("PRAGMA query_only = ON;")
+        return self._conn
+
+    def refresh(self):
+        """
+        bring every frame up to date; a no-op when nothing was committed
+        since the last call
+        """
+        with self._lock:
+            conn = self._connection()
+            if conn is None:
+                for f in self.frames:
+                    f.frame = f.empty()
+                return
+            version = conn.execute("PRAGMA data_version").fetchone()[0]
+            if version == self._data_version and all(f.frame is not None for f in self.frames):
+                return
+            for f in self.frames:
+                f.refresh(conn)
+            self._data_version = version
+
+    def rollup_devices(self) -> list[str]:
+        with self._lock:
+            conn = self._connection()
+            if conn is None:
+                return []
+            try:
+                return [r[0] for r in conn.execute(
+                    "SELECT DISTINCT device_id FROM rollup WHERE grain = 'week'"
+                )]
+            except sqlite3.OperationalError:
+                return []
+
+    def rollups(self, device_id: str, grain: str, since_ms: int | None = None) -> pd.DataFrame:
+        """
+        pre-aggregated hour/day/week buckets written by the API (api/rollups.py)
+        """
+        with self._lock:
+            conn = self._connection()
+            if conn is None:
+                return pd.DataFrame()
+            try:
+                return pd.read_sql_query(
+                    """
+                    SELECT bucket_start_ms, bucket_label, weight_mean, weight_last,
+                        steps_delta_sum, steps_cum_max, sample_count
+                    FROM rollup
+                    WHERE device_id = ? AND grain = ? AND bucket_start_ms >= ?
+                    ORDER BY bucket_start_ms
+                    """,
+                    conn,
+                    params=(device_id, grain, since_ms if since_ms is not None else -(2**62)),
+                )
+            except (sqlite3.OperationalError, pd.errors.DatabaseError):
+                return pd.DataFrame()
+
+    def weigh_ins(self) -> pd.DataFrame:
+        self.refresh()
+        return self.weigh_in.frame
+
+    def checkins(self) -> pd.DataFrame:
+        self.refresh()
+        return self.daily_checkin.frame
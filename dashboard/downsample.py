@@ -0,0 +1,109 @@
+"""
+Downsampling for dashboard charts.
+
+Charts get at most a point budget that depends on the zoom range, so a
+multi-year range ships a couple of thousand points to the browser
+instead of every raw row. lttb() keeps the visual shape of smooth series
+(weight, sleep); minmax() keeps the extremes of spiky ones (steps).
+"""
+import numpy as np
+import pandas as pd
+
+
+MIN_POINTS = 200
+MAX_POINTS = 2000
+
+RANGES = {
+    "7D": pd.Timedelta(days=7),
+    "30D": pd.Timedelta(days=30),
+    "90D": pd.Timedelta(days=90),
+    "1Y": pd.Timedelta(days=365),
+    "All": None,
+}
+
+
+def point_budget(span: pd.Timedelta) -> int:
+    """
+    about one point per hour for short ranges, capped for long ones
+    """
+    hours = max(1, int(span / pd.Timedelta(hours=1)))
+    return int(min(MAX_POINTS, max(MIN_POINTS, hours)))
+
+
+def lttb(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """
+    Largest-Triangle-Three-Buckets; returns the indices to keep
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    keep = np.empty(n_out, dtype=np.int64)
+    keep[0], keep[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        # average of the next bucket is the third triangle corner
+        nlo, nhi = hi, (edges[i + 2] if i + 2 < len(edges) else n)
+        cx = x[nlo:nhi].mean()
+        cy = y[nlo:nhi].mean()
+        bx, by = x[lo:hi], y[lo:hi]
+        area = np.abs((x[a] - cx) * (by - y[a]) - (x[a] - bx) * (cy - y[a]))
+        a = lo + int(np.argmax(area))
+        keep[i + 1] = a
+    return keep
+
+
+def minmax(y: np.ndarray, n_out: int) -> np.ndarray:
+    """
+    min and max of each bucket, in time order; returns the indices to keep
+    """
+    n = len(y)
+    if n_out >= n or n_out < 4:
+        return np.arange(n)
+    buckets = n_out // 2
+    edges = np.linspace(0, n, buckets + 1).astype(np.int64)
+    keep = []
+    for lo, hi in zip(edges[:-1], edges[1:]):
+        if hi <= lo:
+            continue
+        chunk = y[lo:hi]
+        keep.extend(sorted({lo + int(np.argmin(chunk)), lo + int(np.argmax(chunk))}))
+    return np.asarray(keep, dtype=np.int64)
+
+
+def downsample(series: pd.Series, budget: int, method: str = "lttb") -> pd.Series:
+    """
+    reduce a time-indexed series to at most budget points
+    """
+    series = series.dropna()
+    if len(series) <= budget:
+        return series
+    y = series.to_numpy(dtype=np.float64)
+    if method == "minmax":
+        idx = minmax(y, budget)
+    else:
+        x = series.index.asi8.astype(np.float64)
+        idx = lttb(x, y, budget)
+    return series.iloc[idx]
+
+
+def clip_range(frame: pd.DataFrame, span: pd.Timedelta | None) -> pd.DataFrame:
+    """
+    rows of a time-indexed frame within span of its newest row
+    """
+    if span is None or frame.empty:
+        return frame
+    return frame[frame.index >= frame.index.max() - span]
+
+
+def rollup_grain(span: pd.Timedelta, budget: int) -> str:
+    """
+    finest rollup grain whose bucket count over span fits the budget
+    """
+    if span / pd.Timedelta(hours=1) <= budget:
+        return "hour"
+    if span / pd.Timedelta(days=1) <= budget:
+        return "day"
+    return "week"
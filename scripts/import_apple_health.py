@@ -0,0 +1,247 @@
+"""
+Import an Apple Health export.xml (years of history, often several GB).
+
+The file is streamed with iterparse and every element is cleared once
+handled, so memory stays flat regardless of file size. BodyMass,
+StepCount and SleepAnalysis records become observation_event + payload +
+observation_provenance rows, written through ingest.insert_observations
+in large transactions. Event ids are uuid5 of the record, so a re-import
+only reports duplicates.
+
+Progress is checkpointed per file in import_checkpoint; an interrupted
+import resumes after the last committed batch.
+
+    python scripts/import_apple_health.py export.xml [--db PATH] [--device-id ID]
+"""
+import argparse
+import os
+import re
+import sys
+import time
+import uuid
+import xml.etree.ElementTree as ET
+from datetime import datetime, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from api import db, derived, fused, ingest, migrations  # noqa: E402
+
+
+IMPORT_NAMESPACE = uuid.UUID("3f6d2a8e-5c7b-4e19-8a04-d1b9c6e2f573")
+
+SOURCE_KIND = "apple_health_export"
+
+BODY_MASS = "HKQuantityTypeIdentifierBodyMass"
+STEP_COUNT = "HKQuantityTypeIdentifierStepCount"
+SLEEP = "HKCategoryTypeIdentifierSleepAnalysis"
+
+# unit -> kg
+MASS_UNITS = {"kg": 1.0, "lb": 0.45359237, "g": 0.001, "st": 6.35029318}
+
+AWAKE = "HKCategoryValueSleepAnalysisAwake"
+
+
+def parse_date(text: str) -> datetime:
+    # export.xml dates look like "2021-03-04 07:12:45 +0800"
+    return datetime.strptime(text, "%Y-%m-%d %H:%M:%S %z")
+
+
+def to_ms(dt: datetime) -> int:
+    return int(dt.timestamp() * 1000)
+
+
+def iso_utc(dt: datetime) -> str:
+    return dt.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def slug(text: str) -> str:
+    return re.sub(r"[^a-z0-9]+", "_", text.lower()).strip("_") or "unknown"
+
+
+class Mapper:
+    """
+    turns Record attributes into ingest records.
+
+    Sleep samples are intervals, while obs_sleep_state holds state
+    changes (each state lasts until the next one). So every sleep record
+    becomes its state at startDate, plus an awake state at endDate unless
+    the next sample from the same source starts right there.
+    """
+
+    def __init__(self, device_id: str | None):
+        self.device_id = device_id
+        self._sleep_end: dict[str, tuple[int, dict]] = {}
+
+    def _record(self, attrs: dict, kind: str, start: datetime, suffix: str = "") -> dict:
+        source = attrs.get("sourceName", "")
+        key = "|".join((attrs["type"], source, attrs.get("startDate", ""),
+                        attrs.get("endDate", ""), attrs.get("value", ""), suffix))
+        return {
+            "event": {
+                "event_id": str(uuid.uuid5(IMPORT_NAMESPACE, key)),
+                "device_id": self.device_id or slug(source),
+                "observed_at": iso_utc(start),
+                "observed_ms": to_ms(start),
+                "obs_kind": kind,
+            },
+            "provenance": {
+                "source_kind": SOURCE_KIND,
+                "app_version": attrs.get("sourceVersion"),
+                "provenance_json": None,
+            },
+        }
+
+    def map(self, attrs: dict) -> list[dict]:
+        kind = attrs.get("type")
+        if kind == BODY_MASS:
+            factor = MASS_UNITS.get(attrs.get("unit", "kg"))
+            if factor is None:
+                return []
+            rec = self._record(attrs, "weight", parse_date(attrs["startDate"]))
+            rec["weight"] = {"body_mass_kg": round(float(attrs["value"]) * factor, 3)}
+            return [rec]
+        if kind == STEP_COUNT:
+            rec = self._record(attrs, "steps", parse_date(attrs["startDate"]))
+            rec["steps"] = {"step_value": int(float(attrs["value"])), "step_mode": "delta"}
+            return [rec]
+        if kind == SLEEP:
+            return self._sleep(attrs)
+        return []
+
+    def _sleep(self, attrs: dict) -> list[dict]:
+        out = []
+        start = parse_date(attrs["startDate"])
+        end = parse_date(attrs["endDate"])
+        source = attrs.get("sourceName", "")
+        pending = self._sleep_end.pop(source, None)
+        if pending is not None and pending[0] < to_ms(start):
+            out.append(pending[1])
+
+        rec = self._record(attrs, "sleep_state", start)
+        rec["sleep_state"] = {"state": attrs.get("value", AWAKE)}
+        out.append(rec)
+        if attrs.get("value") != AWAKE:
+            marker = self._record(attrs, "sleep_state", end, suffix="end")
+            marker["sleep_state"] = {"state": AWAKE}
+            self._sleep_end[source] = (to_ms(end), marker)
+        return out
+
+    def flush(self) -> list[dict]:
+        out = [marker for _, marker in self._sleep_end.values()]
+        self._sleep_end.clear()
+        return out
+
+
+def records(f, mapper: Mapper):
+    """
+    yield mapped ingest records from export.xml; constant memory
+    """
+    context = ET.iterparse(f, events=("start", "end"))
+    _, root = next(context)
+    for event, elem in context:
+        if event != "end":
+            continue
+        if elem.tag == "Record":
+            yield from mapper.map(elem.attrib)
+        # Record children (MetadataEntry, ...) are cleared with the record
+        if elem.tag in ("Record", "Workout", "ActivitySummary", "ClinicalRecord", "Correlation"):
+            elem.clear()
+            root.clear()
+    yield from mapper.flush()
+
+
+def load_checkpoint(conn, path: str, size: int, mtime: int) -> int:
+    row = conn.execute(
+        "SELECT file_size, file_mtime, records_done FROM import_checkpoint WHERE source_path = ?",
+        (path,),
+    ).fetchone()
+    if row is None or (row[0], row[1]) != (size, mtime):
+        # new or changed file: start over (ids are deterministic, so
+        # anything already imported only comes back as duplicate)
+        return 0
+    return row[2]
+
+
+def save_checkpoint(conn, path: str, size: int, mtime: int, done: int):
+    conn.execute(
+        """
+        INSERT INTO import_checkpoint(source_path, file_size, file_mtime, records_done, updated_at)
+        VALUES (?, ?, ?, ?, strftime('%Y-%m-%dT%H:%M:%fZ', 'now'))
+        ON CONFLICT(source_path) DO UPDATE SET
+            file_size = excluded.file_size, file_mtime = excluded.file_mtime,
+            records_done = excluded.records_done, updated_at = excluded.updated_at
+        """,
+        (path, size, mtime, done),
+    )
+
+
+def run(conn, path: str, device_id: str | None = None, batch_size: int = 20000) -> dict:
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    size, mtime = stat.st_size, int(stat.st_mtime)
+    skip = load_checkpoint(conn, path, size, mtime)
+    counts = {"ok": 0, "duplicate": 0, "rejected": 0}
+    seen = 0
+    started = time.monotonic()
+    batch: list[dict] = []
+
+    def commit(f):
+        with conn:
+            for status, _ in ingest.insert_observations(conn, batch):
+                counts[status] += 1
+            derived.refresh(conn)
+            save_checkpoint(conn, path, size, mtime, seen)
+        batch.clear()
+        elapsed = max(time.monotonic() - started, 1e-6)
+        pos = f.tell()
+        print(
+            f"\r{pos / size:6.1%}  {pos / 2**20:,.0f}/{size / 2**20:,.0f} MB"
+            f"  {seen:,} records  {(seen - skip) / elapsed:,.0f}/s"
+            f"  {counts['ok']:,} new  {counts['duplicate']:,} dup  {counts['rejected']:,} rejected",
+            end="", flush=True,
+        )
+
+    with open(path, "rb") as f:
+        for record in records(f, Mapper(device_id)):
+            seen += 1
+            if seen <= skip:
+                continue
+            batch.append(record)
+            if len(batch) >= batch_size:
+                commit(f)
+        if batch:
+            commit(f)
+    print()
+    counts["records"] = seen
+    counts["seconds"] = round(time.monotonic() - started, 1)
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import an Apple Health export.xml")
+    parser.add_argument("export", help="path to export.xml")
+    parser.add_argument("--db", default=None, help="database (default: HEALTH_DB_PATH)")
+    parser.add_argument("--device-id", default=None,
+                        help="device_id for every record (default: one per sourceName)")
+    parser.add_argument("--batch", type=int, default=20000, help="records per transaction")
+    args = parser.parse_args(argv)
+
+    conn = db.connect(path=args.db)
+    try:
+        # a first backfill usually runs before the service ever started
+        needs_rebuild = fused.drop_legacy_view(conn)
+        for version in migrations.migrate(conn):
+            print(f"schema migration {version} applied")
+        if needs_rebuild:
+            with conn:
+                derived.rebuild(conn)
+        counts = run(conn, args.export, args.device_id, max(1, args.batch))
+        print(f"import done: {counts}")
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
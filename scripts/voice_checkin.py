@@ -1,54 +1,340 @@
-import subprocess
-import requests
-from datetime import datetime
+"""
+Voice check-in: score a note for stress and sentiment and post it to the
+check-in API, or backfill the scores of every stored check-in.
+
+Scoring is driven by a lexicon (checkin_lexicon.json next to this file,
+or --lexicon): a baseline, the 0-10 range, the sentiment thresholds and
+a weight per word. Its words are compiled into one regex, so a note is
+scanned once instead of once per word; a word counts once per note
+however often it appears, and overlapping words (great and tired in
+greatired) or nested ones (calm in calmer) count too, as a plain
+substring test would.
+
+backfill streams daily_checkin (mood + diet_note, the text the dashboard
+reads) from the dashboard database in id order, scores the notes in a
+worker pool and writes checkin_analysis (one row per check-in) in one
+transaction per chunk. Scores are cached in checkin_text_score by text
+hash with the lexicon they were computed under, and every lexicon used
+is kept in checkin_lexicon. After a lexicon change only notes containing
+a word that was added, removed or reweighted are rescored; the others
+keep their score. Changing the baseline, range or thresholds rescores
+everything.
+
+    python scripts/voice_checkin.py
+    python scripts/voice_checkin.py backfill [--db PATH] [--lexicon PATH] [--workers N]
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import sqlite3
+import sys
+import time
+from datetime import datetime, timezone
+from functools import lru_cache
+from pathlib import Path
 
 API_URL = "http://localhost:8000/checkin"
 
+# daily_checkin lives in the dashboard's database (dashboard/dashboard.py)
+DEFAULT_DB = Path(__file__).resolve().parent.parent / "dashboard" / "health.db"
+DEFAULT_LEXICON = Path(__file__).resolve().parent / "checkin_lexicon.json"
+
+CHUNK_ROWS = 5000
+
+# same batch size as api/identity.py lookups
+LOOKUP_CHUNK = 500
+
+# below this many notes a chunk is scored in-process
+POOL_MIN_TEXTS = 256
+
+ANALYSIS_SQL = """
+CREATE TABLE IF NOT EXISTS checkin_lexicon (
+    lexicon_hash TEXT PRIMARY KEY,
+    body_json TEXT NOT NULL,
+    created_at TEXT NOT NULL
+) WITHOUT ROWID;
+
+-- score cache: one row per distinct note text
+CREATE TABLE IF NOT EXISTS checkin_text_score (
+    text_hash TEXT PRIMARY KEY,
+    lexicon_hash TEXT NOT NULL,
+    stress_score REAL NOT NULL,
+    sentiment TEXT NOT NULL,
+    matched TEXT NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS checkin_analysis (
+    checkin_id INTEGER PRIMARY KEY,
+    text_hash TEXT NOT NULL,
+    lexicon_hash TEXT NOT NULL,
+    stress_score REAL NOT NULL,
+    sentiment TEXT NOT NULL,
+    analysed_at TEXT NOT NULL
+);
+"""
+
+PAGE_SQL = """
+SELECT c.id, c.mood, c.diet_note, a.text_hash, a.lexicon_hash
+FROM daily_checkin c
+LEFT JOIN checkin_analysis a ON a.checkin_id = c.id
+WHERE c.id > ?
+ORDER BY c.id
+LIMIT ?
+"""
+
+STORE_SCORE_SQL = """
+INSERT OR REPLACE INTO checkin_text_score
+(text_hash, lexicon_hash, stress_score, sentiment, matched) values(?,?,?,?,?)
+"""
+
+STORE_ANALYSIS_SQL = """
+INSERT OR REPLACE INTO checkin_analysis
+(checkin_id, text_hash, lexicon_hash, stress_score, sentiment, analysed_at) values(?,?,?,?,?,?)
+"""
+
+
+def _compile(words) -> re.Pattern | None:
+    # longest first, so a word is not cut short by one it starts with; a
+    # lookahead matches at every position, so overlapping words all count
+    words = sorted(words, key=len, reverse=True)
+    return re.compile("(?=(" + "|".join(map(re.escape, words)) + "))") if words else None
+
 
-def text_analysis(text:str):
+class Lexicon:
+    SETTINGS = ("baseline", "min", "max", "negative_at", "positive_at")
+
+    def __init__(self, spec: dict):
+        self.baseline = float(spec.get("baseline", 3.0))
+        self.min = float(spec.get("min", 0.0))
+        self.max = float(spec.get("max", 10.0))
+        self.negative_at = float(spec.get("negative_at", 7.0))
+        self.positive_at = float(spec.get("positive_at", 3.0))
+        self.words = {w.lower(): float(weight) for w, weight in spec.get("words", {}).items()}
+        self.body = json.dumps(self.spec(), sort_keys=True, separators=(",", ":"))
+        self.hash = hashlib.blake2b(self.body.encode(), digest_size=16).hexdigest()
+        self.pattern = _compile(self.words)
+        # a match also stands for the lexicon words inside it
+        self._inside = {w: [v for v in self.words if v in w] for w in self.words}
+
+    @classmethod
+    def load(cls, path) -> "Lexicon":
+        with open(path, encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    def spec(self) -> dict:
+        return {**{name: getattr(self, name) for name in self.SETTINGS}, "words": dict(self.words)}
+
+    def matches(self, lower: str) -> set[str]:
+        found = set()
+        if self.pattern is not None:
+            for m in set(self.pattern.findall(lower)):
+                found.update(self._inside[m])
+        return found
+
+    def score(self, text: str) -> tuple[float, str, list[str]]:
+        """
+        (stress score, sentiment, lexicon words found)
+        """
+        matched = sorted(self.matches(text.lower()))
+        score = self.baseline + sum(self.words[w] for w in matched)
+        score = max(self.min, min(self.max, score))
+        if score >= self.negative_at:
+            sentiment = "negtive"
+        elif score <= self.positive_at:
+            sentiment = "positive"
+        else:
+            sentiment = "neutral"
+        return score, sentiment, matched
+
+    def affected(self, old: "Lexicon"):
+        """
+        test(lowered text) -> whether a score under old can differ under self
+        """
+        if any(getattr(old, name) != getattr(self, name) for name in self.SETTINGS):
+            return lambda lower: True
+        changed = {w for w in old.words.keys() | self.words.keys()
+                   if old.words.get(w) != self.words.get(w)}
+        pattern = _compile(changed)
+        if pattern is None:
+            return lambda lower: False
+        return lambda lower: pattern.search(lower) is not None
+
+
+@lru_cache(maxsize=1)
+def default_lexicon() -> Lexicon:
+    return Lexicon.load(DEFAULT_LEXICON)
+
+
+def text_analysis(text: str, lexicon: Lexicon | None = None):
     """
-    simple emotion/stress analys
+    simple emotion/stress analysis
     """
-    lower = text.lower()
-    
-    positive_words = ["good", "great", "relaxed", "happy", "excited", "calm"]
-    negative_words = ["tired", "stressed", "anxious", "angry", "upset", "sad", "exhausted"]
-
-    score = 3.0 #baseline
-
-    for w in positive_words: 
-        if w in lower:
-            score -= 1
-        
-    for w in negative_words:
-        if w in lower:
-            score +=2
-
-    #range 0 - 10
-    score = max(0.0, min(10.0, score))
-
-    if score >= 7:
-        sentiment = "negtive"
-    elif score <= 3:
-        sentiment = "positive"
-    else: 
-        sentiment = "neutral"
-
+    score, sentiment, _ = (lexicon or default_lexicon()).score(text)
     mood = text[:200]
-    return mood, score, sentiment  
+    return mood, score, sentiment
+
+
+def note_text(mood, diet_note) -> str:
+    return "\n".join(part for part in (mood, diet_note) if part)
+
+
+def text_hash(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+# worker-process state, set by _init_worker
+_worker_lexicon: Lexicon | None = None
+
+
+def _init_worker(spec: dict):
+    global _worker_lexicon
+    _worker_lexicon = Lexicon(spec)
+
+
+def _score_texts(texts: list[str]) -> list[tuple]:
+    return [_worker_lexicon.score(text) for text in texts]
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+class Backfill:
+    """
+    one backfill run over a connection to the dashboard database
+    """
+
+    def __init__(self, conn: sqlite3.Connection, lexicon: Lexicon, workers: int = 1):
+        self.conn = conn
+        self.lexicon = lexicon
+        self.workers = max(1, workers)
+        self.pool = None
+        # old lexicon_hash -> affected test
+        self._affected = {}
+        self.counts = {"checkins": 0, "current": 0, "cached": 0, "carried": 0, "rescored": 0}
+
+    def _affected_since(self, lexicon_hash: str):
+        test = self._affected.get(lexicon_hash)
+        if test is None:
+            row = self.conn.execute(
+                "SELECT body_json FROM checkin_lexicon WHERE lexicon_hash = ?", (lexicon_hash,)
+            ).fetchone()
+            test = self.lexicon.affected(Lexicon(json.loads(row[0]))) if row else (lambda lower: True)
+            self._affected[lexicon_hash] = test
+        return test
+
+    def _cached(self, hashes: list[str]) -> dict:
+        found = {}
+        for i in range(0, len(hashes), LOOKUP_CHUNK):
+            part = hashes[i:i + LOOKUP_CHUNK]
+            marks = ",".join("?" * len(part))
+            for h, lex, score, sentiment, matched in self.conn.execute(
+                f"SELECT text_hash, lexicon_hash, stress_score, sentiment, matched"
+                f" FROM checkin_text_score WHERE text_hash IN ({marks})",
+                part,
+            ):
+                found[h] = (lex, score, sentiment, matched)
+        return found
+
+    def _score(self, texts: list[str]) -> list[tuple]:
+        if self.workers == 1 or len(texts) < POOL_MIN_TEXTS:
+            return [self.lexicon.score(text) for text in texts]
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(
+                self.workers, initializer=_init_worker, initargs=(self.lexicon.spec(),)
+            )
+        size = -(-len(texts) // (self.workers * 4))
+        parts = [texts[i:i + size] for i in range(0, len(texts), size)]
+        return [r for part in self.pool.map(_score_texts, parts) for r in part]
+
+    def _chunk(self, rows: list[tuple]):
+        lex = self.lexicon.hash
+        todo = []
+        texts = {}
+        for checkin_id, mood, diet_note, done_hash, done_lex in rows:
+            text = note_text(mood, diet_note)
+            h = text_hash(text)
+            if done_hash == h and done_lex == lex:
+                self.counts["current"] += 1
+                continue
+            todo.append((checkin_id, h))
+            texts[h] = text
+        if not todo:
+            return
+
+        scores = {}
+        carried = []
+        for h, (old_lex, score, sentiment, matched) in self._cached(list(texts)).items():
+            if old_lex == lex:
+                scores[h] = (score, sentiment)
+                self.counts["cached"] += 1
+            elif not self._affected_since(old_lex)(texts[h].lower()):
+                scores[h] = (score, sentiment)
+                carried.append((h, lex, score, sentiment, matched))
+            # else: rescored below
+        rescore = [h for h in texts if h not in scores]
+        stored = []
+        for h, (score, sentiment, matched) in zip(rescore, self._score([texts[h] for h in rescore])):
+            scores[h] = (score, sentiment)
+            stored.append((h, lex, score, sentiment, json.dumps(matched)))
+        self.counts["carried"] += len(carried)
+        self.counts["rescored"] += len(stored)
+
+        analysed_at = _now()
+        with self.conn:
+            self.conn.executemany(STORE_SCORE_SQL, carried + stored)
+            self.conn.executemany(STORE_ANALYSIS_SQL, [
+                (checkin_id, h, lex, *scores[h], analysed_at) for checkin_id, h in todo
+            ])
+
+    def run(self, chunk_rows: int = CHUNK_ROWS) -> dict:
+        self.conn.executescript(ANALYSIS_SQL)
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO checkin_lexicon(lexicon_hash, body_json, created_at) values(?,?,?)",
+                (self.lexicon.hash, self.lexicon.body, _now()),
+            )
+        started = time.monotonic()
+        last = -(2**63)
+        try:
+            while True:
+                rows = self.conn.execute(PAGE_SQL, (last, chunk_rows)).fetchall()
+                if not rows:
+                    break
+                self.counts["checkins"] += len(rows)
+                self._chunk(rows)
+                last = rows[-1][0]
+                elapsed = max(time.monotonic() - started, 1e-9)
+                print(f"\r  {self.counts['checkins']:,} check-ins"
+                      f"  {self.counts['checkins'] / elapsed:,.0f}/s", end="", flush=True)
+        finally:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+        print()
+        self.counts["seconds"] = round(time.monotonic() - started, 2)
+        return self.counts
+
 
 def record_audio(output_path="note.wav", seconds=30):
     """
-    
+
     """
 def transcribe_audio_to_text(audi="note.wav") -> str:
     """
-    
+
     """
-def main():
+
+
+def checkin(lexicon: Lexicon):
+    import requests
+
     text = input("Type what you would have said\n")
     # text =transcribe_audio_to_text()
-    mood, stress_score, sentiment = text_analysis(text)
+    mood, stress_score, sentiment = text_analysis(text, lexicon)
 
     print(f"[DEBUG] mood={mood}")
     print(f"[DEBUG] stress_score={stress_score}, sentiment={sentiment}")
@@ -56,9 +342,9 @@ def main():
     data = {
         "mood": text[:100],
         "diet_note": "",
-        "exercise_minutes": None, 
-        "exercise_note": None, 
-        "sleep_hours": None, 
+        "exercise_minutes": None,
+        "exercise_note": None,
+        "sleep_hours": None,
         "weight":None,
     }
     resp = requests.post(API_URL, json=data)
@@ -66,5 +352,28 @@ def main():
     print("Response", resp.text)
 
 
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Voice check-in and check-in text analysis")
+    parser.add_argument("command", nargs="?", default="checkin", choices=["checkin", "backfill"])
+    parser.add_argument("--db", default=str(DEFAULT_DB), help="dashboard database with daily_checkin")
+    parser.add_argument("--lexicon", default=str(DEFAULT_LEXICON), help="lexicon JSON")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS, help="check-ins per transaction")
+    args = parser.parse_args(argv)
+
+    lexicon = Lexicon.load(args.lexicon)
+    if args.command == "checkin":
+        checkin(lexicon)
+        return 0
+
+    conn = sqlite3.connect(args.db, timeout=30)
+    try:
+        counts = Backfill(conn, lexicon, args.workers).run(max(1, args.chunk_rows))
+        print(f"backfill done: {counts}")
+    finally:
+        conn.close()
+    return 0
+
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
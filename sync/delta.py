@@ -0,0 +1,367 @@
+"""
+Delta sync between peers.
+
+Instead of shipping a full .backup of health.db, export writes a gzip'd
+NDJSON changeset with only what the peer has not seen yet:
+
+- observations (event + payload + provenance) with
+  observation_provenance.ingested_at past the peer's mark
+- is_valid / superseded_by changes logged in observation_change
+- metric_value / metric_run and decision_run / decision_result rows whose
+  computed_at is past the peer's mark (metric_def rides along, it is tiny)
+
+Rows are streamed into the file as they are read, so a first sync does
+not hold the history in memory; the per-table counts follow them in a
+trailer line. The marks live in sync_peer and only advance on `ack`,
+after the file made it to the peer. apply inserts the changeset in one
+transaction with executemany, so its cost follows the changeset size,
+not the history.
+
+    python -m sync.delta export --peer NAME --out FILE [--db PATH]
+    python -m sync.delta ack    --peer NAME --file FILE [--db PATH]
+    python -m sync.delta apply  --file FILE [--db PATH]
+"""
+import argparse
+import gzip
+import json
+import os
+import sqlite3
+import sys
+from datetime import datetime, timedelta, timezone
+
+from api import db, derived, identity, ingest
+
+
+FORMAT = "healthpi-changeset"
+# 2: counts moved from the header to the trailer
+VERSION = 2
+READABLE = (1, 2)
+
+# first item of the trailer line, ["counts", {table: rows}]
+TRAILER = "counts"
+
+# re-send this much before the ingested_at and computed_at marks; rows
+# committed slightly out of timestamp order (a metric write racing a
+# correction) are not lost, and apply ignores repeats
+OVERLAP = timedelta(minutes=5)
+
+APPLY_CHUNK = 5000
+
+# table -> (columns, insert statement), in foreign-key order
+TABLES = {
+    # observations go to the compact tables (api/schema.py) so rowcount counts them
+    "observation_event": (
+        ["event_id", "device_id", "observed_at", "observed_ms", "obs_kind",
+         "is_valid", "superseded_by", "note"],
+        ingest.compact_sql("observation_event", "INSERT OR IGNORE"),
+    ),
+    "obs_weight": (
+        ["event_id", "body_mass_kg"],
+        ingest.compact_sql("obs_weight", "INSERT OR IGNORE"),
+    ),
+    "obs_steps": (
+        ["event_id", "step_value", "step_mode"],
+        ingest.compact_sql("obs_steps", "INSERT OR IGNORE"),
+    ),
+    "obs_sleep_state": (
+        ["event_id", "state"],
+        ingest.compact_sql("obs_sleep_state", "INSERT OR IGNORE"),
+    ),
+    "observation_provenance": (
+        ["event_id", "source_kind", "app_version", "ingested_at", "provenance_json"],
+        ingest.compact_sql("observation_provenance", "INSERT OR IGNORE"),
+    ),
+    "metric_def": (
+        ["metric_id", "metric_name", "unit", "description"],
+        # watermarks are local bookkeeping and are never synced
+        "INSERT OR IGNORE INTO metric_def(metric_id, metric_name, watermark, unit, description)"
+        " values(?,?,'{}',?,?)",
+    ),
+    "metric_value": (
+        ["metric_value_id", "metric_id", "device_id", "window_start_ms", "window_end_ms",
+         "computed_at", "value_real", "value_int", "value_text"],
+        "INSERT INTO metric_value"
+        "(metric_value_id, metric_id, device_id, window_start_ms, window_end_ms,"
+        " computed_at, value_real, value_int, value_text) values(?,?,?,?,?,?,?,?,?)"
+        " ON CONFLICT(metric_value_id) DO UPDATE SET"
+        " computed_at = excluded.computed_at, value_real = excluded.value_real,"
+        " value_int = excluded.value_int, value_text = excluded.value_text"
+        " WHERE excluded.computed_at > metric_value.computed_at",
+    ),
+    "metric_run": (
+        ["metric_value_id", "confidence_score", "missing_data_ratio", "is_imputed",
+         "logic_version", "details_json"],
+        "INSERT OR REPLACE INTO metric_run"
+        "(metric_value_id, confidence_score, missing_data_ratio, is_imputed,"
+        " logic_version, details_json) values(?,?,?,?,?,?)",
+    ),
+    "decision_run": (
+        ["decision_run_id", "metric_value_id", "computed_at", "policy_version"],
+        "INSERT OR IGNORE INTO decision_run"
+        "(decision_run_id, metric_value_id, computed_at, policy_version) values(?,?,?,?)",
+    ),
+    "decision_result": (
+        ["decision_run_id", "reversible", "explain", "action", "msg", "notify"],
+        "INSERT OR IGNORE INTO decision_result"
+        "(decision_run_id, reversible, explain, action, msg, notify) values(?,?,?,?,?,?)",
+    ),
+}
+
+# supersession updates: (event_id, is_valid, superseded_by)
+CHANGE_COLUMNS = ["event_id", "is_valid", "superseded_by"]
+
+# the deterministic conflict rule shared with sync/merge.py: invalid wins,
+# and an existing superseded_by is kept unless the incoming one sorts first
+APPLY_CHANGE_SQL = """
+    UPDATE event SET
+        is_valid = MIN(is_valid, ?2),
+        superseded_by = CASE
+            WHEN ?3 IS NULL THEN superseded_by
+            WHEN superseded_by IS NULL OR ?3 < superseded_by THEN ?3
+            ELSE superseded_by
+        END
+    WHERE event_id = ?1
+        AND (is_valid > ?2 OR (?3 IS NOT NULL AND (superseded_by IS NULL OR ?3 < superseded_by)))
+"""
+
+
+def _iso_minus(ts: str, delta: timedelta) -> str:
+    """
+    ts - delta, with as many fractional digits as ts so the two compare
+    as strings
+    """
+    if not ts:
+        return ""
+    try:
+        dt = datetime.strptime(ts, "%Y-%m-%dT%H:%M:%S.%fZ")
+    except ValueError:
+        return ts
+    digits = len(ts) - ts.rindex(".") - 2
+    return (dt - delta).strftime("%Y-%m-%dT%H:%M:%S.%f")[:20 + digits] + "Z"
+
+
+def peer_marks(conn: sqlite3.Connection, peer_id: str) -> dict:
+    row = conn.execute(
+        "SELECT ingested_hwm, change_hwm, computed_hwm FROM sync_peer WHERE peer_id = ?",
+        (peer_id,),
+    ).fetchone()
+    if row is None:
+        return {"ingested": "", "change": 0, "computed": ""}
+    return {"ingested": row[0], "change": row[1], "computed": row[2]}
+
+
+def _queries(marks: dict) -> list[tuple[str, str, tuple]]:
+    """
+    (table, select, params) per table, in TABLES order
+    """
+    since = _iso_minus(marks["ingested"], OVERLAP)
+    computed = _iso_minus(marks["computed"], OVERLAP)
+    events = ("SELECT e.event_id FROM event_provenance p JOIN event e"
+              " ON e.event_key = p.event_key WHERE p.ingested_at > ?")
+    out = []
+    for table, (columns, _) in TABLES.items():
+        cols = ", ".join(f"t.{c}" for c in columns)
+        if table == "metric_def":
+            out.append((table, f"SELECT {cols} FROM metric_def t", ()))
+        elif table == "metric_value":
+            out.append((table, f"SELECT {cols} FROM metric_value t WHERE t.computed_at > ?",
+                        (computed,)))
+        elif table == "metric_run":
+            out.append((table, f"SELECT {cols} FROM metric_run t JOIN metric_value mv"
+                               " ON mv.metric_value_id = t.metric_value_id"
+                               " WHERE mv.computed_at > ?", (computed,)))
+        elif table == "decision_run":
+            out.append((table, f"SELECT {cols} FROM decision_run t WHERE t.computed_at > ?",
+                        (computed,)))
+        elif table == "decision_result":
+            out.append((table, f"SELECT {cols} FROM decision_result t JOIN decision_run dr"
+                               " ON dr.decision_run_id = t.decision_run_id"
+                               " WHERE dr.computed_at > ?", (computed,)))
+        else:
+            out.append((table, f"SELECT {cols} FROM {table} t"
+                               f" WHERE t.event_id IN ({events})", (since,)))
+    return out
+
+
+def export(conn: sqlite3.Connection, peer_id: str, out_path: str) -> dict:
+    """
+    write the changeset for peer_id; returns the header (with the marks
+    to store on ack) and the counts written to the trailer
+    """
+    marks = peer_marks(conn, peer_id)
+    # new marks are read before the rows, so nothing committed in between
+    # can fall behind them
+    ingested, computed_v, computed_d, change = conn.execute(
+        """
+        SELECT
+            (SELECT MAX(ingested_at) FROM event_provenance),
+            (SELECT MAX(computed_at) FROM metric_value),
+            (SELECT MAX(computed_at) FROM decision_run),
+            (SELECT MAX(seq) FROM observation_change)
+        """
+    ).fetchone()
+    header = {
+        "format": FORMAT,
+        "version": VERSION,
+        "peer": peer_id,
+        "created_at": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+        "columns": {t: c for t, (c, _) in TABLES.items()} | {"change": CHANGE_COLUMNS},
+        "since": marks,
+        "marks": {
+            "ingested": max(ingested or "", marks["ingested"]),
+            "computed": max(computed_v or "", computed_d or "", marks["computed"]),
+            "change": max(change or 0, marks["change"]),
+        },
+    }
+
+    counts = {}
+    # rows go straight to disk; the file only takes its name once complete
+    tmp = out_path + ".tmp"
+    with gzip.open(tmp, "wt", encoding="utf-8", compresslevel=6) as f:
+        f.write(json.dumps(header, separators=(",", ":")) + "\n")
+        for table, sql, params in _queries(marks):
+            n = 0
+            for row in conn.execute(sql, params):
+                f.write(json.dumps([table, row], separators=(",", ":")) + "\n")
+                n += 1
+            counts[table] = n
+        n = 0
+        for row in conn.execute(
+            """
+            SELECT e.event_id, e.is_valid, e.superseded_by
+            FROM observation_event e
+            WHERE e.event_id IN (
+                SELECT event_id FROM observation_change WHERE seq > ? AND seq <= ?
+            )
+            """,
+            (marks["change"], header["marks"]["change"]),
+        ):
+            f.write(json.dumps(["change", row], separators=(",", ":")) + "\n")
+            n += 1
+        counts["change"] = n
+        f.write(json.dumps([TRAILER, counts], separators=(",", ":")) + "\n")
+    os.replace(tmp, out_path)
+    header["counts"] = counts
+    return header
+
+
+def read_header(path: str) -> dict:
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        header = json.loads(f.readline())
+    if header.get("format") != FORMAT or header.get("version") not in READABLE:
+        raise ValueError(f"{path} is not a {FORMAT} v{'/'.join(map(str, READABLE))} file")
+    return header
+
+
+def ack(conn: sqlite3.Connection, path: str) -> dict:
+    """
+    the peer has the changeset: advance its marks and prune the change log
+    """
+    header = read_header(path)
+    marks = header["marks"]
+    with conn:
+        conn.execute(
+            """
+            INSERT INTO sync_peer(peer_id, ingested_hwm, change_hwm, computed_hwm, updated_at)
+            VALUES (?, ?, ?, ?, strftime('%Y-%m-%dT%H:%M:%fZ', 'now'))
+            ON CONFLICT(peer_id) DO UPDATE SET
+                ingested_hwm = MAX(ingested_hwm, excluded.ingested_hwm),
+                change_hwm = MAX(change_hwm, excluded.change_hwm),
+                computed_hwm = MAX(computed_hwm, excluded.computed_hwm),
+                updated_at = excluded.updated_at
+            """,
+            (header["peer"], marks["ingested"], marks["change"], marks["computed"]),
+        )
+        # every peer, and the report build (api/reports.py), has seen these changes
+        conn.execute(
+            """
+            DELETE FROM observation_change WHERE seq <= MIN(
+                (SELECT MIN(change_hwm) FROM sync_peer),
+                COALESCE((SELECT change_hwm FROM report_state WHERE id = 1),
+                         (SELECT MIN(change_hwm) FROM sync_peer))
+            )
+            """
+        )
+    return marks
+
+
+def apply_rows(conn: sqlite3.Connection, lines) -> dict:
+    """
+    insert [table, row] items in order, inside the caller's transaction
+    """
+    counts: dict[str, int] = {}
+    pending: list = []
+    current = None
+
+    def flush():
+        if not pending:
+            return
+        if current == "change":
+            cur = conn.executemany(APPLY_CHANGE_SQL, pending)
+        else:
+            if current == "observation_event":
+                ingest.intern(conn, (row[1] for row in pending), (row[4] for row in pending))
+            cur = conn.executemany(TABLES[current][1], pending)
+        counts[current] = counts.get(current, 0) + max(cur.rowcount, 0)
+        pending.clear()
+
+    events = []
+    for table, row in lines:
+        if table != current or len(pending) >= APPLY_CHUNK:
+            flush()
+            current = table
+        if table != "change" and table not in TABLES:
+            raise ValueError(f"unknown table '{table}' in changeset")
+        if table == "observation_event":
+            events.append(row[0])
+        pending.append(row)
+    flush()
+    # re-uploads the peer took under a new event_id end up superseded here
+    counts["identity"], counts["duplicate"] = identity.hash_events(conn, events)
+    return counts
+
+
+def apply(conn: sqlite3.Connection, path: str) -> dict:
+    read_header(path)
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        f.readline()
+        items = (json.loads(line) for line in f if line.strip())
+        lines = (item for item in items if item[0] != TRAILER)
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            counts = apply_rows(conn, lines)
+            derived.refresh(conn)
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m sync.delta")
+    parser.add_argument("command", choices=["export", "ack", "apply"])
+    parser.add_argument("--db", default=None, help="database (default: HEALTH_DB_PATH)")
+    parser.add_argument("--peer", help="peer id (export)")
+    parser.add_argument("--out", help="changeset to write (export)")
+    parser.add_argument("--file", help="changeset to read (ack / apply)")
+    args = parser.parse_args(argv)
+
+    conn = db.connect(path=args.db)
+    try:
+        if args.command == "export":
+            if not args.peer or not args.out:
+                parser.error("export needs --peer and --out")
+            header = export(conn, args.peer, args.out)
+            print(f"changeset for {args.peer}: {header['counts']}")
+        elif args.command == "ack":
+            if not args.file:
+                parser.error("ack needs --file")
+            print(f"marks advanced: {ack(conn, args.file)}")
+        else:
+            if not args.file:
+                parser.error("apply needs --file")
+            print(f"changeset applied: {apply(conn, args.file)}")
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,303 @@
+"""
+Merge an incoming peer database (a .backup of its health.db) into ours.
+
+The incoming file is ATTACHed and merged set-wise in one transaction:
+
+- its events are staged once in a temp table with their content hash
+  (api/identity.py, the "same resource + time + original metadata" rule
+  from docs/note.md)
+- an indexed anti-join on event_id, then on observation_identity, finds
+  the events we already have; the rest are copied with their payload,
+  provenance and identity rows, in foreign-key order
+- is_valid / superseded_by conflicts resolve the same way as in
+  sync/delta.py: invalid wins, and the lexicographically smallest
+  superseded_by wins, with peer ids remapped to ours
+- metric and decision rows follow; derived tables refresh before commit
+
+Merged files are logged by sha256, so a retried merge is a no-op.
+
+    python -m sync.merge INCOMING_DB [--db PATH]
+"""
+import argparse
+import hashlib
+import json
+import sqlite3
+import sys
+
+from api import db, derived, identity
+from api.schema import OBSERVED_AT_SQL, PAYLOAD_TABLES
+from .delta import TABLES
+
+
+STAGE_SQL = """
+    INSERT INTO temp.merge_in(event_id, device_id, obs_kind, observed_ms, body_mass_kg,
+                              step_value, step_mode, state, source_kind, is_valid, superseded_by)
+    SELECT e.event_id, e.device_id, e.obs_kind, e.observed_ms, w.body_mass_kg,
+        s.step_value, s.step_mode, z.state, COALESCE(p.source_kind, 'unknown'),
+        e.is_valid, e.superseded_by
+    FROM inc.observation_event e
+    LEFT JOIN inc.obs_weight w ON w.event_id = e.event_id
+    LEFT JOIN inc.obs_steps s ON s.event_id = e.event_id
+    LEFT JOIN inc.obs_sleep_state z ON z.event_id = e.event_id
+    LEFT JOIN inc.observation_provenance p ON p.event_id = e.event_id
+"""
+
+# already ours by content: one probe of observation_identity (and of
+# archived_identity, for history in the cold tier) per row
+MATCH_IDENTITY_SQL = """
+    UPDATE temp.merge_in SET local_id = COALESCE(
+        (SELECT i.event_id FROM main.observation_identity i
+         WHERE i.content_hash = merge_in.content_hash),
+        (SELECT a.event_id FROM main.archived_identity a
+         WHERE a.content_hash = merge_in.content_hash)
+    )
+    WHERE local_id IS NULL AND content_hash IS NOT NULL
+"""
+
+# duplicates inside the incoming file collapse onto their smallest id
+CANONICAL_SQL = """
+    UPDATE temp.merge_in SET canon = CASE
+        WHEN content_hash IS NULL THEN event_id
+        ELSE (
+            SELECT MIN(m.event_id) FROM temp.merge_in m
+            WHERE m.content_hash = merge_in.content_hash AND m.local_id IS NULL
+        )
+    END
+    WHERE local_id IS NULL
+"""
+
+# MIN(is_valid) and the smallest remapped superseded_by per local event;
+# an event never ends up superseding itself
+RESOLVE_SQL = """
+    UPDATE main.event AS l SET
+        is_valid = MIN(l.is_valid, c.is_valid),
+        superseded_by = CASE
+            WHEN c.sup IS NULL THEN l.superseded_by
+            WHEN l.superseded_by IS NULL OR c.sup < l.superseded_by THEN c.sup
+            ELSE l.superseded_by
+        END
+    FROM (
+        SELECT m.local_id AS id, MIN(m.is_valid) AS is_valid,
+            MIN(NULLIF(COALESCE(t.local_id, m.superseded_by), m.local_id)) AS sup
+        FROM temp.merge_in m
+        LEFT JOIN temp.merge_in t ON t.event_id = m.superseded_by
+        GROUP BY m.local_id
+    ) AS c
+    WHERE l.event_id = c.id
+        AND (l.is_valid > c.is_valid
+             OR (c.sup IS NOT NULL AND (l.superseded_by IS NULL OR c.sup < l.superseded_by)))
+"""
+
+
+def file_hash(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _tables(conn: sqlite3.Connection, schema: str) -> set[str]:
+    # a peer on the compact layout has observation_event and the payload tables as views
+    return {r[0] for r in conn.execute(
+        f"SELECT name FROM {schema}.sqlite_master WHERE type IN ('table', 'view')"
+    )}
+
+
+def _copy(conn: sqlite3.Connection, table: str, where: str = "", joins: str = "",
+          verb: str = "INSERT OR IGNORE") -> int:
+    columns = TABLES[table][0]
+    cols = ", ".join(columns)
+    sel = ", ".join(f"x.{c}" for c in columns)
+    cur = conn.execute(
+        f"{verb} INTO main.{table}({cols}) SELECT {sel} FROM inc.{table} x {joins} {where}"
+    )
+    return max(cur.rowcount, 0)
+
+
+def _merge(conn: sqlite3.Connection, present: set[str]) -> dict:
+    counts = {}
+    conn.execute(
+        """
+        CREATE TEMP TABLE merge_in (
+            event_id TEXT PRIMARY KEY,
+            device_id TEXT NOT NULL,
+            obs_kind TEXT NOT NULL,
+            observed_ms INTEGER NOT NULL,
+            body_mass_kg REAL,
+            step_value INTEGER,
+            step_mode TEXT,
+            state TEXT,
+            source_kind TEXT NOT NULL,
+            is_valid INTEGER NOT NULL,
+            superseded_by TEXT,
+            content_hash TEXT,
+            local_id TEXT,
+            canon TEXT
+        ) WITHOUT ROWID
+        """
+    )
+    conn.execute(STAGE_SQL)
+    counts["events_incoming"] = conn.execute("SELECT COUNT(*) FROM temp.merge_in").fetchone()[0]
+    rows = conn.execute(
+        """
+        SELECT event_id, device_id, obs_kind, observed_ms, body_mass_kg,
+            step_value, step_mode, state, source_kind
+        FROM temp.merge_in
+        """
+    ).fetchall()
+    conn.executemany(
+        "UPDATE temp.merge_in SET content_hash = ? WHERE event_id = ?",
+        [(identity.row_hash(r), r[0]) for r in rows],
+    )
+    del rows
+
+    conn.execute(
+        """
+        UPDATE temp.merge_in SET local_id = event_id
+        WHERE EXISTS (SELECT 1 FROM main.event l WHERE l.event_id = merge_in.event_id)
+        """
+    )
+    counts["events_known"] = conn.execute(
+        "SELECT COUNT(*) FROM temp.merge_in WHERE local_id IS NOT NULL"
+    ).fetchone()[0]
+    conn.execute(MATCH_IDENTITY_SQL)
+    conn.execute("CREATE INDEX temp.merge_in_hash ON merge_in(content_hash)")
+    conn.execute(CANONICAL_SQL)
+
+    new = "JOIN temp.merge_in m ON m.event_id = x.event_id"
+    fresh = "m.local_id IS NULL AND m.canon = m.event_id"
+    for table, column in (("device", "device_id"), ("event_kind", "obs_kind")):
+        conn.execute(
+            f"INSERT OR IGNORE INTO main.{table}({column})"
+            f" SELECT DISTINCT x.{column} FROM inc.observation_event x {new} WHERE {fresh}"
+        )
+    # into the compact tables, so that rowcount counts the rows; superseded_by
+    # is set by RESOLVE_SQL, once peer ids are remapped
+    cur = conn.execute(
+        f"""
+        INSERT INTO main.event(event_id, device_key, kind_key, observed_ms, observed_at,
+                               is_valid, superseded_by, note)
+        SELECT x.event_id, d.device_key, k.kind_key, x.observed_ms,
+            NULLIF(x.observed_at, {OBSERVED_AT_SQL.format(ms="x.observed_ms")}),
+            x.is_valid, NULL, x.note
+        FROM inc.observation_event x {new}
+        JOIN main.device d ON d.device_id = x.device_id
+        JOIN main.event_kind k ON k.obs_kind = x.obs_kind
+        WHERE {fresh}
+        """
+    )
+    counts["events_new"] = cur.rowcount
+    for table, (compact, columns) in PAYLOAD_TABLES.items():
+        if table in present:
+            cur = conn.execute(
+                f"INSERT OR IGNORE INTO main.{compact}(event_key, {', '.join(columns)})"
+                f" SELECT l.event_key, {', '.join(f'x.{c}' for c in columns)}"
+                f" FROM inc.{table} x {new} JOIN main.event l ON l.event_id = x.event_id"
+                f" WHERE {fresh}"
+            )
+            counts[table] = max(cur.rowcount, 0)
+    conn.execute(
+        """
+        INSERT INTO main.observation_identity(content_hash, event_id)
+        SELECT content_hash, event_id FROM temp.merge_in
+        WHERE local_id IS NULL AND canon = event_id AND content_hash IS NOT NULL
+        """
+    )
+    conn.execute("UPDATE temp.merge_in SET local_id = canon WHERE local_id IS NULL")
+    counts["events_duplicate"] = (counts["events_incoming"] - counts["events_known"]
+                                  - counts["events_new"])
+    counts["events_resolved"] = conn.execute(RESOLVE_SQL).rowcount
+
+    if "metric_def" in present:
+        # watermarks are local bookkeeping and are never merged
+        counts["metric_def"] = conn.execute(
+            """
+            INSERT OR IGNORE INTO main.metric_def(metric_id, metric_name, watermark, unit, description)
+            SELECT metric_id, metric_name, '{}', unit, description FROM inc.metric_def
+            """
+        ).rowcount
+    if "metric_value" in present:
+        cols = TABLES["metric_value"][0]
+        cur = conn.execute(
+            f"""
+            INSERT INTO main.metric_value({', '.join(cols)})
+            SELECT {', '.join(f'x.{c}' for c in cols)} FROM inc.metric_value x
+            JOIN main.metric_def d ON d.metric_id = x.metric_id
+            WHERE true
+            ON CONFLICT(metric_value_id) DO UPDATE SET
+                computed_at = excluded.computed_at, value_real = excluded.value_real,
+                value_int = excluded.value_int, value_text = excluded.value_text
+            WHERE excluded.computed_at > metric_value.computed_at
+            """
+        )
+        counts["metric_value"] = cur.rowcount
+    if "metric_run" in present and "metric_value" in present:
+        # the run follows whichever side's value won
+        counts["metric_run"] = _copy(
+            conn, "metric_run", verb="INSERT OR REPLACE",
+            joins="JOIN inc.metric_value iv ON iv.metric_value_id = x.metric_value_id"
+                  " JOIN main.metric_value lv ON lv.metric_value_id = x.metric_value_id",
+            where="WHERE lv.computed_at = iv.computed_at",
+        )
+    if "decision_run" in present:
+        counts["decision_run"] = _copy(
+            conn, "decision_run",
+            joins="JOIN main.metric_value lv ON lv.metric_value_id = x.metric_value_id",
+        )
+    if "decision_result" in present:
+        counts["decision_result"] = _copy(
+            conn, "decision_result",
+            joins="JOIN main.decision_run r ON r.decision_run_id = x.decision_run_id",
+        )
+    conn.execute("DROP TABLE temp.merge_in")
+    return counts
+
+
+def merge(conn: sqlite3.Connection, incoming_path: str) -> dict:
+    """
+    merge incoming_path into conn; returns counts ({"skipped": True} plus
+    the original counts when this file was merged before)
+    """
+    digest = file_hash(incoming_path)
+    row = conn.execute(
+        "SELECT counts_json FROM sync_merge_log WHERE file_hash = ?", (digest,)
+    ).fetchone()
+    if row is not None:
+        return {"skipped": True, **json.loads(row[0])}
+
+    conn.execute("ATTACH DATABASE ? AS inc", (incoming_path,))
+    try:
+        present = _tables(conn, "inc")
+        if "observation_event" not in present:
+            raise ValueError(f"{incoming_path} has no observation_event table")
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            counts = _merge(conn, present)
+            derived.refresh(conn)
+            conn.execute(
+                "INSERT INTO sync_merge_log(file_hash, source_path, counts_json) VALUES (?, ?, ?)",
+                (digest, incoming_path, json.dumps(counts)),
+            )
+    finally:
+        conn.execute("DETACH DATABASE inc")
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m sync.merge")
+    parser.add_argument("incoming", help="peer database to merge")
+    parser.add_argument("--db", default=None, help="database (default: HEALTH_DB_PATH)")
+    args = parser.parse_args(argv)
+
+    conn = db.connect(path=args.db)
+    try:
+        counts = merge(conn, args.incoming)
+        print(f"merged {args.incoming}: {counts}")
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -18,26 +18,24 @@ fi
 
 
 LOCAL_DB="../store/health.db"
-INCOMING_DB="../store/incoming.db"
-SNAPSHOT_DB="../store/health_snap.db"
-MERGE_SQL="merge_income.sql"
 
-: "${HEALTH_REMOTE_INCOME_FILE:?Missing HEALTH_REMOTE_INCOME_FILE}" #REMOTE file local 
+: "${HEALTH_REMOTE_INCOME_CHANGESET:?Missing HEALTH_REMOTE_INCOME_CHANGESET}" #REMOTE file local 
 
-echo "Pulling remote income db" 
-./sync.sh pull "$HEALTH_REMOTE_INCOME_FILE" "$INCOMING_DB"
+# a peer that still pushes a whole .backup sends a .db file; merge that,
+# apply anything else as a delta changeset
+case "$HEALTH_REMOTE_INCOME_CHANGESET" in
+  *.db) INCOMING="../store/incoming.db"; ENGINE=(-m sync.merge) ;;
+  *)    INCOMING="../store/incoming.ndjson.gz"; ENGINE=(-m sync.delta apply --file) ;;
+esac
 
-echo "Snapshot local db"
-sqlite3 "$LOCAL_DB" ".backup '$SNAPSHOT_DB'"
+echo "Pulling remote changes" 
+./sync.sh pull "$HEALTH_REMOTE_INCOME_CHANGESET" "$INCOMING"
 
+# both engines work in a single transaction, so a failed run leaves the
+# local db untouched and no snapshot is needed
 echo "Merge incoming -> local" 
-if [ ! -f "$MERGE_SQL"]; then
-    echo "Error: merge SQL '$MERGE_SQL' not found!"
-    exit 1
-fi 
-
-sqlite3 "$LOCAL_DB" < "$MERGE_SQL"
+(cd "$ROOT_DIR" && python3 "${ENGINE[@]}" "$SCRIPT_DIR/$INCOMING" --db "$SCRIPT_DIR/$LOCAL_DB")
 
-rm -f "$INCOMING_DB"
+rm -f "$INCOMING"
 
-echo "Pull completed"
\ No newline at end of file
+echo "Pull completed"
@@ -14,17 +14,25 @@ else
 fi 
 
 LOCAL_DB="../store/health.db" 
-OUTGOING_DB="../store/outgoing.db" 
+OUTGOING_CHANGESET="../store/outgoing.ndjson.gz" 
 
-: "${HEALTH_REMOTE_INCOMING_FILE:?Missing HEALTH_REMOTE_IMCOMING_FILE}"
+: "${HEALTH_SYNC_PEER_ID:?Missing HEALTH_SYNC_PEER_ID}"
+: "${HEALTH_REMOTE_INCOMING_CHANGESET:?Missing HEALTH_REMOTE_INCOMING_CHANGESET}"
 
 
+# only rows the peer has not acknowledged yet
+echo "Exporting changeset for $HEALTH_SYNC_PEER_ID"
+rm -f "$OUTGOING_CHANGESET"
+(cd "$ROOT_DIR" && python3 -m sync.delta export --db "$SCRIPT_DIR/$LOCAL_DB" \
+    --peer "$HEALTH_SYNC_PEER_ID" --out "$SCRIPT_DIR/$OUTGOING_CHANGESET")
 
-echo "Creating outgoing db"
-rm -f "$OUTGOING_DB"
-sqlite3 "$LOCAL_DB" ".backup '$OUTGOING_DB'"
+echo "Pushing changeset"
+./sync.sh push "$OUTGOING_CHANGESET" "$HEALTH_REMOTE_INCOMING_CHANGESET"
 
-echo "Pushing outgoing db"
-./sync.sh push "$OUTGOINNG_DB" "$HEALTH_REMOTE_INCOMING_FILE"
+# the marks only move once the file is on the peer
+(cd "$ROOT_DIR" && python3 -m sync.delta ack --db "$SCRIPT_DIR/$LOCAL_DB" \
+    --file "$SCRIPT_DIR/$OUTGOING_CHANGESET")
 
-echo "push completed"
\ No newline at end of file
+rm -f "$OUTGOING_CHANGESET"
+
+echo "push completed"
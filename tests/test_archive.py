@@ -0,0 +1,67 @@
+import time
+
+import pytest
+
+from api import archive, config, db, derived, fused, ingest, migrations
+
+
+DAY_MS = 86_400_000
+
+
+def day_records(start_ms: int, days: int) -> list[dict]:
+    out = []
+    for day in range(days):
+        ms = start_ms + day * DAY_MS
+        out.append({
+            "event": {"event_id": f"w-{day}", "device_id": "d1", "observed_at": f"w {day}",
+                      "observed_ms": ms + 8 * 3_600_000, "obs_kind": "weight"},
+            "weight": {"body_mass_kg": 80.0 + day % 5},
+        })
+        out.append({
+            "event": {"event_id": f"s-{day}", "device_id": "d1", "observed_at": f"s {day}",
+                      "observed_ms": ms + 23 * 3_600_000 + 30 * 60_000, "obs_kind": "steps"},
+            "steps": {"step_value": 10_000 + 100 * day, "step_mode": "device_total"},
+        })
+    return out
+
+
+@pytest.fixture
+def conn(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "DEFAULT_TIMEZONE", "UTC")
+    monkeypatch.setattr(config, "ARCHIVE_DIR", tmp_path / "archive")
+    conn = db.connect(path=tmp_path / "health.db")
+    migrations.migrate(conn)
+    yield conn
+    conn.close()
+
+
+def snapshot(conn) -> dict:
+    return {
+        "rollup": [
+            tuple(round(v, 9) if isinstance(v, float) else v for v in row)
+            for row in conn.execute("SELECT * FROM rollup ORDER BY 1, 2, 3")
+        ],
+        "steps": dict(conn.execute("SELECT event_id, step_delta FROM steps_normalized")),
+    }
+
+
+def test_rebuilds_keep_archived_months(conn):
+    start_ms = archive.month_start(int(time.time() * 1000) - 100 * DAY_MS)
+    with conn:
+        ingest.insert_observations(conn, day_records(start_ms, 100))
+        derived.refresh(conn)
+    before = snapshot(conn)
+
+    assert archive.run(conn, older_than_days=40)["events"] > 0
+    with conn:
+        derived.set_timezone(conn, "d1", "Europe/Berlin")
+        derived.set_timezone(conn, "d1", "UTC")
+    assert snapshot(conn)["rollup"] == before["rollup"]
+
+    with conn:
+        derived.rebuild(conn)
+    after = snapshot(conn)
+    assert after["rollup"] == before["rollup"]
+    # the live step deltas, including the first one after the archive
+    assert after["steps"] and after["steps"] == {e: before["steps"][e] for e in after["steps"]}
+    assert fused.check(conn) == []
@@ -0,0 +1,66 @@
+import pytest
+
+from api import config, corrections, db, derived, ingest, metrics, migrations
+from bench.generate import DEFAULT_START_MS, generate
+
+
+DAY_MS = 86_400_000
+HOUR_MS = 3_600_000
+NOW_MS = DEFAULT_START_MS + 11 * DAY_MS
+
+DERIVED = ("fused_minute", "steps_normalized", "rollup", "sleep_session")
+
+
+@pytest.fixture
+def conn(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "DEFAULT_TIMEZONE", "UTC")
+    conn = db.connect(path=tmp_path / "health.db")
+    migrations.migrate(conn)
+    yield conn
+    conn.close()
+
+
+def snapshot(conn) -> dict:
+    return {
+        table: sorted(
+            tuple(round(v, 9) if isinstance(v, float) else v for v in row)
+            for row in conn.execute(f"SELECT * FROM {table}")
+        )
+        for table in DERIVED
+    }
+
+
+def values(conn) -> dict:
+    return dict(conn.execute("SELECT metric_value_id, value_real FROM metric_value"))
+
+
+def test_corrections_match_full_rebuild(conn):
+    with conn:
+        ingest.insert_observations(conn, list(generate(2, 10, seed=3)))
+        derived.refresh(conn)
+    metrics.run(conn, NOW_MS)
+    weighings = [e for (e,) in conn.execute(
+        "SELECT event_id FROM observation_event WHERE device_id = 'bench-000'"
+        " AND obs_kind = 'weight' AND is_valid = 1 ORDER BY observed_ms LIMIT 3"
+    )]
+
+    with conn:
+        # a day of steps, part of a night, and two weighings replaced by a third
+        corrections.apply(conn, "invalidate", device_id="bench-000", obs_kind="steps",
+                          start_ms=DEFAULT_START_MS + 2 * DAY_MS,
+                          end_ms=DEFAULT_START_MS + 3 * DAY_MS)
+        corrections.apply(conn, "invalidate", device_id="bench-001", obs_kind="sleep_state",
+                          start_ms=DEFAULT_START_MS + 4 * DAY_MS,
+                          end_ms=DEFAULT_START_MS + 4 * DAY_MS + 2 * HOUR_MS)
+        corrections.apply(conn, "supersede", event_ids=weighings[:2], superseded_by=weighings[2])
+        result = corrections.apply(conn, "restore", event_ids=weighings[:1])
+    assert result["events"] == 1
+    incremental, corrected = snapshot(conn), values(conn)
+
+    with conn:
+        derived.rebuild(conn)
+        conn.execute("DELETE FROM metric_value")
+        conn.execute("UPDATE metric_def SET watermark = '{}'")
+    metrics.run(conn, NOW_MS)
+    assert snapshot(conn) == incremental
+    assert corrected == pytest.approx(values(conn))
@@ -0,0 +1,87 @@
+import numpy as np
+
+from api import config, db, decisions, derived, ingest, metrics, migrations
+
+
+DAY_MS = 86_400_000
+# 2024-03-20T00:00:00Z; Europe/Berlin moves its clocks on 2024-03-31
+START_MS = 1_710_892_800_000
+
+
+def weighing(event_id: str, day: int, kg: float) -> dict:
+    return {
+        "event": {
+            "event_id": event_id,
+            "device_id": "d1",
+            "observed_at": f"day {day}",
+            "observed_ms": START_MS + day * DAY_MS + 8 * 3_600_000,
+            "obs_kind": "weight",
+        },
+        "weight": {"body_mass_kg": kg},
+    }
+
+
+def test_trend_lag_across_dst(tmp_path):
+    conn = db.connect(path=tmp_path / "health.db")
+    migrations.migrate(conn)
+    with conn:
+        derived.set_timezone(conn, "d1", "Europe/Berlin")
+        ingest.insert_observations(conn, [weighing(f"w-{day}", day, 80.0 + day)
+                                          for day in range(30)])
+        derived.refresh(conn)
+    metrics.run(conn, START_MS + 30 * DAY_MS)
+
+    rows = conn.execute(
+        """
+        SELECT metric_value_id, metric_id, device_id, window_start_ms, window_end_ms
+        FROM metric_value WHERE metric_id = 'weight_mean_7d' ORDER BY window_end_ms
+        """
+    ).fetchall()
+    prev = decisions.previous_values(conn, rows, 7 * DAY_MS)
+    conn.close()
+
+    lengths = {we - ws for _, _, _, ws, we in rows}
+    assert lengths == {7 * DAY_MS}
+    # the windows ending a week or more into the data all have a predecessor,
+    # including the ones whose lag spans the DST change
+    first_end = rows[0][4]
+    has_prev = [we - first_end >= 7 * DAY_MS - 3_600_000 for *_, we in rows]
+    assert list(~np.isnan(prev)) == has_prev
+    assert sum(has_prev) > 7
+
+
+def test_late_value_clears_lagged_decisions(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "DEFAULT_TIMEZONE", "UTC")
+    conn = db.connect(path=tmp_path / "health.db")
+    migrations.migrate(conn)
+    with conn:
+        ingest.insert_observations(conn, [weighing(f"w-{day}", day, 80.0) for day in range(21)])
+        derived.refresh(conn)
+    metrics.run(conn, START_MS + 21 * DAY_MS)
+    decisions.run(conn, "v1")
+
+    def week_over_week() -> dict:
+        return dict(conn.execute(
+            """
+            SELECT mv.window_end_ms, dr.action FROM metric_value mv
+            JOIN decision_run r ON r.metric_value_id = mv.metric_value_id
+            JOIN decision_result dr ON dr.decision_run_id = r.decision_run_id
+            WHERE mv.metric_id = 'weight_mean_7d' AND r.policy_version = 'v1'
+            """
+        ))
+
+    assert set(week_over_week().values()) == {"none"}
+
+    # a late low reading on day 5 lowers the 7-day means of the windows
+    # ending on days 6-12, so the ones a week later now gain over them
+    with conn:
+        ingest.insert_observations(conn, [weighing("late", 5, 60.0)])
+        derived.refresh(conn)
+    metrics.run(conn, START_MS + 21 * DAY_MS)
+    decisions.run(conn, "v1")
+    actions = week_over_week()
+    conn.close()
+
+    gained = {(end - START_MS) // DAY_MS for end, action in actions.items()
+              if action == "weight_gain_week"}
+    assert gained == set(range(13, 20))
@@ -0,0 +1,35 @@
+import random
+
+import pytest
+
+from api import config, db, derived, fused, ingest, migrations
+from bench.generate import generate
+
+
+@pytest.fixture
+def conn(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "DEFAULT_TIMEZONE", "UTC")
+    conn = db.connect(path=tmp_path / "health.db")
+    migrations.migrate(conn)
+    yield conn
+    conn.close()
+
+
+def minutes(conn) -> list:
+    return conn.execute("SELECT * FROM fused_minute ORDER BY 1, 2").fetchall()
+
+
+def test_incremental_matches_rebuild(conn):
+    # every kind, supersedes and invalid samples, arriving out of order
+    records = list(generate(2, 10, seed=3))
+    random.Random(5).shuffle(records)
+    for i in range(0, len(records), 97):
+        with conn:
+            ingest.insert_observations(conn, records[i:i + 97])
+            derived.refresh(conn)
+    incremental = minutes(conn)
+    assert incremental and fused.check(conn) == []
+
+    with conn:
+        fused.rebuild(conn)
+    assert minutes(conn) == incremental
@@ -0,0 +1,101 @@
+import pytest
+
+from api import config, db, derived, ingest, metrics, migrations
+
+
+DAY_MS = 86_400_000
+START_MS = 1_704_067_200_000  # 2024-01-01T00:00:00Z
+
+
+def weighing(day: int, kg: float) -> dict:
+    ms = START_MS + day * DAY_MS + 8 * 3_600_000
+    return {
+        "event": {
+            "event_id": f"w-{day}-{kg}",
+            "device_id": "d1",
+            "observed_at": f"day {day}",
+            "observed_ms": ms,
+            "obs_kind": "weight",
+        },
+        "weight": {"body_mass_kg": kg},
+    }
+
+
+def ingest_records(conn, records):
+    with conn:
+        ingest.insert_observations(conn, records)
+        derived.refresh(conn)
+
+
+def means(conn) -> dict[int, float]:
+    return dict(conn.execute(
+        """
+        SELECT window_end_ms, value_real FROM metric_value
+        WHERE device_id = 'd1' AND metric_id = 'weight_mean_7d'
+        """
+    ))
+
+
+@pytest.fixture
+def conn(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "DEFAULT_TIMEZONE", "UTC")
+    conn = db.connect(path=tmp_path / "health.db")
+    migrations.migrate(conn)
+    yield conn
+    conn.close()
+
+
+def test_late_sample_reaches_closed_windows(conn):
+    now_ms = START_MS + 12 * DAY_MS
+    ingest_records(conn, [weighing(day, 80.0) for day in range(10) if day != 5])
+    metrics.run(conn, now_ms)
+    before = means(conn)
+    assert before and set(before.values()) == {80.0}
+
+    ingest_records(conn, [weighing(5, 120.0)])
+    assert metrics.run(conn, now_ms) > 0
+
+    after = means(conn)
+    assert after.keys() == before.keys()
+    for end_ms, value in after.items():
+        covers_day_5 = end_ms - 7 * DAY_MS <= START_MS + 5 * DAY_MS < end_ms
+        assert (value > 80.0) == covers_day_5, end_ms
+    assert conn.execute("SELECT COUNT(*) FROM metric_dirty").fetchone()[0] == 0
+
+
+def test_late_data_matches_full_recompute(conn):
+    now_ms = START_MS + 30 * DAY_MS
+    ingest_records(conn, [weighing(day, 80.0 + day % 3) for day in range(0, 30, 2)])
+    metrics.run(conn, now_ms)
+    ingest_records(conn, [weighing(day, 70.0 + day % 5) for day in range(1, 30, 4)])
+    metrics.run(conn, now_ms)
+    incremental = conn.execute("SELECT metric_value_id, value_real FROM metric_value").fetchall()
+
+    with conn:
+        conn.execute("DELETE FROM metric_value")
+        conn.execute("UPDATE metric_def SET watermark = '{}'")
+    metrics.run(conn, now_ms)
+    full = dict(conn.execute("SELECT metric_value_id, value_real FROM metric_value"))
+    assert dict(incremental) == pytest.approx(full)
+
+
+def test_timezone_change_moves_written_windows(conn):
+    now_ms = START_MS + 20 * DAY_MS
+    ingest_records(conn, [weighing(day, 80.0 + day % 4) for day in range(20)])
+    metrics.run(conn, now_ms)
+    assert {end_ms % DAY_MS for end_ms in means(conn)} == {0}
+
+    with conn:
+        derived.set_timezone(conn, "d1", "America/Los_Angeles")
+    assert conn.execute("SELECT COUNT(*) FROM metric_dirty").fetchone()[0] > 0
+    metrics.run(conn, now_ms)
+    moved = conn.execute("SELECT metric_value_id, value_real FROM metric_value").fetchall()
+    # local midnight in Los Angeles is 08:00 UTC in winter
+    assert {end_ms % DAY_MS for end_ms in means(conn)} == {8 * 3_600_000}
+
+    with conn:
+        conn.execute("DELETE FROM metric_value")
+        conn.execute("UPDATE metric_def SET watermark = '{}'")
+    metrics.run(conn, now_ms)
+    full = dict(conn.execute("SELECT metric_value_id, value_real FROM metric_value"))
+    assert dict(moved) == pytest.approx(full)
@@ -0,0 +1,174 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from api import config, db, derived, fused, ingest, migrations
+from api.schema import PAYLOAD_TABLES
+
+
+START_MS = 1_704_067_200_000  # 2024-01-01T00:00:00Z
+
+# the observation tables as they were before migration 7
+LEGACY_SQL = """
+CREATE TABLE observation_event (
+    event_id TEXT PRIMARY KEY,
+    device_id TEXT NOT NULL,
+    observed_at TEXT NOT NULL,
+    observed_ms INTEGER NOT NULL,
+    obs_kind TEXT NOT NULL,
+    is_valid INTEGER NOT NULL DEFAULT 1,
+    superseded_by TEXT DEFAULT NULL,
+    note TEXT DEFAULT NULL,
+    CHECK (is_valid IN (0, 1))
+);
+CREATE INDEX idx_event_device_time ON observation_event(device_id, observed_ms);
+CREATE TABLE observation_provenance (
+    event_id TEXT PRIMARY KEY,
+    source_kind TEXT NOT NULL DEFAULT 'unknown',
+    app_version TEXT DEFAULT NULL,
+    ingested_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ', 'now')),
+    provenance_json TEXT DEFAULT NULL,
+    FOREIGN KEY (event_id) REFERENCES observation_event(event_id) ON DELETE CASCADE
+) WITHOUT ROWID;
+CREATE TABLE obs_steps (
+    event_id TEXT PRIMARY KEY,
+    step_value INTEGER NOT NULL,
+    step_mode TEXT NOT NULL,
+    FOREIGN KEY (event_id) REFERENCES observation_event(event_id) ON DELETE CASCADE
+) WITHOUT ROWID;
+CREATE TABLE obs_weight (
+    event_id TEXT PRIMARY KEY,
+    body_mass_kg REAL NOT NULL,
+    body_mass_01 REAL GENERATED ALWAYS AS (round(body_mass_kg, 1)) VIRTUAL,
+    FOREIGN KEY (event_id) REFERENCES observation_event(event_id) ON DELETE CASCADE
+) WITHOUT ROWID;
+CREATE TABLE obs_sleep_state (
+    event_id TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    FOREIGN KEY (event_id) REFERENCES observation_event(event_id) ON DELETE CASCADE
+) WITHOUT ROWID;
+CREATE TABLE steps_normalized (
+    event_id TEXT PRIMARY KEY,
+    device_id TEXT NOT NULL,
+    observed_ms INTEGER NOT NULL,
+    step_mode TEXT NOT NULL,
+    step_delta INTEGER NOT NULL,
+    is_reset INTEGER NOT NULL DEFAULT 0,
+    FOREIGN KEY (event_id) REFERENCES observation_event(event_id) ON DELETE CASCADE
+);
+CREATE TABLE observation_identity (
+    content_hash TEXT PRIMARY KEY,
+    event_id TEXT NOT NULL UNIQUE,
+    FOREIGN KEY (event_id) REFERENCES observation_event(event_id) ON DELETE CASCADE
+) WITHOUT ROWID;
+"""
+
+TABLES = {
+    "observation_event": "event_id, device_id, observed_at, observed_ms, obs_kind,"
+                         " is_valid, superseded_by, note",
+    "observation_provenance": "*",
+    "obs_steps": "*",
+    "obs_weight": "*",
+    "obs_sleep_state": "*",
+    "steps_normalized": "*",
+    "observation_identity": "*",
+}
+
+
+def iso(ms: int) -> str:
+    return datetime.fromtimestamp(ms / 1000, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+@pytest.fixture
+def legacy(tmp_path, monkeypatch):
+    """
+    a database at migration 6, with the observation tables of the old layout
+    """
+    monkeypatch.setattr(config, "DEFAULT_TIMEZONE", "UTC")
+    conn = db.connect(path=tmp_path / "health.db")
+    migrations.migrate(conn)
+    conn.execute("PRAGMA foreign_keys = OFF")
+    for view in ("observation_event", *PAYLOAD_TABLES):
+        conn.execute(f"DROP VIEW {view}")
+    for table in ("steps_normalized", "observation_identity", "event_provenance",
+                  "event_steps", "event_weight", "event_sleep_state", "event", "device",
+                  "event_kind"):
+        conn.execute(f"DROP TABLE {table}")
+    conn.executescript(LEGACY_SQL)
+    conn.execute("DELETE FROM schema_migrations WHERE version = 7")
+    conn.commit()
+    conn.execute("PRAGMA foreign_keys = ON")
+
+    with conn:
+        for i in range(9):
+            ms = START_MS + i * 3_600_000
+            kind = ("weight", "steps", "sleep_state")[i % 3]
+            # imported rows may carry their own spelling of the time
+            observed_at = iso(ms) if i != 4 else "2024-01-01T04:00:00+00:00"
+            conn.execute(
+                "INSERT INTO observation_event VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (f"e{i}", f"d{i % 2}", observed_at, ms, kind, int(i != 7),
+                 "e0" if i == 6 else None, "typo" if i == 5 else None),
+            )
+            conn.execute("INSERT INTO observation_provenance(event_id, source_kind, ingested_at)"
+                         " VALUES (?, 'test', ?)", (f"e{i}", iso(ms)))
+            conn.execute("INSERT INTO observation_identity VALUES (?, ?)", (f"h{i}", f"e{i}"))
+            if kind == "weight":
+                conn.execute("INSERT INTO obs_weight(event_id, body_mass_kg) VALUES (?, ?)",
+                             (f"e{i}", 80.04 + i))
+            elif kind == "steps":
+                conn.execute("INSERT INTO obs_steps VALUES (?, ?, 'delta')", (f"e{i}", 100 * i))
+                conn.execute("INSERT INTO steps_normalized VALUES (?, ?, ?, 'delta', ?, 0)",
+                             (f"e{i}", f"d{i % 2}", ms, 100 * i))
+            else:
+                conn.execute("INSERT INTO obs_sleep_state VALUES (?, 'asleep')", (f"e{i}",))
+    yield conn
+    conn.close()
+
+
+def snapshot(conn) -> dict:
+    return {
+        table: sorted(conn.execute(f"SELECT {cols} FROM {table}").fetchall())
+        for table, cols in TABLES.items()
+    }
+
+
+def test_compact_events_keeps_rows_and_writes_during_the_copy(legacy, monkeypatch):
+    copy_events = migrations._copy_events
+    expected = {}
+
+    def copy_and_write(conn, low, high):
+        copied = copy_events(conn, low, high)
+        if not expected:
+            # the service keeps writing the old tables between chunks
+            ms = START_MS + 20 * 3_600_000
+            conn.execute("INSERT INTO observation_event(event_id, device_id, observed_at,"
+                         " observed_ms, obs_kind) VALUES ('late', 'd2', ?, ?, 'weight')",
+                         (iso(ms), ms))
+            conn.execute("INSERT INTO obs_weight(event_id, body_mass_kg) VALUES ('late', 70.0)")
+            conn.execute("UPDATE observation_event SET is_valid = 0 WHERE event_id = 'e1'")
+            conn.execute("UPDATE obs_steps SET step_value = 5 WHERE event_id = 'e7'")
+            conn.execute("DELETE FROM observation_event WHERE event_id = 'e8'")
+            expected.update(snapshot(conn))
+        return copied
+
+    monkeypatch.setattr(migrations, "_copy_events", copy_and_write)
+    assert migrations.migrate(legacy, chunk_rows=2) == [7]
+    assert snapshot(legacy) == expected
+    assert migrations.migrate(legacy) == []
+
+    # observed_at is only stored where it is not observed_ms spelled out
+    stored = dict(legacy.execute("SELECT event_id, observed_at FROM event"))
+    assert {e for e, at in stored.items() if at is not None} == {"e4"}
+    assert legacy.execute("PRAGMA foreign_key_check").fetchall() == []
+
+    # the compact tables take writes and triggers after the swap
+    with legacy:
+        results = ingest.insert_observations(legacy, [{
+            "event": {"event_id": "new", "device_id": "d0", "observed_at": iso(START_MS + 60_000),
+                      "observed_ms": START_MS + 60_000, "obs_kind": "weight"},
+            "weight": {"body_mass_kg": 81.0},
+        }])
+        derived.rebuild(legacy)
+    assert results == [("ok", None)]
+    assert fused.check(legacy) == []
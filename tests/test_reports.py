@@ -0,0 +1,71 @@
+import json
+
+import pytest
+
+from api import config, db, derived, ingest, migrations, reports
+
+
+DAY_MS = 86_400_000
+START_MS = 1_704_067_200_000  # 2024-01-01T00:00:00Z
+
+
+def weighing(day: int, kg: float) -> dict:
+    return {
+        "event": {
+            "event_id": f"w-{day}",
+            "device_id": "d1",
+            "observed_at": f"day {day}",
+            "observed_ms": START_MS + day * DAY_MS + 2 * 3_600_000,
+            "obs_kind": "weight",
+        },
+        "weight": {"body_mass_kg": kg},
+    }
+
+
+@pytest.fixture
+def conn(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "DEFAULT_TIMEZONE", "UTC")
+    conn = db.connect(path=tmp_path / "health.db")
+    migrations.migrate(conn)
+    yield conn
+    conn.close()
+
+
+def build(conn, **kw):
+    batch = reports.compute(conn, **kw)
+    with conn:
+        reports.write(conn, batch)
+
+
+def stored(conn) -> dict:
+    return {
+        (period, start): json.loads(body)
+        for period, start, body in conn.execute(
+            "SELECT period, period_start_ms, body_json FROM report WHERE device_id = 'd1'"
+        )
+    }
+
+
+def test_timezone_change_rebuilds_reports(conn):
+    with conn:
+        ingest.insert_observations(conn, [weighing(day, 80.0 + day) for day in range(7)])
+        derived.refresh(conn)
+    build(conn)
+
+    with conn:
+        derived.set_timezone(conn, "d1", "America/Los_Angeles")
+        ingest.insert_observations(conn, [weighing(9, 90.0)])
+        derived.refresh(conn)
+    build(conn)
+    incremental = stored(conn)
+
+    months = [r for (period, _), r in incremental.items() if period == "month"]
+    assert {r["timezone"] for r in incremental.values()} == {"America/Los_Angeles"}
+    assert sum(r["weight"]["count"] for r in months) == 8
+    assert sum(r["days_with_data"] for r in months) == 8
+
+    with conn:
+        conn.execute("DELETE FROM report")
+        conn.execute("DELETE FROM report_day")
+    build(conn, full=True)
+    assert incremental == stored(conn)
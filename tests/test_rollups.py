@@ -0,0 +1,42 @@
+import random
+
+import pytest
+
+from api import config, db, derived, ingest, migrations, rollups
+from bench.generate import generate
+
+
+@pytest.fixture
+def conn(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "DEFAULT_TIMEZONE", "UTC")
+    conn = db.connect(path=tmp_path / "health.db")
+    migrations.migrate(conn)
+    yield conn
+    conn.close()
+
+
+def buckets(conn) -> list:
+    return [
+        tuple(round(v, 9) if isinstance(v, float) else v for v in row)
+        for row in conn.execute("SELECT * FROM rollup ORDER BY 1, 2, 3")
+    ]
+
+
+def test_incremental_matches_rebuild(conn):
+    records = list(generate(2, 10, seed=3))
+    random.Random(5).shuffle(records)
+    with conn:
+        derived.set_timezone(conn, "bench-001", "America/New_York")
+    for n, i in enumerate(range(0, len(records), 97)):
+        with conn:
+            if n == 6:
+                # local days move halfway through the stream
+                derived.set_timezone(conn, "bench-000", "Asia/Kolkata")
+            ingest.insert_observations(conn, records[i:i + 97])
+            derived.refresh(conn)
+    incremental = buckets(conn)
+    assert {row[1] for row in incremental} == {"hour", "day", "week"}
+
+    with conn:
+        rollups.rebuild(conn)
+    assert buckets(conn) == incremental
@@ -0,0 +1,35 @@
+import random
+
+import pytest
+
+from api import config, db, derived, ingest, migrations, sleep
+from bench.generate import generate
+
+
+@pytest.fixture
+def conn(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "DEFAULT_TIMEZONE", "UTC")
+    conn = db.connect(path=tmp_path / "health.db")
+    migrations.migrate(conn)
+    yield conn
+    conn.close()
+
+
+def sessions(conn) -> list:
+    return conn.execute("SELECT * FROM sleep_session ORDER BY 1").fetchall()
+
+
+def test_incremental_matches_rebuild(conn):
+    # nights arrive out of order and in pieces, so sessions split and join
+    records = list(generate(2, 10, seed=3))
+    random.Random(5).shuffle(records)
+    for i in range(0, len(records), 97):
+        with conn:
+            ingest.insert_observations(conn, records[i:i + 97])
+            derived.refresh(conn)
+    incremental = sessions(conn)
+    assert len(incremental) >= 2 * 9
+
+    with conn:
+        sleep.rebuild(conn)
+    assert sessions(conn) == incremental
@@ -0,0 +1,74 @@
+import random
+
+import pytest
+
+from api import config, db, derived, ingest, migrations, steps
+from bench.generate import generate
+
+
+HOUR_MS = 3_600_000
+START_MS = 1_704_067_200_000  # 2024-01-01T00:00:00Z
+
+
+def sample(event_id: str, ms: int, value: int, mode: str) -> dict:
+    return {
+        "event": {"event_id": event_id, "device_id": "d1", "observed_at": event_id,
+                  "observed_ms": ms, "obs_kind": "steps"},
+        "steps": {"step_value": value, "step_mode": mode},
+    }
+
+
+@pytest.fixture
+def conn(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "DEFAULT_TIMEZONE", "UTC")
+    conn = db.connect(path=tmp_path / "health.db")
+    migrations.migrate(conn)
+    yield conn
+    conn.close()
+
+
+def normalized(conn) -> dict:
+    return dict(conn.execute("SELECT event_id, step_delta FROM steps_normalized"))
+
+
+def test_one_mode_counts_per_hour(conn):
+    # a phone reports each hour's walking, a watch counts the same steps
+    walked = {8: 500, 9: 300, 10: 700, 11: 200}
+    phone, watch, today = [], [], 0
+    for hour, steps in walked.items():
+        today += steps
+        phone.append(sample(f"p-{hour}", START_MS + hour * HOUR_MS + 50 * 60_000, steps, "delta"))
+        watch.append(sample(f"w-{hour}", START_MS + hour * HOUR_MS + 55 * 60_000, today, "cumulative"))
+    with conn:
+        ingest.insert_observations(conn, [r for r in phone + watch if r["event"]["event_id"] != "p-10"])
+        derived.refresh(conn)
+    # hour 10 only has the watch, whose sample counts since the one at 9:55
+    assert normalized(conn)["w-10"] == 700
+
+    # the phone's hour 10 arrives late and takes over that hour
+    with conn:
+        ingest.insert_observations(conn, [r for r in phone if r["event"]["event_id"] == "p-10"])
+        derived.refresh(conn)
+    incremental = normalized(conn)
+    assert sum(incremental.values()) == sum(walked.values())
+    assert {e for e, d in incremental.items() if d} == {f"p-{hour}" for hour in walked}
+
+    with conn:
+        derived.rebuild(conn)
+    assert normalized(conn) == incremental
+
+
+def test_incremental_matches_rebuild(conn):
+    # all three modes per device, resets included, arriving out of order
+    records = list(generate(2, 10, seed=3))
+    random.Random(5).shuffle(records)
+    for i in range(0, len(records), 97):
+        with conn:
+            ingest.insert_observations(conn, records[i:i + 97])
+            derived.refresh(conn)
+    incremental = conn.execute("SELECT * FROM steps_normalized ORDER BY 1").fetchall()
+    assert {row[3] for row in incremental} == set(steps.MODES)
+
+    with conn:
+        steps.rebuild(conn)
+    assert conn.execute("SELECT * FROM steps_normalized ORDER BY 1").fetchall() == incremental